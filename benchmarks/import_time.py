@@ -0,0 +1,78 @@
+"""
+Measure startup cost of WAVES Galaxy adaptor modules
+
+Each module is imported in a fresh interpreter, after ``django.setup()``, as done when adaptors are registered
+through ``ADAPTORS_CLASSES``. Reports import time and heavy modules pulled in by the import.
+
+Usage (from repository root)::
+
+    python benchmarks/import_time.py [--runs 10] [--against <git revision>]
+
+``--against`` runs the same measures on a checkout of given revision (e.g. ``HEAD~1``) for comparison.
+"""
+from __future__ import unicode_literals, print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ['waves.adaptors.galaxy.tool', 'waves.adaptors.galaxy.router', 'waves.adaptors.galaxy.importers']
+#: Modules only needed when actually talking to Galaxy
+HEAVY = ['bioblend.galaxy.objects', 'bioblend.galaxy', 'requests', 'requests_toolbelt', 'waves.wcore.models']
+
+MEASURE = """
+import json, sys, time
+import django
+django.setup()
+before = set(sys.modules)
+start = time.time()
+__import__(%r)
+elapsed = time.time() - start
+loaded = [name for name in %r if name in sys.modules and name not in before]
+print(json.dumps(dict(elapsed=elapsed, loaded=loaded)))
+"""
+
+
+def measure(root, module, runs):
+    env = dict(os.environ, PYTHONPATH=root, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE',
+                                                                                  'waves_galaxy.settings'))
+    results = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', MEASURE % (module, HEAVY)], cwd=root, env=env)
+        results.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+    times = sorted(result['elapsed'] for result in results)
+    return dict(median=times[len(times) // 2] * 1000, best=times[0] * 1000, loaded=results[-1]['loaded'])
+
+
+def report(label, root, runs):
+    print('== %s' % label)
+    for module in MODULES:
+        result = measure(root, module, runs)
+        print('%-40s median %7.1f ms  best %7.1f ms  heavy: %s' % (module, result['median'], result['best'],
+                                                                   ', '.join(result['loaded']) or '-'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10, help='Interpreters started per module')
+    parser.add_argument('--against', help='Git revision to compare with')
+    args = parser.parse_args()
+    if args.against:
+        checkout = tempfile.mkdtemp()
+        try:
+            archive = subprocess.Popen(['git', 'archive', args.against], cwd=ROOT, stdout=subprocess.PIPE)
+            subprocess.check_call(['tar', '-x', '-C', checkout], stdin=archive.stdout)
+            archive.wait()
+            report(args.against, checkout, args.runs)
+        finally:
+            shutil.rmtree(checkout)
+    report('working tree', ROOT, args.runs)
+
+
+if __name__ == '__main__':
+    main()
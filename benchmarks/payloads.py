@@ -0,0 +1,235 @@
+"""
+Measure Galaxy responses bytes received by adaptor hot paths over one job lifecycle, with and without the
+``MINIMAL_PAYLOADS`` setting
+
+A fake Galaxy host answers bioblend requests (through a request layer, see :mod:`waves.adaptors.galaxy.transport`)
+with responses shaped like Galaxy 18.05 ones, honouring ``keys`` parameter. One job lifecycle is replayed with
+``GalaxyJobAdaptor`` methods: ``--inputs`` files uploads into a history already holding ``--datasets`` datasets
+(shared histories, see ``HISTORY`` setting), ``--polls`` history readiness checks, then job outputs resolution after
+tool run request. Uploads requests themselves are sent in both modes, with identical responses.
+Usage (from repository root)::
+
+    python benchmarks/payloads.py [--inputs 2] [--datasets 200] [--polls 4] [--outputs 3]
+"""
+from __future__ import unicode_literals, print_function
+
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+URL = 'http://galaxy.bench'
+HISTORY_ID = 'f2db41e1fa331b3e'
+TIME = '2018-06-04T09:12:31.523406'
+
+
+def encoded_id(number):
+    return '%016x' % (0x5969b1f7201f12ae + number)
+
+
+class FakeGalaxy(object):
+    """ Request layer answering Galaxy API requests, counting requests and bytes received per phase
+
+    :param datasets: number of datasets already in history
+    """
+
+    def __init__(self, datasets, outputs):
+        self.data_sets = [self.data_set(i, 'ok') for i in range(datasets)]
+        self.outputs = outputs
+        self.phase = None
+        self.counts = {}
+
+    @staticmethod
+    def data_set(number, state, output_name=None):
+        """ Detailed history dataset description """
+        data_set_id = encoded_id(number)
+        data_set = dict(
+            model_class='HistoryDatasetAssociation', id=data_set_id, hid=number + 1, name='data_%i.fasta' % number,
+            history_id=HISTORY_ID, dataset_id=encoded_id(100000 + number), state=state, deleted=False, purged=False,
+            visible=True, accessible=True, resubmitted=False, rerunnable=True, create_time=TIME, update_time=TIME,
+            history_content_type='dataset', hda_ldda='hda', api_type='file', type='file', extension='fasta',
+            file_ext='fasta', data_type='galaxy.datatypes.sequence.Fasta', genome_build='?', metadata_dbkey='?',
+            metadata_data_lines=2480, metadata_sequences=1240, file_size=183405, misc_blurb='1,240 sequences',
+            misc_info='uploaded fasta file', creating_job=encoded_id(200000 + number), annotation=None, tags=[],
+            uuid='9a1c4ce1-6e0d-4b8b-93ac-%012x' % number, display_apps=[], display_types=[], visualizations=[],
+            meta_files=[], url='/api/histories/%s/contents/%s' % (HISTORY_ID, data_set_id),
+            download_url='/api/histories/%s/contents/%s/display' % (HISTORY_ID, data_set_id),
+            peek='<table cellspacing="0" cellpadding="3"><tr><td>&gt;sequence_%i</td></tr><tr><td>ACGTTGCAAGT'
+                 'CCGATGCAAGTTGCAACGTAGGCT</td></tr></table>' % number)
+        if output_name:
+            data_set['output_name'] = output_name
+        return data_set
+
+    @staticmethod
+    def summary(data_set):
+        """ History contents list item """
+        return dict((key, data_set[key]) for key in (
+            'id', 'name', 'hid', 'history_id', 'state', 'deleted', 'purged', 'visible', 'history_content_type',
+            'extension', 'create_time', 'update_time', 'url', 'type', 'dataset_id'))
+
+    def history(self):
+        states = {}
+        for data_set in self.data_sets:
+            states.setdefault(data_set['state'], []).append(data_set['id'])
+        state = 'queued' if 'queued' in states else 'ok'
+        return dict(
+            model_class='History', id=HISTORY_ID, name='WAVES user:42', deleted=False, purged=False, published=False,
+            importable=False, slug=None, username_and_slug=None, annotation=None, tags=[], genome_build=None,
+            create_time=TIME, update_time=TIME, user_id=encoded_id(300000), size=183405 * len(self.data_sets),
+            nice_size='%i KB' % (183 * len(self.data_sets)), empty=not self.data_sets, hid_counter=len(self.data_sets),
+            state=state, state_ids=states, state_details=dict((key, len(ids)) for key, ids in states.items()),
+            contents_url='/api/histories/%s/contents' % HISTORY_ID, url='/api/histories/%s' % HISTORY_ID)
+
+    def job(self, full):
+        outputs = self.data_sets[-self.outputs:]
+        job = dict(model_class='Job', id=encoded_id(400000), tool_id='cat1', state='queued', exit_code=None,
+                   create_time=TIME, update_time=TIME, history_id=HISTORY_ID, external_id=None,
+                   params=dict(chromInfo='"/galaxy/tool-data/shared/ucsc/chrom/?.len"', dbkey='"?"',
+                               queries='[]', input1='{"values": [{"src": "hda", "id": 1}]}'),
+                   inputs=dict(input1=dict(id=self.data_sets[0]['id'], src='hda', uuid=self.data_sets[0]['uuid'])),
+                   outputs=dict(('out_file%i' % (i + 1), dict(id=data_set['id'], src='hda', uuid=data_set['uuid']))
+                                for i, data_set in enumerate(outputs)))
+        if full:
+            job.update(command_line='python /galaxy/tools/filters/catWrapper.py "/galaxy/database/files/000/'
+                                    'dataset_1.dat" "/galaxy/database/files/000/dataset_2.dat"',
+                       stdout='', stderr='', job_messages=[], job_metrics=[], dependencies=[])
+        return job
+
+    def respond(self, method, path, params):
+        params = params or {}
+        match = re.match(r'/api/(\w+)(?:/(\w+))?(?:/(contents))?(?:/(\w+))?$', path)
+        module, item, contents, sub_item = match.groups()
+        if method == 'post' and module == 'tools':
+            number = len(self.data_sets)
+            self.data_sets.append(self.data_set(number, 'queued'))
+            return dict(outputs=[self.data_sets[-1]], jobs=[dict(id=encoded_id(500000 + number), state='new')],
+                        output_collections=[], implicit_collections=[])
+        if module == 'histories' and contents:
+            if sub_item:
+                return next(data_set for data_set in self.data_sets if data_set['id'] == sub_item)
+            return [self.summary(data_set) for data_set in self.data_sets]
+        if module == 'histories':
+            body = self.history()
+        elif module == 'datasets':
+            body = next(data_set for data_set in self.data_sets if data_set['id'] == item)
+        elif module == 'jobs':
+            body = self.job(full=bool(params.get('full')))
+        else:
+            raise ValueError('Unexpected request %s %s' % (method.upper(), path))
+        if params.get('keys'):
+            body = dict((key, body.get(key)) for key in params['keys'].split(','))
+        return body
+
+    def __call__(self, method, url, kwargs, send):
+        import requests
+
+        body = self.respond(method, url[len(URL):].split('?')[0], kwargs.get('params'))
+        content = json.dumps(body).encode('utf-8')
+        counts = self.counts.setdefault(self.phase, [0, 0])
+        counts[0] += 1
+        counts[1] += len(content)
+        if method != 'get':
+            return body
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = content
+        response._content_consumed = True
+        return response
+
+    @contextmanager
+    def counting(self, phase):
+        self.phase = phase
+        yield
+        self.phase = None
+
+
+class NullTimer(object):
+    @contextmanager
+    def phase(self, name, label=None):
+        yield
+
+
+class InputFile(object):
+    def __init__(self, name, value):
+        self.name, self.value, self.remote_input_id = name, value, None
+
+    def save(self):
+        pass
+
+
+class Job(object):
+    def __init__(self, working_dir, inputs):
+        self.working_dir = working_dir
+        self.input_files = []
+        for i in range(inputs):
+            value = 'input_%i.fasta' % i
+            with open(os.path.join(working_dir, value), 'w') as input_file:
+                input_file.write('>sequence_%i\nACGTTGCAAGTCCGATGCAAGTTGCAACGTAGGCT\n' % i)
+            self.input_files.append(InputFile('input%i' % i, value))
+
+
+def lifecycle(minimal, args):
+    """ Replay job lifecycle hot paths, return requests count and bytes received per phase """
+    from bioblend.galaxy.objects import GalaxyInstance, wrappers
+    from django.test import override_settings
+    from waves.adaptors.galaxy.tool import GalaxyJobAdaptor
+    from waves.adaptors.galaxy.transport import add_request_layer
+
+    galaxy = FakeGalaxy(args.datasets, args.outputs)
+    adaptor = GalaxyJobAdaptor(command='cat1')
+    adaptor.connector = GalaxyInstance(URL, 'benchmark')
+    add_request_layer(adaptor.connector.gi, galaxy)
+    working_dir = tempfile.mkdtemp()
+    try:
+        with override_settings(WAVES_GALAXY=dict(MINIMAL_PAYLOADS=minimal)):
+            job = Job(working_dir, args.inputs)
+            history = wrappers.History(dict(id=HISTORY_ID, name='WAVES user:42'), gi=adaptor.connector)
+            with galaxy.counting('upload'):
+                adaptor._upload_inputs(job, history, NullTimer())
+            with galaxy.counting('readiness'):
+                for _ in range(args.polls):
+                    adaptor._history_ready(HISTORY_ID)
+            run_outputs = [FakeGalaxy.data_set(len(galaxy.data_sets) + i, 'new', output_name='out_file%i' % (i + 1))
+                           for i in range(args.outputs)]
+            galaxy.data_sets.extend(run_outputs)
+            with galaxy.counting('outputs'):
+                adaptor._remote_outputs(encoded_id(400000), run_outputs)
+    finally:
+        shutil.rmtree(working_dir)
+    return galaxy.counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--inputs', type=int, default=2, help='Job input files')
+    parser.add_argument('--datasets', type=int, default=200, help='Datasets already in job history')
+    parser.add_argument('--polls', type=int, default=4, help='History readiness checks before submission')
+    parser.add_argument('--outputs', type=int, default=3, help='Job outputs')
+    args = parser.parse_args()
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'waves_galaxy.settings')
+    import django
+
+    django.setup()
+    full, minimal = lifecycle(False, args), lifecycle(True, args)
+    print('%-10s %14s %14s %12s %12s %12s' % ('phase', 'requests full', 'requests min', 'bytes full', 'bytes min',
+                                            'saved'))
+    totals = [0, 0, 0, 0]
+    for phase in ('upload', 'readiness', 'outputs'):
+        row = full.get(phase, [0, 0]) + minimal.get(phase, [0, 0])
+        totals = [total + value for total, value in zip(totals, row)]
+        print('%-10s %14i %14i %12i %12i %12i' % (phase, row[0], row[2], row[1], row[3], row[1] - row[3]))
+    print('%-10s %14i %14i %12i %12i %12i' % ('job', totals[0], totals[2], totals[1], totals[3],
+                                            totals[1] - totals[3]))
+    print('Bytes saved per job lifecycle: %i (%.0f%%)' % (totals[1] - totals[3],
+                                                         100. * (totals[1] - totals[3]) / (totals[1] or 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Measure memory and time spent building importer tools choices from a large Galaxy tools list
+
+A tools list shaped like a large Galaxy host one (``--tools`` tools in 60 panel sections, most tools installed in
+several versions) is generated, then importer choices are built from it:
+
+- ``services``: previous implementation, one ``bioblend`` Tool wrapper and one unsaved Django ``Service`` per tool
+- ``catalog``: :class:`waves.adaptors.galaxy.catalog.ToolCatalog`, kept in memory for following calls
+
+Each variant runs in a fresh interpreter. Reports best time and peak memory allocated (see ``tool_import.py``).
+Usage (from repository root)::
+
+    python benchmarks/tool_catalog.py [--tools 10000] [--runs 3]
+"""
+from __future__ import unicode_literals, print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from tool_import import MemoryMeter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VARIANTS = ['services', 'catalog']
+UNWANTED = [None, 'Get Data', 'Filter and sort', 'Collection Operations', 'Graph/Display Data', 'Send Data',
+            'Text Manipulation', 'Fetch Alignments']
+
+
+def tools_list(count):
+    """ Galaxy ``GET /api/tools?in_panel=false`` like tools list """
+    tools = []
+    for i in range(count):
+        name = 'tool_%i' % (i // 3)
+        version = '%i.%i.%i' % (1 + i % 3, i % 7, i % 2)
+        tools.append(dict(id='toolshed.g2.bx.psu.edu/repos/owner_%i/%s/%s/%s' % (i % 400, name, name, version),
+                          name=name.replace('_', ' ').capitalize(), version=version,
+                          description='Description of %s' % name, panel_section_name='Section %i' % (i % 60),
+                          panel_section_id='section_%i' % (i % 60), model_class='Tool', link='/tool_runner?...',
+                          min_width=-1, target='galaxy_main', form_style='regular', labels=[]))
+    return tools
+
+
+def services_choices(tools):
+    from bioblend.galaxy.objects.wrappers import Tool
+    from waves.wcore.models import get_service_model
+
+    Service = get_service_model()
+    tool_list = [Tool(tool, gi=None) for tool in tools]
+    group_list = [x for x in sorted(set(y.wrapped['panel_section_name'] for y in tool_list)) if x not in UNWANTED]
+    service_list = [(x, sorted((Service(remote_service_id=y.id, name=y.name, version=y.version,
+                                        description=y.wrapped['description'])
+                                for y in tool_list if y.wrapped['panel_section_name'] == x), key=lambda d: d.name))
+                    for x in group_list]
+    return [(x[0], [(y.remote_service_id, y.name + ' ' + y.version + (' (%s)' % y.description if y.description
+                                                                      else '')) for y in x[1]])
+            for x in service_list]
+
+
+def catalog_choices(tools):
+    from waves.adaptors.galaxy.catalog import ToolCatalog
+
+    return ToolCatalog(tools).choices(exclude_sections=UNWANTED)
+
+
+def measure(variant, count):
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'waves_galaxy.settings')
+    import django
+
+    django.setup()
+    tools = tools_list(count)
+    build = dict(services=services_choices, catalog=catalog_choices)[variant]
+    with MemoryMeter() as memory:
+        start = time.time()
+        choices = build(tools)
+        elapsed = time.time() - start
+    print(json.dumps(dict(elapsed=elapsed, memory=memory.peak, label=memory.label,
+                          choices=sum(len(group) for _, group in choices))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tools', type=int, default=10000, help='Tools listed on Galaxy host')
+    parser.add_argument('--runs', type=int, default=3, help='Interpreters started per variant')
+    parser.add_argument('--variant', choices=VARIANTS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.variant:
+        return measure(args.variant, args.tools)
+    print('%-10s %8s %10s %14s' % ('variant', 'choices', 'best (ms)', 'memory (KiB)'))
+    for variant in VARIANTS:
+        results = []
+        for _ in range(args.runs):
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--variant', variant,
+                                              '--tools', str(args.tools)], cwd=ROOT)
+            results.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+        best = min(results, key=lambda result: result['elapsed'])
+        print('%-10s %8i %10.1f %5s %8.0f' % (variant, best['choices'], best['elapsed'] * 1000, best['label'],
+                                            best['memory']))
+
+
+if __name__ == '__main__':
+    main()
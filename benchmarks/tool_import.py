@@ -0,0 +1,266 @@
+"""
+Measure Galaxy tools params import cost over a corpus of recorded tool definitions
+
+Each tool definition (``show_tool`` response with ``io_details`` and ``link_details``) is imported with
+``GalaxyToolImporter.load_tool_params`` into a new service default submission, on a test database created from
+current Django settings. No Galaxy host is needed: tool definitions are served from the corpus files. Reports, per
+tool, params count, best import time, database queries count and peak memory allocated during import (Python 3
+``tracemalloc``; on Python 2 only process max RSS growth is available, reported as ``rss+``).
+
+Corpus is made of ``waves/adaptors/galaxy/fixtures/services`` (tools used by tests) and
+``waves/adaptors/galaxy/fixtures/tools``. Usage (from repository root)::
+
+    python benchmarks/tool_import.py run [--runs 5] [--tool <file name> ...]
+    python benchmarks/tool_import.py record --url <galaxy url> --key <api key> <tool id> [<tool id> ...]
+    python benchmarks/tool_import.py generate
+
+``record`` adds tools from a live Galaxy host to the corpus, ``generate`` (re)writes ``synthetic_*`` tools, large
+tools (hundreds of params, deep conditionals, repeats) built from recorded params descriptions.
+"""
+from __future__ import unicode_literals, print_function
+
+import argparse
+import copy
+import glob
+import json
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'waves', 'adaptors', 'galaxy', 'fixtures')
+CORPUS = [os.path.join(FIXTURES, 'services'), os.path.join(FIXTURES, 'tools')]
+
+
+def load_corpus(names=None):
+    """ Corpus tools definitions, smallest first: list of (file name, tool definition) """
+    corpus = []
+    for directory in CORPUS:
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            name = os.path.splitext(os.path.basename(path))[0]
+            if not names or name in names:
+                with open(path) as fixture:
+                    corpus.append((name, json.load(fixture)))
+    return sorted(corpus, key=lambda item: count_params(item[1]['inputs']))
+
+
+def count_params(tool_inputs):
+    """ Number of params in Galaxy tool inputs tree (conditionals test params included) """
+    count, stack = 0, list(tool_inputs or [])
+    while stack:
+        tool_input = stack.pop()
+        if tool_input.get('type') in ('section', 'repeat'):
+            stack.extend(tool_input.get('inputs', []))
+        elif tool_input.get('type') == 'conditional':
+            count += 1
+            stack.extend(child for case in tool_input.get('cases', []) for child in case.get('inputs', []))
+        else:
+            count += 1
+    return count
+
+
+def write_tool(path, tool):
+    with open(path, 'w') as fixture:
+        json.dump(tool, fixture, indent=1, sort_keys=True, separators=(',', ': '))
+
+
+class FixtureConnector(object):
+    """ Stands for a connected bioblend ``objects.GalaxyInstance``, serving tools details from the corpus """
+
+    def __init__(self, tools):
+        self._tools = tools
+        self.gi = self
+        self.tools = self
+
+    def show_tool(self, tool_id, io_details=False, link_details=False):
+        return copy.deepcopy(self._tools[tool_id])
+
+    def get(self, id_, io_details=False, link_details=False):
+        from bioblend.galaxy.objects.wrappers import Tool
+        return Tool(self.show_tool(id_), gi=self)
+
+
+class FixtureAdaptor(object):
+    complete_url = 'fixtures://corpus'
+
+    def __init__(self, tools):
+        self.connector = FixtureConnector(tools)
+
+
+class MemoryMeter(object):
+    """ Peak memory allocated in a block, in KiB """
+
+    def __init__(self):
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        self._tracemalloc = tracemalloc
+        self.label = 'peak' if tracemalloc else 'rss+'
+        self.peak = None
+
+    def __enter__(self):
+        if self._tracemalloc:
+            self._tracemalloc.start()
+        else:
+            self._rss = self._max_rss()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._tracemalloc:
+            self.peak = self._tracemalloc.get_traced_memory()[1] / 1024.0
+            self._tracemalloc.stop()
+        else:
+            self.peak = float(self._max_rss() - self._rss)
+
+    @staticmethod
+    def _max_rss():
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, KiB elsewhere
+        return rss / 1024 if sys.platform == 'darwin' else rss
+
+
+def import_tool(tools, tool):
+    """ Import tool params once in a new service, return (elapsed, queries, peak memory, imported inputs) """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from waves.adaptors.galaxy.importers import GalaxyToolImporter
+    from waves.wcore.models import get_service_model
+
+    service = get_service_model().objects.create(name=tool['name'][:255], version=tool.get('version'))
+    try:
+        importer = GalaxyToolImporter(FixtureAdaptor(tools))
+        importer._warnings, importer._errors = [], []
+        importer.service, importer.submission = service, service.default_submission
+        with MemoryMeter() as memory, CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            importer.load_tool_params(tool['id'], importer.submission)
+            elapsed = time.time() - start
+        return elapsed, len(queries), memory, importer.submission.inputs.count()
+    finally:
+        service.delete()
+
+
+def run(args):
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'waves_galaxy.settings')
+    import django
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    from waves.adaptors.galaxy.cache import get_metadata_cache
+
+    django.setup()
+    setup_test_environment()
+    corpus = load_corpus(args.tool)
+    tools = dict((tool['id'], tool) for _, tool in corpus)
+    database = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        cache = get_metadata_cache(FixtureAdaptor.complete_url)
+        if cache is not None:
+            cache.invalidate()
+        print('%-32s %6s %6s %10s %8s %12s' % ('tool', 'params', 'inputs', 'best (ms)', 'queries', 'memory (KiB)'))
+        for name, tool in corpus:
+            results = [import_tool(tools, tool) for _ in range(args.runs)]
+            elapsed, queries, memory, inputs = min(results, key=lambda result: result[0])
+            print('%-32s %6i %6i %10.1f %8i %7s %.0f' % (name[:32], count_params(tool['inputs']), inputs,
+                                                       elapsed * 1000, queries, memory.label, memory.peak))
+    finally:
+        connection.creation.destroy_test_db(database, verbosity=0)
+
+
+def record(args):
+    from bioblend.galaxy import GalaxyInstance
+
+    gi = GalaxyInstance(args.url, key=args.key)
+    for tool_id in args.tool_id:
+        tool = gi.tools.show_tool(tool_id, io_details=True, link_details=True)
+        # Tool shed ids: <shed>/repos/<owner>/<repository>/<tool>/<version>
+        name = re.sub(r'[^\w]+', '_', tool_id.split('/')[-2] if '/' in tool_id else tool_id).lower()
+        path = os.path.join(CORPUS[-1], '%s.json' % name)
+        write_tool(path, tool)
+        print('%s: %i params recorded in %s' % (tool_id, count_params(tool['inputs']), os.path.relpath(path, ROOT)))
+
+
+def _templates():
+    """ Recorded params descriptions per type, synthetic tools params are copies of them """
+    templates, stack = {}, [tool_input for _, tool in load_corpus(['noisy', 'fastme']) for tool_input in tool['inputs']]
+    while stack:
+        tool_input = stack.pop()
+        if tool_input.get('type') == 'conditional':
+            stack.append(tool_input['test_param'])
+            stack.extend(child for case in tool_input.get('cases', []) for child in case.get('inputs', []))
+        else:
+            templates.setdefault(tool_input['type'], tool_input)
+    return templates
+
+
+def _param(templates, input_type, name):
+    param = copy.deepcopy(templates[input_type])
+    param.update(name=name, label=name.replace('_', ' ').capitalize())
+    return param
+
+
+def _params(templates, prefix, count):
+    types = ['integer', 'float', 'boolean', 'select', 'text']
+    return [_param(templates, types[i % len(types)], '%s_%i' % (prefix, i)) for i in range(count)]
+
+
+def _conditional(templates, name, cases):
+    test_param = _param(templates, 'select', '%s_type' % name)
+    test_param['options'] = [[value.capitalize(), value, i == 0] for i, value in enumerate(value for value, _ in cases)]
+    test_param['value'] = cases[0][0]
+    return dict(type='conditional', model_class='Conditional', name=name, test_param=test_param,
+                cases=[dict(model_class='ConditionalWhen', value=value, inputs=inputs) for value, inputs in cases])
+
+
+def _tool(templates, name, inputs, description):
+    base = load_corpus(['noisy'])[0][1]
+    return dict(base, id='synthetic/%s/1.0' % name, name=name.replace('_', ' ').capitalize(), version='1.0',
+                description=description, inputs=[_param(templates, 'data', 'input')] + inputs)
+
+
+def generate(args):
+    templates = _templates()
+    sections = [dict(type='section', model_class='Section', name='section_%i' % i, title='Section %i' % i,
+                     expanded=False, inputs=_params(templates, 'section_%i' % i, 25)) for i in range(12)]
+    deepest = []
+    for level in reversed(range(12)):
+        deepest = [_conditional(templates, 'level_%i' % level,
+                                [('a', _params(templates, 'level_%i_a' % level, 6) + deepest),
+                                 ('b', _params(templates, 'level_%i_b' % level, 2)), ('c', [])])]
+    repeats = [dict(type='repeat', model_class='Repeat', name='repeat_%i' % i, title='Repeat %i' % i, min=0,
+                    max='__Infinity__', default=1,
+                    inputs=_params(templates, 'repeat_%i' % i, 6) + [
+                        _conditional(templates, 'repeat_%i_mode' % i,
+                                     [('a', _params(templates, 'repeat_%i_a' % i, 3)),
+                                      ('b', _params(templates, 'repeat_%i_b' % i, 3))])]) for i in range(8)]
+    for name, inputs, description in (('synthetic_wide', sections, '300 params in 12 sections'),
+                                      ('synthetic_deep', deepest, '12 nested conditionals'),
+                                      ('synthetic_repeats', repeats, '8 repeats holding conditionals')):
+        path = os.path.join(CORPUS[-1], '%s.json' % name)
+        write_tool(path, _tool(templates, name, inputs, description))
+        print('%s: %i params' % (os.path.relpath(path, ROOT), count_params(inputs) + 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers()
+    run_parser = commands.add_parser('run', help='Import corpus tools on a test database')
+    run_parser.add_argument('--runs', type=int, default=5, help='Imports per tool, best one is reported')
+    run_parser.add_argument('--tool', action='append', help='Corpus file name (without extension), repeatable')
+    run_parser.set_defaults(command=run)
+    record_parser = commands.add_parser('record', help='Add tools definitions from a Galaxy host to the corpus')
+    record_parser.add_argument('--url', required=True, help='Galaxy host url')
+    record_parser.add_argument('--key', required=True, help='Galaxy API key')
+    record_parser.add_argument('tool_id', nargs='+', help='Galaxy tool id')
+    record_parser.set_defaults(command=record)
+    generate_parser = commands.add_parser('generate', help='Write synthetic large tools definitions')
+    generate_parser.set_defaults(command=generate)
+    args = parser.parse_args()
+    args.command(args)
+
+
+if __name__ == '__main__':
+    main()
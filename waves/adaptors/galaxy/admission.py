@@ -0,0 +1,192 @@
+""" Admission control for jobs submitted to a Galaxy host
+
+When Galaxy already has ``max_active`` jobs queued or running for the adaptor's user, new jobs are not submitted
+but held in a local backlog, shared by all WAVES processes on this host (a sqlite database in
+``galaxy_settings.SHARED_DIR``). Held jobs are admitted in priority order, then submission order, as soon as
+active jobs count goes below threshold. Held jobs which are no longer waiting locally (deleted, cancelled, failed)
+are pruned from backlog, so that they do not delay other jobs admission.
+
+Held jobs are released by an explicit step (``galaxy_pipeline`` or ``galaxy_release`` management commands, see
+:meth:`waves.adaptors.galaxy.tool.GalaxyJobAdaptor.release_held`), never by a job status check: an admitted held job
+is leased, it stays in backlog until its submission succeeds and is held again if it fails.
+
+Active jobs count is read from Galaxy at most every ``load_ttl`` seconds, and incremented locally for each job
+admitted in-between.
+"""
+from __future__ import unicode_literals
+
+import errno
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from os.path import join
+
+from waves.adaptors.galaxy.settings import galaxy_settings
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['AdmissionController', 'get_admission_controller', 'default_priority', 'active_remote_jobs']
+
+#: Galaxy jobs states counted as active
+ACTIVE_STATES = ('new', 'queued', 'running')
+#: Max time (seconds) for a released job submission, before other processes may release it again
+RELEASE_LEASE = 600
+
+
+def default_priority(job):
+    """ Registered users jobs first """
+    return 1 if getattr(job, 'client', None) is not None else 0
+
+
+def active_remote_jobs(gi):
+    """ Number of current Galaxy user's jobs waiting or running """
+    return len(gi.jobs._get(params=dict(state=list(ACTIVE_STATES))))
+
+
+class AdmissionController(object):
+    """ Local jobs backlog for one Galaxy host
+
+    :param url: Galaxy host url
+    :param max_active: max number of active jobs on Galaxy
+    :param load_ttl: max time (seconds) between two active jobs count from Galaxy
+    """
+
+    def __init__(self, url, max_active, load_ttl=10, shared_dir=None):
+        self.url = url
+        self.max_active = max_active
+        self.load_ttl = load_ttl
+        self._pruned = 0
+        directory = join(shared_dir or galaxy_settings.SHARED_DIR, 'admission')
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.db_path = join(directory, '%s.sqlite' % hashlib.md5(url.encode('utf-8')).hexdigest())
+        with self._connection() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS held (job TEXT PRIMARY KEY, priority INTEGER, enqueued REAL, '
+                       'leased REAL DEFAULT 0)')
+            db.execute('CREATE TABLE IF NOT EXISTS load (id INTEGER PRIMARY KEY, active INTEGER, stamp REAL)')
+
+    def _connection(self):
+        # Autocommit mode, admission decisions are serialized with explicit 'BEGIN IMMEDIATE' transactions
+        return sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+
+    def admit(self, job, priority, count_active, lease=0):
+        """ Tell whether job may be submitted now, hold it in backlog otherwise
+
+        :param job: job key (slug)
+        :param priority: job priority, higher first
+        :param count_active: callable returning current active jobs count on Galaxy
+        :param lease: keep admitted held job in backlog for ``lease`` seconds, until :meth:`remove` once submitted
+            or :meth:`requeue` if submission failed (meanwhile, job is not admitted again)
+        :return: True if job is admitted (and removed from backlog unless leased)
+        """
+        db = self._connection()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                row = db.execute('SELECT active, stamp FROM load WHERE id = 0').fetchone()
+                if row is None or time.time() - row[1] > self.load_ttl:
+                    active, stamp = count_active(), time.time()
+                else:
+                    active, stamp = row
+                held = db.execute('SELECT job, priority, enqueued, leased FROM held').fetchall()
+                current = next((item for item in held if item[0] == job), None)
+                enqueued = current[2] if current is not None else time.time()
+                leased = current is not None and current[3] > time.time()
+                rank = sum(1 for other, other_priority, other_enqueued, _ in held if other != job and
+                           (-other_priority, other_enqueued) < (-priority, enqueued))
+                admitted = not leased and rank < self.max_active - active
+                if admitted:
+                    if lease and current is not None:
+                        db.execute('UPDATE held SET leased = ? WHERE job = ?', (time.time() + lease, job))
+                    else:
+                        db.execute('DELETE FROM held WHERE job = ?', (job,))
+                    active += 1
+                elif not leased:
+                    db.execute('INSERT OR REPLACE INTO held VALUES (?, ?, ?, 0)', (job, priority, enqueued))
+                db.execute('INSERT OR REPLACE INTO load VALUES (0, ?, ?)', (active, stamp))
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+        finally:
+            db.close()
+        if not admitted:
+            logger.debug('Job %s held (rank %i, %i active jobs on %s)', job, rank, active, self.url)
+        return admitted
+
+    def requeue(self, job):
+        """ Hold again a leased job whose submission failed, keeping its place in backlog """
+        db = self._connection()
+        try:
+            db.execute('UPDATE held SET leased = 0 WHERE job = ?', (job,))
+        finally:
+            db.close()
+
+    def remove(self, job):
+        """ Remove job from backlog (e.g. when cancelled) """
+        db = self._connection()
+        try:
+            db.execute('DELETE FROM held WHERE job = ?', (job,))
+        finally:
+            db.close()
+
+    def holds(self, job):
+        """ Tell whether job is held in backlog """
+        db = self._connection()
+        try:
+            return db.execute('SELECT 1 FROM held WHERE job = ?', (job,)).fetchone() is not None
+        finally:
+            db.close()
+
+    def prune(self, waiting, min_interval=0):
+        """ Remove held jobs which are no longer waiting for submission
+
+        :param waiting: callable returning, among given jobs keys, those still waiting for submission
+        :param min_interval: min time (seconds) between two prunes from this controller
+        :return: list of removed jobs keys
+        """
+        if time.time() - self._pruned < min_interval:
+            return []
+        self._pruned = time.time()
+        held = [item['job'] for item in self.backlog]
+        if not held:
+            return []
+        still_waiting = set(waiting(held))
+        gone = [job for job in held if job not in still_waiting]
+        if gone:
+            db = self._connection()
+            try:
+                db.executemany('DELETE FROM held WHERE job = ?', [(job,) for job in gone])
+            finally:
+                db.close()
+            logger.info('%i jobs no longer waiting removed from %s backlog', len(gone), self.url)
+        return gone
+
+    @property
+    def backlog(self):
+        """ Held jobs, in admission order: list of dict(job, priority, enqueued) """
+        db = self._connection()
+        try:
+            rows = db.execute('SELECT job, priority, enqueued FROM held ORDER BY priority DESC, enqueued').fetchall()
+        finally:
+            db.close()
+        return [dict(job=job, priority=priority, enqueued=enqueued) for job, priority, enqueued in rows]
+
+
+_controllers = {}
+
+
+def get_admission_controller(url):
+    """ Return admission controller for Galaxy host ``url``, None if disabled in settings """
+    config = galaxy_settings.ADMISSION
+    if not config or not config.get('max_active'):
+        return None
+    if url not in _controllers:
+        _controllers[url] = AdmissionController(url, config['max_active'], config.get('load_ttl', 10))
+    _controllers[url].max_active = config['max_active']
+    return _controllers[url]
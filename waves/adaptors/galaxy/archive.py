@@ -0,0 +1,57 @@
+""" Download of several Galaxy datasets as one archive
+
+Job outputs datasets are grouped in a temporary 'list' dataset collection (datasets are not copied), downloaded as
+a single zip stream, whose members are then extracted to their expected paths. See ``galaxy_settings.ARCHIVE_DOWNLOAD``
+for the automatic choice between archive and one download per dataset.
+"""
+from __future__ import unicode_literals
+
+import logging
+import shutil
+import zipfile
+from os.path import basename
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['use_archive', 'extract_archive']
+
+
+def use_archive(sizes, min_outputs, max_size=None):
+    """ Tell whether downloading datasets as one archive is worth it: enough datasets, total size small enough
+    for zip creation not to outweigh requests overhead
+
+    :param sizes: list of datasets sizes (bytes), None for unknown sizes
+    :param min_outputs: min number of datasets
+    :param max_size: max total size (bytes), None for no limit
+    """
+    if len(sizes) < min_outputs:
+        return False
+    return max_size is None or sum(size or 0 for size in sizes) <= max_size
+
+
+def extract_archive(archive_path, targets, chunk_size=1 << 20):
+    """ Extract archive members to their target path
+
+    Members are matched by their file name without extension, i.e. element identifier in Galaxy collection archives
+    (``<collection name>/<element identifier>.<ext>``).
+
+    :param targets: dictionary of element identifiers with their target file path
+    :return: set of extracted elements identifiers
+    """
+    extracted = set()
+    with zipfile.ZipFile(archive_path) as archive:
+        for member in archive.infolist():
+            identifier = basename(member.filename).split('.')[0]
+            if identifier not in targets or identifier in extracted:
+                continue
+            source = archive.open(member)
+            try:
+                with open(targets[identifier], 'wb') as destination:
+                    shutil.copyfileobj(source, destination, chunk_size)
+            finally:
+                source.close()
+            extracted.add(identifier)
+    missing = set(targets) - extracted
+    if missing:
+        logger.warning('Datasets missing from archive %s: %s', archive_path, ', '.join(sorted(missing)))
+    return extracted
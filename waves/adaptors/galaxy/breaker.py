@@ -0,0 +1,206 @@
+""" Circuit breaker for Galaxy endpoints
+
+After ``failures`` consecutive transient errors (connection errors, timeouts, 502/503/504 responses) on a Galaxy host,
+the circuit opens: any following request fails immediately with :class:`CircuitOpenError` instead of waiting for a
+connection timeout. Once ``reset_timeout`` is elapsed the circuit is half-open: next request first probes the host,
+closing the circuit on success, or opening it again for another period. Probe is a Galaxy version request sent with
+a dedicated bioblend instance, so that it never goes through (nor replaces) any adaptor connector.
+"""
+from __future__ import unicode_literals
+
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from bioblend import ConnectionError
+
+from waves.adaptors.galaxy.settings import galaxy_settings
+from waves.adaptors.galaxy.transport import add_request_layer
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['CircuitOpenError', 'CircuitBreaker', 'get_breaker', 'install_breaker', 'retry_idempotent']
+
+#: HTTP status codes meaning Galaxy (or its proxy) is temporarily unavailable
+TRANSIENT_STATUS = (502, 503, 504)
+
+
+class CircuitOpenError(ConnectionError):
+    """ Raised without any network call while circuit is open for a Galaxy host """
+    pass
+
+
+def is_transient(error):
+    """ Tell whether ``error`` is worth a retry (connection failure, timeout, gateway errors) """
+    import requests
+
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, ConnectionError):
+        return error.status_code is None or error.status_code in TRANSIENT_STATUS
+    return False
+
+
+class CircuitBreaker(object):
+    """ Circuit breaker for one Galaxy host url, shared by all adaptors in current process """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, url, failures=5, reset_timeout=30):
+        self.url = url
+        self.max_failures = failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.last_error = None
+        #: Callable returning True if Galaxy host is available, run when circuit is half-open
+        self.probe = self.check_host
+        self._lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.time() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    @contextmanager
+    def probing(self):
+        """ Let requests in enclosed block go through, whatever circuit state """
+        self._local.probing = True
+        try:
+            yield
+        finally:
+            self._local.probing = False
+
+    def before_request(self):
+        """ Fail fast if circuit is open, probe host if half-open
+
+        :raise: :class:`CircuitOpenError`
+        """
+        if getattr(self._local, 'probing', False):
+            return
+        state = self.state
+        if state == self.HALF_OPEN and self._probe():
+            return
+        if state != self.CLOSED:
+            raise CircuitOpenError('Galaxy %s is unavailable (circuit open, last error: %s)' % (self.url,
+                                                                                              self.last_error))
+
+    def _probe(self):
+        if not self._lock.acquire(False):
+            # Another thread is already probing
+            return False
+        try:
+            if self.state != self.HALF_OPEN:
+                return self.state == self.CLOSED
+            try:
+                with self.probing():
+                    available = self.probe is not None and self.probe()
+            except Exception as e:
+                self.last_error = '%s' % e
+                available = False
+            if available:
+                self.record_success()
+            else:
+                with self._state_lock:
+                    self.opened_at = time.time()
+                logger.warning('Galaxy %s still unavailable, circuit kept open', self.url)
+            return available
+        finally:
+            self._lock.release()
+
+    def check_host(self):
+        """ Default probe: Galaxy version request, with its own bioblend instance
+
+        :raise: :class:`requests.exceptions.RequestException` if host is not available
+        """
+        from bioblend.galaxy import GalaxyInstance
+
+        gi = GalaxyInstance(url=self.url)
+        response = gi.make_get_request('%s/version' % gi.url, params={},
+                                       timeout=galaxy_settings.CONNECT_TIMEOUT or None)
+        response.raise_for_status()
+        return True
+
+    def record_success(self):
+        with self._state_lock:
+            if self.opened_at is not None:
+                logger.info('Galaxy %s available again, circuit closed', self.url)
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self, error):
+        with self._state_lock:
+            self.failures += 1
+            self.last_error = '%s' % error
+            if self.failures >= self.max_failures or self.opened_at is not None:
+                if self.opened_at is None:
+                    logger.warning('Galaxy %s unavailable after %i failures, circuit open', self.url, self.failures)
+                self.opened_at = time.time()
+
+    def __call__(self, method, url, kwargs, send):
+        """ Request layer, see :func:`waves.adaptors.galaxy.transport.add_request_layer` """
+        self.before_request()
+        if method == 'get' and galaxy_settings.CONNECT_TIMEOUT:
+            kwargs.setdefault('timeout', (galaxy_settings.CONNECT_TIMEOUT, None))
+        try:
+            response = send()
+        except Exception as e:
+            if is_transient(e):
+                self.record_failure(e)
+            raise
+        status_code = getattr(response, 'status_code', None)
+        if status_code in TRANSIENT_STATUS:
+            self.record_failure('HTTP status %s' % status_code)
+        else:
+            self.record_success()
+        return response
+
+
+_breakers = {}
+
+
+def get_breaker(url):
+    """ Return circuit breaker for Galaxy host ``url``, shared within current process """
+    if url not in _breakers:
+        _breakers[url] = CircuitBreaker(url, **(galaxy_settings.CIRCUIT_BREAKER or {}))
+    return _breakers[url]
+
+
+def install_breaker(gi, url):
+    """ Apply circuit breaker for host ``url`` on all requests sent with bioblend ``gi`` if enabled in settings
+
+    :return: installed breaker or None
+    """
+    if not galaxy_settings.CIRCUIT_BREAKER:
+        return None
+    breaker = get_breaker(url)
+    add_request_layer(gi, breaker)
+    return breaker
+
+
+def retry_idempotent(func, *args, **kwargs):
+    """ Call ``func``, retry with jittered exponential backoff on transient errors
+
+    Only meant for idempotent calls (status, downloads...), circuit open errors are never retried.
+    """
+    retry = galaxy_settings.RETRY or {}
+    attempts = max(int(retry.get('attempts', 1)), 1)
+    for attempt in range(attempts):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt + 1 >= attempts or not is_transient(e):
+                raise
+            delay = random.uniform(0, retry.get('delay', 1) * 2 ** attempt)
+            logger.debug('Transient error %s, retry in %.2fs', e, delay)
+            time.sleep(delay)
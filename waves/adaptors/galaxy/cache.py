@@ -0,0 +1,194 @@
+""" Shared cache for Galaxy metadata (tools list, tools details)
+
+Cached values are stored in a Django cache shared by all WAVES processes: a file based cache in
+``galaxy_settings.SHARED_DIR`` by default, or the Django ``CACHES`` alias set in ``galaxy_settings.METADATA_CACHE``
+(memcached, redis, database...). Local memory caches are only shared within one process, the file based cache is
+used instead of them.
+
+Keys are namespaced per Galaxy host url and versioned: :meth:`GalaxyMetadataCache.invalidate` drops all values for a
+host at once. ``galaxy_sync`` command bumps a sync generation each time it stores a changed tools list (adaptors
+catalogs compare it to resync) and drops details of upgraded or removed tools (see
+:meth:`GalaxyMetadataCache.forget`).
+
+When a value is missing, only one process fetches it from Galaxy while the others wait for the result (a lock key is
+set with ``cache.add``), avoiding a stampede of identical requests on large tools lists.
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import logging
+import time
+from os.path import join
+
+from django.core.cache import caches
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+
+from waves.adaptors.galaxy.settings import galaxy_settings
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['GalaxyMetadataCache', 'get_metadata_cache', 'shared_cache', 'details_name', 'tool_list', 'tool_details']
+
+#: Sleep between two checks for a value being fetched by another process (seconds)
+LOCK_POLL_INTERVAL = 0.1
+#: Max entries in default file based cache, before Django culls some of them
+FILE_CACHE_MAX_ENTRIES = 100000
+
+_file_caches = {}
+
+
+def shared_cache(alias=None):
+    """ Django cache shared between processes: cache ``alias`` unless it is a local memory one, default file based
+    cache in ``galaxy_settings.SHARED_DIR`` otherwise
+    """
+    if alias is not None:
+        cache = caches[alias]
+        if not isinstance(cache, LocMemCache):
+            return cache
+    directory = join(galaxy_settings.SHARED_DIR, 'metadata')
+    if directory not in _file_caches:
+        if alias is not None:
+            logger.warning('Cache %s is local to each process, Galaxy metadata is cached in %s instead', alias,
+                           directory)
+        _file_caches[directory] = FileBasedCache(directory, dict(OPTIONS=dict(MAX_ENTRIES=FILE_CACHE_MAX_ENTRIES)))
+    return _file_caches[directory]
+
+
+class GalaxyMetadataCache(object):
+    """ Versioned cache namespace for one Galaxy host
+
+    :param url: Galaxy host url
+    :param cache: Django cache instance, defaults to the one configured in settings (see :func:`shared_cache`)
+    :param timeout: values time to live (seconds)
+    :param lock_timeout: max time (seconds) a process may hold the fetch lock for a value
+    """
+
+    def __init__(self, url, cache=None, timeout=3600, lock_timeout=120):
+        self.url = url
+        self.cache = cache or shared_cache((galaxy_settings.METADATA_CACHE or {}).get('alias'))
+        self.timeout = timeout
+        self.lock_timeout = lock_timeout
+        self._prefix = 'waves_galaxy:%s' % hashlib.md5(url.encode('utf-8')).hexdigest()
+
+    @property
+    def version(self):
+        version_key = '%s:version' % self._prefix
+        self.cache.add(version_key, 1, None)
+        return self.cache.get(version_key, 1)
+
+    def _incr(self, counter_key, start):
+        try:
+            return self.cache.incr(counter_key)
+        except ValueError:
+            self.cache.set(counter_key, start + 1, None)
+            return start + 1
+
+    def invalidate(self):
+        """ Drop all cached values for this Galaxy host """
+        self._incr('%s:version' % self._prefix, 1)
+        logger.info('Galaxy %s metadata cache invalidated', self.url)
+
+    @property
+    def generation(self):
+        """ Tools list sync generation, 0 until ``galaxy_sync`` command stored a changed tools list """
+        return self.cache.get('%s:generation' % self._prefix, 0)
+
+    def bump_generation(self):
+        """ Tell adaptors catalogs cached tools list changed """
+        return self._incr('%s:generation' % self._prefix, 0)
+
+    def _tool_generation_key(self, tool_id):
+        return '%s:generation:%s' % (self._prefix, hashlib.md5(tool_id.encode('utf-8')).hexdigest())
+
+    def tool_generation(self, tool_id):
+        """ Number of times tool details were dropped, see :meth:`forget` """
+        return self.cache.get(self._tool_generation_key(tool_id), 0)
+
+    def forget(self, tool_id):
+        """ Drop cached details of tool (upgraded in place or removed), values built from them in each process
+        (e.g. params validators) are keyed with :meth:`tool_generation`, bumped here
+        """
+        self.cache.delete_many([self.key(details_name(tool_id, io_details, link_details))
+                                for io_details in (False, True) for link_details in (False, True)])
+        self._incr(self._tool_generation_key(tool_id), 0)
+
+    def key(self, name):
+        return '%s:%s:%s' % (self._prefix, self.version, hashlib.md5(name.encode('utf-8')).hexdigest())
+
+    def set(self, name, value):
+        """ Store ``value`` for ``name``, e.g. a value fetched in background """
+        self.cache.set(self.key(name), value, self.timeout)
+
+    def get_or_fetch(self, name, fetch):
+        """ Return cached value for ``name``, calling ``fetch()`` to compute it when missing
+
+        :param name: value name, unique within this Galaxy host
+        :param fetch: callable returning value, must be picklable
+        """
+        key = self.key(name)
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+        lock_key = '%s:lock' % key
+        deadline = time.time() + self.lock_timeout
+        while not self.cache.add(lock_key, 1, self.lock_timeout):
+            # Another process is fetching this value, wait for it
+            time.sleep(LOCK_POLL_INTERVAL)
+            value = self.cache.get(key)
+            if value is not None:
+                return value
+            if time.time() > deadline:
+                logger.warning('Timeout waiting for %s from cache, fetch it', name)
+                return fetch()
+        try:
+            value = fetch()
+            self.cache.set(key, value, self.timeout)
+            return value
+        finally:
+            self.cache.delete(lock_key)
+
+
+def get_metadata_cache(url):
+    """ Return metadata cache for Galaxy host ``url``, None if disabled in settings """
+    config = galaxy_settings.METADATA_CACHE
+    if not config:
+        return None
+    return GalaxyMetadataCache(url, timeout=config.get('timeout', 3600), lock_timeout=config.get('lock_timeout', 120))
+
+
+def details_name(tool_id, io_details=False, link_details=False):
+    """ Cached tool details value name """
+    return 'tool:%s:%s:%s' % (tool_id, io_details, link_details)
+
+
+def tool_list(connector, url):
+    """ List tools available on Galaxy host, as :class:`bioblend.galaxy.objects.wrappers.Tool`
+
+    :param connector: connected :class:`bioblend.galaxy.objects.GalaxyInstance`
+    :param url: Galaxy host url
+    """
+    from bioblend.galaxy.objects.wrappers import Tool
+
+    metadata_cache = get_metadata_cache(url)
+    if metadata_cache is None:
+        return connector.tools.list()
+    tools = metadata_cache.get_or_fetch('tools', connector.gi.tools.get_tools)
+    return [Tool(tool, gi=connector) for tool in tools]
+
+
+def tool_details(connector, url, tool_id, io_details=False, link_details=False):
+    """ Get tool details from Galaxy host, as a :class:`bioblend.galaxy.objects.wrappers.Tool`
+
+    :param connector: connected :class:`bioblend.galaxy.objects.GalaxyInstance`
+    :param url: Galaxy host url
+    """
+    from bioblend.galaxy.objects.wrappers import Tool
+
+    metadata_cache = get_metadata_cache(url)
+    if metadata_cache is None:
+        return connector.tools.get(id_=tool_id, io_details=io_details, link_details=link_details)
+    details = metadata_cache.get_or_fetch(
+        details_name(tool_id, io_details, link_details),
+        lambda: connector.gi.tools.show_tool(tool_id, io_details=io_details, link_details=link_details))
+    return Tool(details, gi=connector)
@@ -0,0 +1,215 @@
+""" Record / replay of Galaxy HTTP sessions
+
+A cassette is a request layer (see :mod:`waves.adaptors.galaxy.transport`) installed underneath bioblend connector.
+In 'record' mode requests are sent to Galaxy and each response (or error) is recorded with its latency; in 'replay'
+mode no request is sent: recorded responses are returned, after waiting for their recorded latency scaled by
+``latency`` (1: original timing, 0: no wait). Cassettes are JSON files, saved with :meth:`Cassette.save`.
+
+Interactions are matched on HTTP method and url path, in recorded order: params and payloads (API key, job working
+directories, timestamps) may change between sessions, ids in paths come from replayed responses. Recorded urls and
+errors never include the API key: query strings are not recorded, key params are masked in errors messages.
+
+Each interaction is counted in current cassette section, so that tests can check API calls count and latency budget
+of adaptor lifecycle methods::
+
+    with cassette.section('prepare_job'):
+        adaptor.prepare_job(job)
+    self.assertLessEqual(cassette.stats()['prepare_job']['calls'], 5)
+"""
+from __future__ import unicode_literals
+
+import base64
+import collections
+import json
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from bioblend import ConnectionError
+from six.moves.urllib.parse import urlparse
+
+from waves.adaptors.galaxy.settings import galaxy_settings
+from waves.adaptors.galaxy.transport import add_request_layer
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['CassetteError', 'Cassette', 'get_cassette', 'install_cassette']
+
+#: API key params in urls, as sent by bioblend ('key') or in adaptors connection strings ('api_key')
+KEY_PARAM = re.compile(r'\b((?:api_)?key=)[^&\s\'"]+')
+
+
+def _mask_key(text):
+    return KEY_PARAM.sub(r'\1***', text)
+
+
+class CassetteError(Exception):
+    """ Raised in 'replay' mode for a request missing from cassette """
+    pass
+
+
+class Cassette(object):
+    """ Recorded Galaxy HTTP session
+
+    :param path: cassette file path
+    :param mode: 'record' or 'replay'
+    :param latency: replayed latency scale, 1 for recorded timing, 0 for none
+    """
+    RECORD = 'record'
+    REPLAY = 'replay'
+
+    def __init__(self, path, mode=REPLAY, latency=1):
+        if mode not in (self.RECORD, self.REPLAY):
+            raise ValueError('Invalid cassette mode: %s' % mode)
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        #: Recorded interactions: list of dict(method, path, elapsed, response)
+        self.interactions = []
+        #: Interactions sent or replayed: list of dict(method, path, elapsed, section)
+        self.calls = []
+        self._section = None
+        self._lock = threading.Lock()
+        if mode == self.REPLAY:
+            with open(path) as cassette:
+                self.interactions = json.load(cassette)['interactions']
+        self._pending = collections.defaultdict(collections.deque)
+        for interaction in self.interactions:
+            self._pending[(interaction['method'], interaction['path'])].append(interaction)
+
+    def __call__(self, method, url, kwargs, send):
+        """ Request layer, see :func:`waves.adaptors.galaxy.transport.add_request_layer` """
+        path = urlparse(url).path
+        if self.mode == self.REPLAY:
+            return self._replay(method, path)
+        return self._record(method, path, send)
+
+    def _record(self, method, path, send):
+        start = time.time()
+        try:
+            result = send()
+        except Exception as e:
+            response = self._dump_error(e)
+            if response is None:
+                raise
+            self._add(method, path, time.time() - start, response)
+            raise
+        self._add(method, path, time.time() - start, self._dump_result(result))
+        return result
+
+    def _replay(self, method, path):
+        with self._lock:
+            pending = self._pending.get((method, path))
+            if not pending:
+                raise CassetteError('No recorded %s %s left in %s' % (method.upper(), path, self.path))
+            interaction = pending.popleft()
+            self.calls.append(dict(method=method, path=path, elapsed=interaction['elapsed'], section=self._section))
+        if self.latency:
+            time.sleep(interaction['elapsed'] * self.latency)
+        return self._load(interaction['response'])
+
+    def _add(self, method, path, elapsed, response):
+        with self._lock:
+            self.interactions.append(dict(method=method, path=path, elapsed=elapsed, response=response))
+            self.calls.append(dict(method=method, path=path, elapsed=elapsed, section=self._section))
+
+    @staticmethod
+    def _dump_result(result):
+        import requests
+
+        if isinstance(result, requests.Response):
+            # Reading content also serves streamed responses to caller from memory
+            return dict(status_code=result.status_code, headers=dict(result.headers),
+                        url=result.url.split('?')[0] if result.url else result.url,
+                        content=base64.b64encode(result.content).decode('ascii'))
+        return dict(value=result)
+
+    @staticmethod
+    def _dump_error(error):
+        import requests
+
+        if isinstance(error, ConnectionError):
+            return dict(error='bioblend', message=_mask_key('%s' % error.args[0]) if error.args else '',
+                        body=error.body, status_code=error.status_code)
+        if isinstance(error, requests.exceptions.RequestException):
+            return dict(error='requests', message=_mask_key('%s' % error))
+        return None
+
+    @staticmethod
+    def _load(response):
+        import requests
+
+        if response.get('error') == 'bioblend':
+            raise ConnectionError(response['message'], body=response['body'], status_code=response['status_code'])
+        if response.get('error') == 'requests':
+            raise requests.exceptions.ConnectionError(response['message'])
+        if 'value' in response:
+            return response['value']
+        result = requests.Response()
+        result.status_code = response['status_code']
+        result.headers.update(response['headers'])
+        result.url = response['url']
+        result.encoding = requests.utils.get_encoding_from_headers(result.headers)
+        result._content = base64.b64decode(response['content'])
+        result._content_consumed = True
+        return result
+
+    @contextmanager
+    def section(self, name):
+        """ Count interactions within block in section ``name`` """
+        previous, self._section = self._section, name
+        try:
+            yield self
+        finally:
+            self._section = previous
+
+    def stats(self):
+        """ Interactions per section: dictionary of section names with dict(calls, latency) """
+        stats = collections.OrderedDict()
+        for call in self.calls:
+            section = stats.setdefault(call['section'], dict(calls=0, latency=0))
+            section['calls'] += 1
+            section['latency'] += call['elapsed']
+        return stats
+
+    @property
+    def remaining(self):
+        """ Number of recorded interactions not replayed yet """
+        return sum(len(pending) for pending in self._pending.values())
+
+    def save(self):
+        """ Write recorded interactions to cassette file """
+        with self._lock:
+            with open(self.path, 'w') as cassette:
+                json.dump(dict(interactions=self.interactions), cassette, indent=1)
+        logger.info('%i Galaxy interactions recorded in %s', len(self.interactions), self.path)
+
+
+_cassettes = {}
+
+
+def get_cassette(path, mode=Cassette.REPLAY, latency=1):
+    """ Return cassette for file ``path``, shared within current process """
+    if path not in _cassettes or _cassettes[path].mode != mode:
+        _cassettes[path] = Cassette(path, mode, latency)
+    _cassettes[path].latency = latency
+    return _cassettes[path]
+
+
+def install_cassette(gi, url):
+    """ Record or replay all requests sent with bioblend ``gi`` if a cassette is set in settings
+
+    Cassette must be installed first, underneath any other request layer.
+
+    :return: installed cassette or None
+    """
+    config = galaxy_settings.CASSETTE
+    if not config:
+        return None
+    cassette = get_cassette(config['path'], config.get('mode', Cassette.REPLAY), config.get('latency', 1))
+    add_request_layer(gi, cassette)
+    logger.info('Galaxy %s requests %s from %s', url, 'replayed' if cassette.mode == Cassette.REPLAY else 'recorded',
+                cassette.path)
+    return cassette
@@ -0,0 +1,241 @@
+""" Compact in memory catalog of Galaxy remote tools
+
+Galaxy hosts may list thousands of tools: each tool is kept as a slotted :class:`ToolRecord` (no per instance
+dictionary), repeated strings (sections, versions, names of tools installed in several versions) are shared through
+a per catalog pool, and records are grouped per panel section. One catalog serves importer choices (services
+creation form), tool lookups by id and tools search.
+
+Catalogs are built from the raw tools list shared in metadata cache (see :mod:`waves.adaptors.galaxy.cache`) and
+kept in current process. Once this cached list expired or was invalidated, catalog is synced with the new list: tools
+lists fingerprints (tools ids with version and section) are compared, only added, upgraded, moved and removed tools
+are updated, along with catalog search index.
+"""
+from __future__ import unicode_literals
+
+import logging
+import re
+import threading
+import time
+from collections import namedtuple
+
+from waves.adaptors.galaxy.cache import get_metadata_cache
+from waves.adaptors.galaxy.search import ToolIndex
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['ToolRecord', 'ToolCatalog', 'ToolsDelta', 'get_tool_catalog', 'fingerprint', 'diff_fingerprints',
+           'tool_lineage', 'version_key']
+
+#: Changes between two tools lists: ``added`` tools, ``removed`` tools, ``upgraded`` tools (new version of a tool
+#: already listed: same id with another version, or new tool shed id of a listed repository tool) and ``moved``
+#: tools (other panel section), as lists of tools ids
+ToolsDelta = namedtuple('ToolsDelta', 'added removed upgraded moved')
+
+
+def fingerprint(tools):
+    """ Tools list fingerprint: dictionary of tools ids with (version, panel section) """
+    return dict((tool['id'], (tool.get('version'), tool.get('panel_section_name'))) for tool in tools
+                if tool.get('model_class', 'Tool') == 'Tool')
+
+
+def tool_lineage(tool_id):
+    """ Tool id without version for tool shed tools (``<shed>/repos/<owner>/<repository>/<tool>/<version>``),
+    tool id otherwise
+    """
+    return tool_id.rsplit('/', 1)[0] if '/repos/' in tool_id else tool_id
+
+
+def version_key(version):
+    """ Sort key for tools versions ('1.10' > '1.9') """
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part) for part in re.split(r'[.\-+_]', version or '')]
+
+
+def diff_fingerprints(previous, current):
+    """ Compute :data:`ToolsDelta` from ``previous`` to ``current`` tools lists fingerprints """
+    lineages = set(tool_lineage(tool_id) for tool_id in previous)
+    added, upgraded, moved = [], [], []
+    for tool_id, (version, section) in current.items():
+        if tool_id not in previous:
+            (upgraded if tool_lineage(tool_id) in lineages else added).append(tool_id)
+        elif previous[tool_id][0] != version:
+            upgraded.append(tool_id)
+        elif previous[tool_id][1] != section:
+            moved.append(tool_id)
+    removed = [tool_id for tool_id in previous if tool_id not in current]
+    return ToolsDelta(sorted(added), sorted(removed), sorted(upgraded), sorted(moved))
+
+
+class ToolRecord(object):
+    """ Galaxy tool summary, ``edam_topics`` and ``edam_operations`` are tuples of EDAM terms """
+    __slots__ = ('id', 'name', 'version', 'description', 'section', 'edam_topics', 'edam_operations')
+
+    def __init__(self, id, name, version, description=None, section=None, edam_topics=(), edam_operations=()):
+        self.id = id
+        self.name = name
+        self.version = version
+        self.description = description
+        self.section = section
+        self.edam_topics = edam_topics
+        self.edam_operations = edam_operations
+
+    def __repr__(self):
+        return '<ToolRecord %s>' % self.id
+
+    @property
+    def label(self):
+        """ Label in importer choices: name, version and description """
+        return '%s %s%s' % (self.name, self.version, ' (%s)' % self.description if self.description else '')
+
+
+class ToolCatalog(object):
+    """ Galaxy tools by id, grouped by panel section
+
+    :param tools: Galaxy tools descriptions (as listed by ``GET /api/tools?in_panel=false``), only 'Tool' model
+        class items are kept (data managers...)
+    """
+
+    def __init__(self, tools=()):
+        self._strings = {}
+        self._tools = {}
+        self._sections = {}
+        self._unsorted = set()
+        self._index = None
+        for tool in tools:
+            self.add(tool)
+
+    def _shared(self, value):
+        return self._strings.setdefault(value, value) if value is not None else None
+
+    def add(self, tool):
+        """ Add (or replace) a tool from its Galaxy description
+
+        :return: added record, None if tool is not a 'Tool' model class item
+        """
+        if tool.get('model_class', 'Tool') != 'Tool':
+            return None
+        self.remove(tool['id'])
+        record = ToolRecord(tool['id'], self._shared(tool.get('name')), self._shared(tool.get('version')),
+                            self._shared(tool.get('description') or None),
+                            self._shared(tool.get('panel_section_name')),
+                            self._shared(tuple(tool.get('edam_topics') or ())),
+                            self._shared(tuple(tool.get('edam_operations') or ())))
+        self._tools[record.id] = record
+        self._sections.setdefault(record.section, []).append(record)
+        self._unsorted.add(record.section)
+        if self._index is not None:
+            self._index.add(record)
+        return record
+
+    def remove(self, tool_id):
+        """ Remove a tool, if present
+
+        :return: removed record or None
+        """
+        record = self._tools.pop(tool_id, None)
+        if record is not None:
+            section = self._sections[record.section]
+            section.remove(record)
+            if not section:
+                del self._sections[record.section]
+            if self._index is not None:
+                self._index.remove(tool_id)
+        return record
+
+    @property
+    def fingerprint(self):
+        """ Catalog tools fingerprint, see :func:`fingerprint` """
+        return dict((record.id, (record.version, record.section)) for record in self._tools.values())
+
+    def sync(self, tools):
+        """ Update catalog to ``tools`` list, only adding, replacing or removing changed tools
+
+        :return: applied :data:`ToolsDelta`
+        """
+        delta = diff_fingerprints(self.fingerprint, fingerprint(tools))
+        changed = set(delta.added + delta.upgraded + delta.moved)
+        for tool in tools:
+            if tool['id'] in changed:
+                self.add(tool)
+        for tool_id in delta.removed:
+            self.remove(tool_id)
+        return delta
+
+    def get(self, tool_id, default=None):
+        return self._tools.get(tool_id, default)
+
+    def __contains__(self, tool_id):
+        return tool_id in self._tools
+
+    def __len__(self):
+        return len(self._tools)
+
+    def __iter__(self):
+        return iter(self._tools.values())
+
+    @property
+    def sections(self):
+        """ Sorted panel sections names (None for tools outside any section) """
+        return sorted(self._sections, key=lambda section: section or '')
+
+    def section(self, name):
+        """ Tools records in section ``name``, sorted by name """
+        if name in self._unsorted:
+            self._sections[name].sort(key=lambda record: record.name)
+            self._unsorted.discard(name)
+        return self._sections.get(name, [])
+
+    @property
+    def index(self):
+        """ Search index over catalog tools (see :mod:`waves.adaptors.galaxy.search`), built on first access and
+        then updated along with catalog
+        """
+        if self._index is None:
+            self._index = ToolIndex(self._tools.values())
+            logger.debug('Search index built: %i tools', len(self._index))
+        return self._index
+
+    def search(self, query, limit=20, fuzzy=False, exclude_sections=()):
+        """ Search tools by id, name, description, section or EDAM terms, see :meth:`ToolIndex.search`
+
+        :return: list of matching records, best matches first
+        """
+        records = self.index.search(query, None if exclude_sections else limit, fuzzy)
+        records = [record for record in records if record.section not in exclude_sections]
+        return records[:limit]
+
+    def choices(self, exclude_sections=()):
+        """ Tools grouped by section, in Django choices format: list of (section, list of (tool id, label))
+
+        :param exclude_sections: sections left out (None for tools outside any section)
+        """
+        return [(name, [(record.id, record.label) for record in self.section(name)])
+                for name in self.sections if name not in exclude_sections]
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_tool_catalog(connector, url):
+    """ Return tools catalog for Galaxy host ``url``, synced with metadata cache tools list once it expired, was
+    invalidated or replaced by ``galaxy_sync`` command (only changed tools are updated, see :meth:`ToolCatalog.sync`)
+
+    :param connector: connected :class:`bioblend.galaxy.objects.GalaxyInstance`
+    """
+    metadata_cache = get_metadata_cache(url)
+    if metadata_cache is None:
+        return ToolCatalog(connector.gi.tools.get_tools())
+    version = metadata_cache.version, metadata_cache.generation
+    with _catalogs_lock:
+        catalog, synced_version, synced = _catalogs.get(url, (None, None, 0))
+        if catalog is None or synced_version != version or time.time() - synced > metadata_cache.timeout:
+            tools = metadata_cache.get_or_fetch('tools', connector.gi.tools.get_tools)
+            if catalog is None:
+                catalog = ToolCatalog(tools)
+                logger.debug('Galaxy %s tools catalog built: %i tools', url, len(catalog))
+            else:
+                delta = catalog.sync(tools)
+                logger.debug('Galaxy %s tools catalog synced: %s', url,
+                             ', '.join('%i %s' % (len(ids), name) for name, ids in zip(delta._fields, delta)))
+            _catalogs[url] = (catalog, version, time.time())
+    return catalog
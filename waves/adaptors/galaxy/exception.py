@@ -3,7 +3,7 @@ from __future__ import unicode_literals
 
 import json
 
-import bioblend
+import six
 
 from waves.wcore.adaptors.exceptions import AdaptorConnectException
 
@@ -17,21 +17,22 @@ class GalaxyAdaptorConnectionError(AdaptorConnectException):
     def __init__(self, e):
         """
         Load and parse superclass ConnectionError message body
-        :param e: The exception
+        :param e: The exception, or an error message
         """
-
-        class BaseError(Exception):
-            def __init__(self, *args, **kwargs):
-                super(BaseError, self).__init__(*args, **kwargs)
-
-        if getattr(e, 'body'):
-            error_data = json.loads(e.body)
-        elif isinstance(e, bioblend.ConnectionError):
-            error_data = dict(err_msg=e.message)
-        elif e is str:
-            try:
-                error_data = json.loads(e)
-            except ValueError:
-                error_data = dict(err_msg="%s" % e)
-        message = '{}'.format(error_data['err_msg'])
-        super(GalaxyAdaptorConnectionError, self).__init__(message)
+        self.status_code = getattr(e, 'status_code', None)
+        super(GalaxyAdaptorConnectionError, self).__init__(_error_message(e))
+
+
+def _error_message(e):
+    """ Extract error message from a Galaxy json error body, body may be missing, empty or not json at all """
+    body = getattr(e, 'body', None) if not isinstance(e, six.string_types) else e
+    if body:
+        try:
+            error_data = json.loads(body)
+            if isinstance(error_data, dict) and 'err_msg' in error_data:
+                return '{}'.format(error_data['err_msg'])
+        except (TypeError, ValueError):
+            pass
+    if isinstance(e, six.string_types):
+        return e
+    return '{}'.format(getattr(e, 'message', None) or e)
@@ -0,0 +1,130 @@
+""" Galaxy hosts health monitoring
+
+A background heartbeat thread checks Galaxy host availability every ``interval`` seconds, recording each check
+(time, latency, error) in a sqlite database in ``galaxy_settings.SHARED_DIR``, shared by all WAVES processes on this
+host, one per Galaxy host and api key (a key may be revoked while host is up): a heartbeat only checks host again
+when last recorded check, from any process, is older than ``interval``.
+Adaptors ``test_connection`` then returns last recorded status instead of making a blocking round trip. Checks are
+sent through adaptor connector, as any other request: host circuit breaker, limiter and cassette apply to them.
+"""
+from __future__ import unicode_literals
+
+import errno
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from os.path import join
+
+from waves.adaptors.galaxy.settings import galaxy_settings
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['HealthMonitor', 'get_health_monitor']
+
+
+class HealthMonitor(object):
+    """ Health status history for one Galaxy host
+
+    :param url: Galaxy host url
+    :param probe: callable checking host, returning True if available, raising an exception on errors
+    :param interval: heartbeat period (seconds)
+    :param history: number of checks kept
+    :param api_key: Galaxy api key checked by probe
+    """
+
+    def __init__(self, url, probe, interval=30, history=20, shared_dir=None, api_key=None):
+        self.url = url
+        self.probe = probe
+        self.interval = interval
+        self.history = history
+        self._thread = None
+        self._stopping = threading.Event()
+        directory = join(shared_dir or galaxy_settings.SHARED_DIR, 'health')
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        owner = url if api_key is None else '%s|%s' % (url, api_key)
+        self.db_path = join(directory, '%s.sqlite' % hashlib.md5(owner.encode('utf-8')).hexdigest())
+        with self._connection() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS health_check (checked REAL, available INTEGER, latency REAL, '
+                       'error TEXT)')
+
+    def _connection(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def measure(self):
+        """ Check host now and record result
+
+        :return: current status, see :meth:`status`
+        """
+        start = time.time()
+        try:
+            available, error = bool(self.probe()), None
+        except Exception as e:
+            available, error = False, '%s' % e
+            logger.warning('Galaxy %s health check failed: %s', self.url, error)
+        with self._connection() as db:
+            db.execute('INSERT INTO health_check VALUES (?, ?, ?, ?)', (start, available, time.time() - start, error))
+            db.execute('DELETE FROM health_check WHERE rowid NOT IN (SELECT rowid FROM health_check '
+                       'ORDER BY checked DESC LIMIT ?)', (self.history,))
+        return self.status()
+
+    def status(self, max_age=None):
+        """ Last recorded status, None if host was never checked or last check is older than ``max_age`` seconds
+
+        :return: dict(available, checked, latency, error, history, last_error) where ``history`` lists recorded
+            latencies (most recent first, None for failed checks) and ``last_error`` is dict(checked, error) for last
+            failed check, if any
+        """
+        with self._connection() as db:
+            rows = db.execute('SELECT checked, available, latency, error FROM health_check '
+                              'ORDER BY checked DESC').fetchall()
+        if not rows or (max_age is not None and time.time() - rows[0][0] > max_age):
+            return None
+        checked, available, latency, error = rows[0]
+        last_error = next((dict(checked=row[0], error=row[3]) for row in rows if row[3] is not None), None)
+        return dict(available=bool(available), checked=checked, latency=latency, error=error,
+                    history=[row[2] if row[1] else None for row in rows], last_error=last_error)
+
+    def start(self):
+        """ Start heartbeat thread in this process, if not already running """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._heartbeat, name='galaxy-health-%s' % self.url)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def _heartbeat(self):
+        while not self._stopping.is_set():
+            if self.status(max_age=self.interval) is None:
+                self.measure()
+            self._stopping.wait(self.interval)
+
+
+_monitors = {}
+_monitors_lock = threading.Lock()
+
+
+def get_health_monitor(url, api_key, probe):
+    """ Return health monitor for Galaxy host ``url`` checked with ``api_key``, None if disabled in settings
+
+    :param probe: host check, used if monitor is created, see :class:`HealthMonitor`
+    """
+    config = galaxy_settings.HEALTH
+    if not config:
+        return None
+    key = (url, hashlib.sha256(('%s' % api_key).encode('utf-8')).hexdigest())
+    with _monitors_lock:
+        if key not in _monitors:
+            _monitors[key] = HealthMonitor(url, probe, config.get('interval', 30), config.get('history', 20),
+                                           api_key=api_key)
+    return _monitors[key]
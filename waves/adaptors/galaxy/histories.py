@@ -0,0 +1,136 @@
+""" Shared Galaxy working histories
+
+By default each job runs in its own new Galaxy history. With ``galaxy_settings.HISTORY`` strategy set to 'user' or
+'service', jobs reuse a rolling history, one per WAVES user or per service tool, replaced by a new one once it
+holds ``max_datasets`` datasets or is older than ``max_age`` seconds. Current histories are recorded in a sqlite
+database in ``galaxy_settings.SHARED_DIR``, shared by all WAVES processes on this host, one database per Galaxy host
+and api key (histories belong to the Galaxy user owning the key).
+
+Each job datasets are tagged with :func:`job_tag` in shared histories, results and cleanup are managed per dataset.
+"""
+from __future__ import unicode_literals
+
+import errno
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from os.path import join
+
+from waves.adaptors.galaxy.settings import galaxy_settings
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['HistoryPool', 'get_history_pool', 'history_key', 'job_tag']
+
+
+def history_key(strategy, job, tool_id):
+    """ Shared history key for job, according to strategy """
+    if strategy == 'user':
+        return 'user:%s' % (getattr(job, 'client_id', None) or 'anonymous')
+    return 'service:%s' % tool_id
+
+
+def job_tag(job):
+    """ Tag set on job datasets in shared histories """
+    return 'waves:%s' % job.slug
+
+
+class HistoryPool(object):
+    """ Current shared histories for one Galaxy host
+
+    :param url: Galaxy host url
+    :param max_datasets: max number of datasets in a history, None for no limit
+    :param max_age: max age (seconds) of a history receiving new jobs, None for no limit
+    :param api_key: Galaxy api key histories are created with
+    """
+
+    def __init__(self, url, max_datasets=None, max_age=None, shared_dir=None, api_key=None):
+        self.url = url
+        self.max_datasets = max_datasets
+        self.max_age = max_age
+        directory = join(shared_dir or galaxy_settings.SHARED_DIR, 'histories')
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        owner = url if api_key is None else '%s|%s' % (url, api_key)
+        self.db_path = join(directory, '%s.sqlite' % hashlib.md5(owner.encode('utf-8')).hexdigest())
+        with self._connection() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS current (key TEXT PRIMARY KEY, history_id TEXT, created REAL, '
+                       'datasets INTEGER)')
+
+    def _connection(self):
+        # Autocommit mode, history reservations are serialized with explicit 'BEGIN IMMEDIATE' transactions
+        return sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+
+    def reserve(self, key, datasets, create):
+        """ Reserve room for job datasets in current history for key, starting a new history if needed
+
+        :param datasets: number of datasets job will add
+        :param create: callable creating a new Galaxy history, returning its id
+        :return: history id
+        """
+        db = self._connection()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                row = db.execute('SELECT history_id, created, datasets FROM current WHERE key = ?',
+                                 (key,)).fetchone()
+                if row is None or self._full(row[1], row[2] + datasets):
+                    history_id, created, count = create(), time.time(), 0
+                    logger.info('New shared history %s for %s on %s', history_id, key, self.url)
+                else:
+                    history_id, created, count = row
+                db.execute('INSERT OR REPLACE INTO current VALUES (?, ?, ?, ?)',
+                           (key, history_id, created, count + datasets))
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+        finally:
+            db.close()
+        return history_id
+
+    def _full(self, created, datasets):
+        return (self.max_age is not None and time.time() - created > self.max_age) or \
+               (self.max_datasets is not None and datasets > self.max_datasets)
+
+    def discard(self, key, history_id):
+        """ Stop using history for key (e.g. deleted on Galaxy), next reservation starts a new one """
+        db = self._connection()
+        try:
+            db.execute('DELETE FROM current WHERE key = ? AND history_id = ?', (key, history_id))
+        finally:
+            db.close()
+
+    @property
+    def current(self):
+        """ Current shared histories: list of dict(key, history_id, created, datasets) """
+        db = self._connection()
+        try:
+            rows = db.execute('SELECT key, history_id, created, datasets FROM current ORDER BY key').fetchall()
+        finally:
+            db.close()
+        return [dict(key=key, history_id=history_id, created=created, datasets=datasets)
+                for key, history_id, created, datasets in rows]
+
+
+_pools = {}
+
+
+def get_history_pool(url, api_key=None):
+    """ Return shared histories pool for Galaxy host ``url`` and user ``api_key``, None when jobs use their own
+    history
+    """
+    config = galaxy_settings.HISTORY or {}
+    if config.get('strategy', 'job') == 'job':
+        return None
+    key = (url, hashlib.sha256(('%s' % api_key).encode('utf-8')).hexdigest())
+    if key not in _pools:
+        _pools[key] = HistoryPool(url, api_key=api_key)
+    _pools[key].max_datasets = config.get('max_datasets')
+    _pools[key].max_age = config.get('max_age')
+    return _pools[key]
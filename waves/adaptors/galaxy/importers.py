@@ -8,18 +8,20 @@ import json
 import bioblend
 import six
 import re
+from collections import namedtuple
+
 from bioblend import ConnectionError
 from bioblend.galaxy.objects import client
+from django.db import transaction
 
+from waves.adaptors.galaxy import cache
+from waves.adaptors.galaxy.catalog import get_tool_catalog
 from waves.adaptors.galaxy.exception import GalaxyAdaptorConnectionError
 from waves.wcore.adaptors.exceptions import *
 from waves.wcore.adaptors.importer import AdaptorImporter
 from waves.wcore.models.inputs import *
 from waves.wcore.models.const import ParamType, OptType
-from waves.wcore.models import get_submission_model, SubmissionOutput, get_service_model, Runner
-
-Submission = get_submission_model()
-Service = get_service_model()
+from waves.wcore.models import SubmissionOutput, get_service_model, Runner
 
 logger = logging.getLogger(__file__)
 
@@ -28,6 +30,38 @@ def _get_input_value(tool_input, field, default=''):
     return tool_input[field] if field in tool_input and tool_input[field] != '' else default
 
 
+#: Flattened tool param: Galaxy input description, index of parent (conditional test) param with value it depends on,
+#: index of enclosing repeat
+ParamNode = namedtuple('ParamNode', 'tool_input parent when_value repeat')
+
+
+def flatten_tool_inputs(tool_inputs):
+    """ Flatten Galaxy tool inputs tree (sections, repeats and conditionals, at any depth) without recursion
+
+    :return: tuple (params, repeats): list of :data:`ParamNode` in tool form order (a conditional test param comes
+        before its dependent params), list of repeats descriptions
+    """
+    params, repeats = [], []
+    stack = [(tool_input, None, None, None) for tool_input in reversed(tool_inputs or [])]
+    while stack:
+        tool_input, parent, when_value, repeat = stack.pop()
+        input_type = tool_input.get('type')
+        if input_type == 'section':
+            children = [(child, parent, when_value, repeat) for child in tool_input.get('inputs', [])]
+        elif input_type == 'repeat':
+            repeats.append(tool_input)
+            children = [(child, parent, when_value, len(repeats) - 1) for child in tool_input.get('inputs', [])]
+        elif input_type == 'conditional':
+            params.append(ParamNode(tool_input['test_param'], parent, when_value, repeat))
+            children = [(child, len(params) - 1, case.get('value'), repeat)
+                        for case in tool_input.get('cases', []) for child in case.get('inputs', [])]
+        else:
+            params.append(ParamNode(tool_input, parent, when_value, repeat))
+            children = []
+        stack.extend(reversed(children))
+    return params, repeats
+
+
 class GalaxyToolImporter(AdaptorImporter):
     """ Allow Service to automatically import submission parameters from Galaxy bioblend API """
     #: List of tools categories which are not meaning a 'WAVES' service tool
@@ -76,15 +110,43 @@ class GalaxyToolImporter(AdaptorImporter):
         self.adaptor.connect()
         self._tool_client = self.adaptor.connector.tools
 
+    def import_service(self, tool_id, for_service=None, update_service=False):
+        """ Import remote tool within one transaction: on any failure, neither the service, nor its
+        "Imported from Galaxy" submission, nor any param is saved
+
+        :return: tuple (service, submission), (None, None) if import failed
+        """
+        try:
+            with transaction.atomic():
+                service, submission = super(GalaxyToolImporter, self).import_service(tool_id, for_service,
+                                                                                     update_service)
+                if service is None:
+                    # Base importer reports failures without raising, roll back what it already saved
+                    raise ImporterException('Import of %s failed' % tool_id)
+        except ImporterException:
+            self.service = self.submission = None
+            return None, None
+        return service, submission
+
     def load_tool_params(self, tool_id, for_submission):
-        details = self._tool_client.get(id_=tool_id, io_details=True, link_details=True)
+        details = cache.tool_details(self.adaptor.connector, self.adaptor.complete_url, tool_id, io_details=True,
+                                     link_details=True)
         self.logger.debug('Tools detailed: \n%s ' % json.dumps(details.wrapped))
-        self.logger.debug('----------- IMPORT INPUTS --------------')
-        for_submission.inputs = self.import_service_params(details.wrapped.get('inputs'))
-        self.logger.debug('----------- // INPUTS --------------')
-        self.logger.debug('----------- IMPORT OUTPUTS --------------')
-        for_submission.outputs = self.import_service_outputs(details.wrapped.get('outputs'))
-        self.logger.debug('----------- // OUTPUTS --------------')
+        # Whole submission params are imported, or none of them (see import_service transaction)
+        try:
+            self.logger.debug('----------- IMPORT INPUTS --------------')
+            inputs = self.import_service_params(details.wrapped.get('inputs'))
+            for_submission.inputs = inputs
+            self.logger.debug('----------- // INPUTS --------------')
+            self.logger.debug('----------- IMPORT OUTPUTS --------------')
+            for_submission.outputs = self.import_service_outputs(details.wrapped.get('outputs'), inputs)
+            self.logger.debug('----------- // OUTPUTS --------------')
+        except ImporterException:
+            raise
+        except Exception as e:
+            self.logger.exception(e)
+            self.error(Exception('Unexpected error, no param imported for %s (%s)' % (tool_id, e)))
+            raise ImporterException('Import of %s params failed: %s' % (tool_id, e))
         self.logger.debug('----------- IMPORT EXITCODES --------------')
         for_submission.exit_code = self.import_exit_codes([])
         self.logger.debug('----------- // EXITCODES --------------')
@@ -95,8 +157,9 @@ class GalaxyToolImporter(AdaptorImporter):
         :param tool_id:
         :return: Service
         """
+        Service = get_service_model()
         try:
-            details = self._tool_client.get(id_=tool_id, io_details=False, link_details=False)
+            details = cache.tool_details(self.adaptor.connector, self.adaptor.complete_url, tool_id)
             description = details.wrapped.get('description')
             # TODO add get retrieve existing services for updates
             service = Service(name=details.name,
@@ -120,20 +183,22 @@ class GalaxyToolImporter(AdaptorImporter):
         :return: A list of tuples corresponding to format used in Django for Choices
         """
         try:
-            tool_list = self._tool_client.list()
-            group_list = sorted(set(map(lambda x: x.wrapped['panel_section_name'], tool_list)), key=lambda z: z)
-            group_list = [x for x in group_list if x not in self._unwanted_categories]
-            service_list = [(x,
-                             sorted(
-                                 (Service(remote_service_id=y.id, name=y.name, version=y.version,
-                                          description=y.wrapped['description']) for y in tool_list if
-                                  y.wrapped['panel_section_name'] == x and y.wrapped['model_class'] == 'Tool'),
-                                 key=lambda d: d.name)
-                             ) for x in group_list]
-            return [(x[0], [
-                (y.remote_service_id, y.name + ' ' + y.version + (' (%s)' % y.description if y.description else '')) for
-                y in x[1]])
-                    for x in service_list]
+            catalog = get_tool_catalog(self.adaptor.connector, self.adaptor.complete_url)
+            return catalog.choices(exclude_sections=self._unwanted_categories)
+        except ConnectionError as e:
+            raise GalaxyAdaptorConnectionError(e)
+
+    def search_services(self, query, limit=20, fuzzy=True):
+        """
+        Search available tools on remote Galaxy server by id, name, description, section or EDAM terms, filtering with
+        ``_unwanted_categories``
+
+        :return: A list of (tool id, label) tuples, best matches first
+        """
+        try:
+            catalog = get_tool_catalog(self.adaptor.connector, self.adaptor.complete_url)
+            return [(record.id, record.label) for record in
+                    catalog.search(query, limit, fuzzy, exclude_sections=self._unwanted_categories)]
         except ConnectionError as e:
             raise GalaxyAdaptorConnectionError(e)
 
@@ -142,45 +207,57 @@ class GalaxyToolImporter(AdaptorImporter):
         return []
 
     def import_service_params(self, data):
-        inputs = []
-        self.logger.debug("%i inputs to import ", len(data))
+        """ Import tool inputs: inputs tree is flattened first, then params are created in form order
+
+        :return: list of created params
+        """
+        params, repeats = flatten_tool_inputs(data)
+        self.logger.debug("%i inputs to import ", len(params))
         self.logger.debug("-----------------------")
-        i = 1
-        for cur_input in data:
-            tool_input_type = self.map_type(cur_input.get('type'))
-            clazz = self.get_clazz(cur_input.get('type'))
-            self.logger.info("Input #%i %s %s %s", i, cur_input.get('label'), cur_input.get('name'),
-                              cur_input.get('type'))
-            self.logger.debug('Input details: \n%s ' % json.dumps(cur_input))
-            self.logger.info("%s mapped to %s (%s)", cur_input.get('type'), tool_input_type, clazz)
-            service_input = None
-            if tool_input_type == 'section':
-                service_input = self.import_service_params(cur_input.get('inputs'))
-            elif tool_input_type == 'repeat':
-                repeat_group = self._import_repeat(cur_input)
-                cur_input.repeat_group = repeat_group
-                service_input = self.import_service_params(cur_input.get('inputs'))
-                for srv_input in service_input:
-                    # print "srv_input", srv_input
-                    srv_input.repeat_group = repeat_group
-            elif tool_input_type == 'expand':
-                self.warn(UnmanagedInputTypeException("Expand"))
-            elif tool_input_type == 'conditional':
-                service_input = self._import_conditional_set(cur_input)
+        skipped = self._check_params(params)
+        repeat_groups = [self._import_repeat(repeat) for repeat in repeats]
+        created = []
+        for i, node in enumerate(params):
+            parent = created[node.parent] if node.parent is not None else None
+            if i in skipped or (node.parent is not None and parent is None):
+                created.append(None)
+                continue
+            self.logger.info("Input #%i %s %s %s", i + 1, node.tool_input.get('label'), node.tool_input.get('name'),
+                             node.tool_input.get('type'))
+            self.logger.debug('Input details: \n%s ' % json.dumps(node.tool_input))
+            created.append(self._import_param(node.tool_input, order=i + 1, parent=parent, when_value=node.when_value,
+                                              repeat_group=repeat_groups[node.repeat]
+                                              if node.repeat is not None else None))
+        return [service_input for service_input in created if service_input is not None]
+
+    def _check_params(self, params):
+        """ Validate flattened params before any database write
+
+        :return: set of indexes of params which can't be imported (warned), including params depending on them
+        """
+        skipped = set()
+        for i, node in enumerate(params):
+            tool_input = node.tool_input
+            if node.parent in skipped:
+                self.logger.warning("Param %s skipped, its conditional is not imported", tool_input.get('name'))
+            elif tool_input.get('is_dynamic', False):
+                self.warn(UnmanagedInputTypeException(
+                    'Dynamic field \'%s\':%s ' % (tool_input.get('name'), tool_input.get('label'))))
+            elif tool_input.get('type', 'text') not in self._clazz_map:
+                self.warn(UnmanagedInputTypeException(
+                    "Type:%s|Name:%s" % (tool_input.get('type', 'NA'), tool_input.get('name', 'NA'))))
             else:
-                service_input = self._import_param(cur_input)
-            if service_input is not None:
-                if type(service_input) is list:
-                    inputs.extend(service_input)
-                else:
-                    inputs.append(service_input)
-            i += 1
-        return inputs
+                continue
+            skipped.add(i)
+        return skipped
 
-    def _import_param(self, tool_input):
+    def _import_param(self, tool_input, order=None, parent=None, when_value=None, repeat_group=None):
         """
         Import a single parameter and return a AParam object (or one of its subclass)
         :param tool_input: Received input
+        :param order: param order in submission form
+        :param parent: conditional test param this param depends on, with ``when_value``
+        :param repeat_group: group of repeated params this param belongs to
         :return: AParam
         """
         try:
@@ -188,28 +265,31 @@ class GalaxyToolImporter(AdaptorImporter):
                 'Import param ' + tool_input.get('name', 'NoName') + "/" + tool_input.get('label', 'NoLabel'))
             self.logger.info(
                 'Import param ' + tool_input.get('name', 'NoName') + "/" + tool_input.get('label', 'NoLabel'))
-            if tool_input.get('is_dynamic', False):
-                raise UnmanagedInputTypeException(
-                    'Dynamic field \'%s\':%s ' % (tool_input.get('name'), tool_input.get('label')))
             if tool_input.get('hidden'):
                 required = None
             else:
                 required = not tool_input.get('optional')
             ParamClazz = self.get_clazz(tool_input.get('type', 'text'))
             self.logger.info('Creating a %s ' % ParamClazz.__name__)
-            srv_input = ParamClazz.objects.create(
+            srv_input = ParamClazz(
                 label=tool_input.get('label', tool_input.get('name', 'NoLabel')),
                 name=tool_input.get('name', 'NoName'),
                 default=tool_input.get('default', None),
                 help_text=tool_input.get('help', ''),
                 required=required,
                 submission=self.submission,
-                multiple=_get_input_value(tool_input, 'multiple') is True
+                multiple=_get_input_value(tool_input, 'multiple') is True,
+                order=order or 0,
+                parent=parent,
+                when_value=when_value,
+                repeat_group=repeat_group
             )
             # Add special type import data
             _import_func = getattr(self, '_import_' + tool_input.get('type', 'text'))
             self.logger.info('Import function %s ', _import_func.__name__)
             _import_func(tool_input, srv_input)
+            if parent is not None:
+                srv_input.default = tool_input.get('value', '')
             if 'edam' in tool_input and 'edam_formats' in tool_input['edam']:
                 srv_input.edam_formats = \
                     ','.join([edam_format for edam_format in tool_input['edam']['edam_formats'] if edam_format])
@@ -235,29 +315,6 @@ class GalaxyToolImporter(AdaptorImporter):
                                                   tool_input.get('label', 'NA'))))
             self.logger.warning("Attribute error %s", e.message)
             return None
-        except Exception as e:
-            self.logger.exception(e)
-            self.error(Exception('UnexpectedError for input "%s" (%s)' % (tool_input['name'], e)))
-            return None
-
-    def _import_conditional_set(self, tool_input):
-        self.logger.info('Import conditional set %s ' % tool_input.get('test_param'))
-        test_data = tool_input.get('test_param')
-        test_param = self._import_param(test_data)
-        self.logger.debug('Imported conditional %s', test_param)
-        for related in tool_input.get('cases', []):
-            self.logger.info('Import case ' + related.get('value'))
-            for when_input in related['inputs']:
-                when = self._import_param(when_input)
-                if when is not None:
-                    when.default = when_input.get('value', '')
-                    when.when_value = related.get('value')
-                    when.parent = test_param
-                    when.save()
-                    test_param.dependents_inputs.add(when)
-                else:
-                    self.logger.warning("Unable to import this param %s ", when_input)
-        return test_param
 
     def _import_text(self, tool_input, service_input):
         # TODO check if format needed
@@ -286,6 +343,11 @@ class GalaxyToolImporter(AdaptorImporter):
         service_input.allowed_extensions = allowed_extensions
         self.logger.debug("Multiple: %s " % service_input.multiple)
 
+    def _import_data_collection(self, tool_input, service_input):
+        # Collection files are uploaded then grouped in a Galaxy dataset collection at run time
+        self._import_data(tool_input, service_input)
+        service_input.multiple = True
+
     def _import_select(self, tool_input, service_input):
         service_input.default = _get_input_value(tool_input, 'value')
         options = []
@@ -310,8 +372,13 @@ class GalaxyToolImporter(AdaptorImporter):
     def _import_genomebuild(self, tool_input, service_input):
         return self._import_select(tool_input, service_input)
 
-    def import_service_outputs(self, outputs):
+    def import_service_outputs(self, outputs, inputs=None):
+        """ Import tool outputs
+
+        :param inputs: submission imported params, looked up for outputs named after an input value
+        """
         self.logger.debug(u'Managing service outputs')
+        inputs_by_name = dict((service_input.name, service_input) for service_input in reversed(inputs or []))
         service_outputs = []
         index = 0
         for tool_output in outputs:
@@ -335,7 +402,10 @@ class GalaxyToolImporter(AdaptorImporter):
             if m is not None:
                 input_related_name = m.group(2)
                 self.logger.info("Value is depending on other input %s", m.group(1, 2))
-                related_input = AParam.objects.filter(name=input_related_name, submission=self.submission).first()
+                if inputs is not None:
+                    related_input = inputs_by_name.get(input_related_name)
+                else:
+                    related_input = AParam.objects.filter(name=input_related_name, submission=self.submission).first()
                 if related_input:
                     self.logger.info('Found related \'%s\'', related_input)
                     service_output.from_input = related_input
@@ -348,9 +418,6 @@ class GalaxyToolImporter(AdaptorImporter):
             index += 1
         return service_outputs
 
-    def _import_section(self, section):
-        return self.import_service_params(section['inputs'])
-
 
 class GalaxyWorkFlowImporter(GalaxyToolImporter):
     """
@@ -411,7 +478,7 @@ class GalaxyWorkFlowImporter(GalaxyToolImporter):
         self.workflow = self._tool_client.get(id_=tool_id)
         self.workflow_full_description = self.workflow.export()
         # TODO refactor this to import values from workflow
-        return Service.objects.create(name='new workflow',
+        return get_service_model().objects.create(name='new workflow',
                                       version='1.0',
                                       short_description="")
 
@@ -0,0 +1,38 @@
+""" Run Galaxy jobs through pipelined scheduler, see :mod:`waves.adaptors.galaxy.pipeline` """
+from __future__ import unicode_literals
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from waves.adaptors.galaxy.pipeline import GalaxyPipeline, STAGES
+from waves.adaptors.galaxy.tool import GalaxyJobAdaptor
+from waves.wcore.adaptors.const import JobStatus
+from waves.wcore.models import Job
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Process WAVES Galaxy jobs with separate upload, readiness, submission and collection stages ' \
+           '(replaces WAVES queue daemon for these jobs)'
+
+    def add_arguments(self, parser):
+        for stage in STAGES:
+            parser.add_argument('--%s' % stage, type=int, default=None, help='%s stage workers count' % stage)
+        parser.add_argument('--interval', type=float, default=5, help='Delay (seconds) between new jobs lookups')
+
+    def handle(self, *args, **options):
+        pipeline = GalaxyPipeline(workers=dict((stage, options[stage]) for stage in STAGES if options[stage]))
+        pipeline.start()
+        try:
+            while True:
+                jobs = Job.objects.filter(_status__lte=JobStatus.JOB_COMPLETED, _status__gte=JobStatus.JOB_CREATED)
+                added = sum(1 for job in jobs if isinstance(job.adaptor, GalaxyJobAdaptor) and pipeline.submit(job))
+                if added:
+                    logger.info('%i new jobs in pipeline', added)
+                logger.debug('Pipeline queues %s', pipeline.queue_depths())
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pipeline.stop()
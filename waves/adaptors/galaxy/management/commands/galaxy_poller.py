@@ -0,0 +1,62 @@
+""" Refresh shared Galaxy jobs state table, see :mod:`waves.adaptors.galaxy.poller` """
+from __future__ import unicode_literals
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from waves.adaptors.galaxy.poller import GalaxyStatusPoller, store_key
+from waves.adaptors.galaxy.router import GalaxyRouterAdaptor
+from waves.adaptors.galaxy.settings import galaxy_settings
+from waves.adaptors.galaxy.tool import GalaxyJobAdaptor
+from waves.wcore.adaptors.const import JobStatus
+from waves.wcore.models import Job
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Poll Galaxy hosts of current WAVES jobs, keeping shared jobs state table up to date'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shard', type=int, default=0, help='Shard handled by this poller (from 0)')
+        parser.add_argument('--shards', type=int, default=1,
+                            help='Total number of pollers per Galaxy host, sharded pollers ask for each of their jobs')
+        parser.add_argument('--interval', type=float, default=None, help='Refresh period in seconds')
+        parser.add_argument('--once', action='store_true', default=False, help='Refresh once and exit')
+
+    def handle(self, *args, **options):
+        if not 0 <= options['shard'] < options['shards']:
+            raise CommandError('Shard must be in [0, %i[' % options['shards'])
+        interval = options['interval'] or (galaxy_settings.STATUS_POLLER or {}).get('interval', 5)
+        pollers = {}
+        while True:
+            start = time.time()
+            for key, adaptor in self.active_hosts().items():
+                url = adaptor.complete_url
+                try:
+                    if key not in pollers:
+                        pollers[key] = GalaxyStatusPoller(adaptor.connect().gi, url, options['shard'],
+                                                          options['shards'], api_key=adaptor.app_key)
+                    pollers[key].refresh()
+                except Exception as e:
+                    logger.error('Galaxy %s status refresh failed: %s', url, e)
+            if options['once']:
+                return
+            time.sleep(max(interval - (time.time() - start), 0))
+
+    @staticmethod
+    def active_hosts():
+        """ Galaxy adaptors, by host url and hashed api key (Galaxy only lists jobs of api key user, see
+        :func:`waves.adaptors.galaxy.poller.store_key`), for all queued or running WAVES jobs
+        """
+        hosts = {}
+        for job in Job.objects.filter(_status__in=(JobStatus.JOB_QUEUED, JobStatus.JOB_RUNNING)):
+            adaptor = job.adaptor
+            if isinstance(adaptor, GalaxyRouterAdaptor):
+                adaptor = adaptor.endpoint_adaptor(adaptor.job_endpoint(job))
+            elif not isinstance(adaptor, GalaxyJobAdaptor):
+                continue
+            hosts.setdefault(store_key(adaptor.complete_url, adaptor.app_key), adaptor)
+        return hosts
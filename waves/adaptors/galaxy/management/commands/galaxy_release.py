@@ -0,0 +1,43 @@
+""" Submit Galaxy jobs held in local admission backlog, see :mod:`waves.adaptors.galaxy.admission` """
+from __future__ import unicode_literals
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from waves.adaptors.galaxy.tool import GalaxyJobAdaptor
+from waves.wcore.adaptors.const import JobStatus
+from waves.wcore.models import Job
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Submit WAVES jobs held in Galaxy admission backlogs as soon as Galaxy has room for them ' \
+           '(not needed along galaxy_pipeline command, which releases them too)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=10, help='Delay (seconds) between two releases')
+        parser.add_argument('--once', action='store_true', default=False, help='Release once and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            released = 0
+            for job in Job.objects.filter(Q(remote_job_id__isnull=True) | Q(remote_job_id=''),
+                                          _status=JobStatus.JOB_QUEUED):
+                adaptor = job.adaptor
+                if not isinstance(adaptor, GalaxyJobAdaptor):
+                    continue
+                try:
+                    if adaptor.release_held(job):
+                        job.save()
+                        released += 1
+                except Exception as e:
+                    logger.error('Job %s not released from backlog: %s', job.slug, e)
+            if released:
+                logger.info('%i jobs released from backlog', released)
+            if options['once']:
+                return
+            time.sleep(options['interval'])
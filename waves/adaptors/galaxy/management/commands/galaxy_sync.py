@@ -0,0 +1,72 @@
+""" Sync Galaxy hosts tools catalogs, see :mod:`waves.adaptors.galaxy.sync` """
+from __future__ import unicode_literals
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from waves.adaptors.galaxy.cache import get_metadata_cache
+from waves.adaptors.galaxy.catalog import fingerprint
+from waves.adaptors.galaxy.router import GalaxyRouterAdaptor
+from waves.adaptors.galaxy.settings import galaxy_settings
+from waves.adaptors.galaxy.sync import CatalogSync
+from waves.adaptors.galaxy.tool import GalaxyJobAdaptor
+from waves.adaptors.galaxy.workflow import GalaxyWorkFlowAdaptor
+from waves.wcore.models import get_service_model
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Sync tools catalogs of Galaxy hosts used by WAVES services, recording services whose remote tool changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=None, help='Sync period in seconds')
+        parser.add_argument('--once', action='store_true', default=False, help='Sync once and exit')
+
+    def handle(self, *args, **options):
+        interval = options['interval'] or (galaxy_settings.CATALOG_SYNC or {}).get('interval', 300)
+        syncs = {}
+        while True:
+            start = time.time()
+            for url, (adaptor, services) in self.galaxy_services().items():
+                try:
+                    if url not in syncs:
+                        syncs[url] = CatalogSync(url)
+                    self.sync(syncs[url], adaptor, services)
+                except Exception as e:
+                    logger.error('Galaxy %s tools sync failed: %s', url, e)
+            if options['once']:
+                return
+            time.sleep(max(interval - (time.time() - start), 0))
+
+    @staticmethod
+    def sync(catalog_sync, adaptor, services):
+        tools = adaptor.connect().gi.tools.get_tools()
+        current = fingerprint(tools)
+        delta = catalog_sync.update(current)
+        metadata_cache = get_metadata_cache(catalog_sync.url)
+        if metadata_cache is not None:
+            # Adaptors catalogs sync with this fresh list instead of fetching it again
+            metadata_cache.set('tools', tools)
+            for tool_id in delta.upgraded + delta.removed:
+                metadata_cache.forget(tool_id)
+            if any(delta):
+                metadata_cache.bump_generation()
+        drifted = catalog_sync.check_services(services, current)
+        logger.debug('Galaxy %s synced: %i tools, %i services, %i drifted', catalog_sync.url, len(current),
+                     len(services), len(drifted))
+
+    @staticmethod
+    def galaxy_services():
+        """ Galaxy adaptors and services imported from their tools, by host url """
+        hosts = {}
+        for service in get_service_model().objects.exclude(remote_service_id=None):
+            adaptor = service.adaptor
+            if isinstance(adaptor, GalaxyRouterAdaptor):
+                for url, _ in adaptor.endpoint_list:
+                    hosts.setdefault(url, (adaptor.endpoint_adaptor(url), []))[1].append(service)
+            elif isinstance(adaptor, GalaxyJobAdaptor) and not isinstance(adaptor, GalaxyWorkFlowAdaptor):
+                hosts.setdefault(adaptor.complete_url, (adaptor, []))[1].append(service)
+        return hosts
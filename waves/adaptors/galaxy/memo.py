@@ -0,0 +1,154 @@
+""" Galaxy jobs results memoisation
+
+Jobs running the same tool version, with the same inputs content and the same parameters values as a previous
+successful job reuse its Galaxy outputs instead of running tool again: new job is bound to previous remote job
+and its outputs datasets, which are then downloaded in job working dir as usual.
+
+Results are stored in a sqlite database in ``galaxy_settings.SHARED_DIR``, shared by all WAVES processes on this
+host, one per Galaxy host and API key: previous results are only reused by the Galaxy user who can access them.
+Entries are dropped when older than retention period, when remote datasets are no longer available, and when a new
+version of their tool is stored.
+"""
+from __future__ import unicode_literals
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from os.path import isfile, join
+
+from waves.adaptors.galaxy.settings import galaxy_settings
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['ResultCache', 'get_result_cache', 'memo_key', 'file_hash', 'load_job_memo', 'save_job_memo']
+
+#: Json file name storing memoisation key and hit for a job, in job working dir
+MEMO_FILE = 'job_memo.json'
+
+
+def file_hash(file_path, block_size=1 << 20):
+    """ sha256 hex digest of file content """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def memo_key(tool_id, tool_version, input_hashes, params):
+    """ Memoisation key for a tool run
+
+    :param input_hashes: list of (input name, file content hash)
+    :param params: dictionary of params names with their values
+    """
+    normalised = dict(tool=tool_id, version=tool_version,
+                      inputs=sorted(input_hashes),
+                      params=sorted((name, '%s' % value) for name, value in params.items()))
+    return hashlib.sha256(json.dumps(normalised, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_job_memo(job):
+    """ Memoisation data recorded for job (key, and previous result on a hit), empty dict if none """
+    file_path = join(job.working_dir, MEMO_FILE)
+    if isfile(file_path):
+        with open(file_path) as fp:
+            return json.load(fp)
+    return {}
+
+
+def save_job_memo(job, memo):
+    with open(join(job.working_dir, MEMO_FILE), 'w') as fp:
+        json.dump(memo, fp)
+
+
+class ResultCache(object):
+    """ Successful Galaxy jobs results, by memoisation key, for one Galaxy host and user
+
+    :param url: Galaxy host url
+    :param retention: max age (seconds) of reused results, None to keep them forever
+    :param api_key: Galaxy api key results jobs were run with
+    """
+
+    def __init__(self, url, retention=None, shared_dir=None, api_key=None):
+        self.url = url
+        self.retention = retention
+        directory = join(shared_dir or galaxy_settings.SHARED_DIR, 'memo')
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        owner = url if api_key is None else '%s|%s' % (url, api_key)
+        self.db_path = join(directory, '%s.sqlite' % hashlib.md5(owner.encode('utf-8')).hexdigest())
+        with self._connection() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS result (key TEXT PRIMARY KEY, tool_id TEXT, tool_version TEXT, '
+                       'remote_job_id TEXT, history_id TEXT, outputs TEXT, created REAL, hits INTEGER, '
+                       'last_hit REAL)')
+
+    def _connection(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def get(self, key):
+        """ Previous result for key, counting a hit, None if missing or expired
+
+        :return: dict(remote_job_id, history_id, outputs) where outputs maps outputs api names to datasets ids
+        """
+        with self._connection() as db:
+            row = db.execute('SELECT remote_job_id, history_id, outputs, created FROM result WHERE key = ?',
+                             (key,)).fetchone()
+            if row is None:
+                return None
+            if self.retention is not None and time.time() - row[3] > self.retention:
+                db.execute('DELETE FROM result WHERE key = ?', (key,))
+                return None
+            db.execute('UPDATE result SET hits = hits + 1, last_hit = ? WHERE key = ?', (time.time(), key))
+        return dict(remote_job_id=row[0], history_id=row[1], outputs=json.loads(row[2]))
+
+    def store(self, key, tool_id, tool_version, remote_job_id, history_id, outputs):
+        """ Record a successful job result, dropping results from other versions of the same tool """
+        with self._connection() as db:
+            db.execute('DELETE FROM result WHERE tool_id = ? AND tool_version != ?', (tool_id, tool_version))
+            db.execute('INSERT OR REPLACE INTO result VALUES (?, ?, ?, ?, ?, ?, ?, 0, NULL)',
+                       (key, tool_id, tool_version, remote_job_id, history_id, json.dumps(outputs), time.time()))
+
+    def invalidate(self, key=None, tool_id=None):
+        """ Drop one result, all results for a tool, or everything """
+        with self._connection() as db:
+            if key is not None:
+                db.execute('DELETE FROM result WHERE key = ?', (key,))
+            elif tool_id is not None:
+                db.execute('DELETE FROM result WHERE tool_id = ?', (tool_id,))
+            else:
+                db.execute('DELETE FROM result')
+
+    def purge(self):
+        """ Drop results older than retention period """
+        if self.retention is not None:
+            with self._connection() as db:
+                db.execute('DELETE FROM result WHERE created < ?', (time.time() - self.retention,))
+
+    @property
+    def stats(self):
+        """ Number of stored results and total hits, per tool id """
+        with self._connection() as db:
+            rows = db.execute('SELECT tool_id, COUNT(*), SUM(hits) FROM result GROUP BY tool_id').fetchall()
+        return dict((tool_id, dict(results=count, hits=hits or 0)) for tool_id, count, hits in rows)
+
+
+_caches = {}
+
+
+def get_result_cache(url, api_key=None):
+    """ Return results cache for Galaxy host ``url`` and user ``api_key``, None if disabled in settings """
+    config = galaxy_settings.MEMO
+    if not config:
+        return None
+    key = (url, hashlib.sha256(('%s' % api_key).encode('utf-8')).hexdigest())
+    if key not in _caches:
+        _caches[key] = ResultCache(url, api_key=api_key)
+    _caches[key].retention = config.get('retention')
+    return _caches[key]
@@ -0,0 +1,304 @@
+""" Pipelined scheduler for Galaxy jobs
+
+Jobs go through four stages, each one with its own queue and worker threads pool:
+
+- ``upload``: create job history and upload its inputs files, without waiting for uploads completion (usual WAVES
+  ``run_prepare``, within :func:`waves.adaptors.galaxy.tool.deferred_readiness`)
+- ``readiness``: check once whether uploads are complete, job is re-queued after ``poll_interval`` if not
+- ``submission``: run Galaxy tool (usual WAVES ``run_launch``)
+- ``collection``: check job status (usual WAVES ``run_status``), retrieving results once completed, job is
+  re-queued after ``poll_interval`` while not finished. Jobs held in admission backlog are submitted here once
+  admitted (see :mod:`waves.adaptors.galaxy.admission`)
+
+A slow upload thus never blocks submission or results retrieval for other jobs, and no worker waits idle for a
+history to be ready. With ``FAST_SUBMIT`` setting, readiness checks pass right away. Readiness wait start is recorded
+in job phase timings, so that a restarted pipeline resumes waiting where it stopped.
+
+Jobs are claimed by a pipeline before processing, in a sqlite database in ``galaxy_settings.SHARED_DIR``: claims
+expire unless renewed by their owner (every third of ``claim_ttl``), several pipelines may thus run on this host
+without processing the same jobs, and jobs of a stopped pipeline are taken over by the others. See
+``galaxy_pipeline`` management command to run it in place of WAVES queue daemon for Galaxy jobs.
+"""
+from __future__ import unicode_literals
+
+import errno
+import heapq
+import itertools
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from os.path import join
+
+from six.moves import queue
+
+from waves.adaptors.galaxy.exception import GalaxyAdaptorConnectionError
+from waves.adaptors.galaxy.settings import galaxy_settings
+from waves.adaptors.galaxy.timing import JobPhaseTimer
+from waves.adaptors.galaxy.tool import deferred_readiness
+from waves.wcore.adaptors.const import JobStatus
+from waves.wcore.adaptors.exceptions import AdaptorException
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['GalaxyPipeline', 'JobClaims', 'STAGES', 'READINESS_MARK']
+
+STAGES = ('upload', 'readiness', 'submission', 'collection')
+
+#: Job phase timings mark set when job starts waiting for its inputs uploads
+READINESS_MARK = 'readiness_wait'
+
+
+class JobClaims(object):
+    """ Jobs claimed by pipelines on this host
+
+    :param ttl: claims lifetime (seconds) unless renewed by their owner
+    """
+
+    def __init__(self, ttl=60, shared_dir=None):
+        self.ttl = ttl
+        directory = join(shared_dir or galaxy_settings.SHARED_DIR, 'pipeline')
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.db_path = join(directory, 'claims.sqlite')
+        with self._connection() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS claim (job TEXT PRIMARY KEY, owner TEXT, expires REAL)')
+
+    def _connection(self):
+        # Autocommit mode, claims are serialized with explicit 'BEGIN IMMEDIATE' transactions
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def claim(self, job, owner):
+        """ Claim job for owner, unless another owner holds an unexpired claim on it
+
+        :return: True if job is claimed by owner
+        """
+        db = self._connection()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                row = db.execute('SELECT owner, expires FROM claim WHERE job = ?', (job,)).fetchone()
+                claimed = row is None or row[0] == owner or row[1] < time.time()
+                if claimed:
+                    db.execute('INSERT OR REPLACE INTO claim VALUES (?, ?, ?)', (job, owner, time.time() + self.ttl))
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+        finally:
+            db.close()
+        return claimed
+
+    def renew(self, owner):
+        """ Extend all owner claims """
+        db = self._connection()
+        try:
+            db.execute('UPDATE claim SET expires = ? WHERE owner = ?', (time.time() + self.ttl, owner))
+        finally:
+            db.close()
+
+    def release(self, owner, job=None):
+        """ Drop owner claim on job, or all owner claims """
+        db = self._connection()
+        try:
+            if job is None:
+                db.execute('DELETE FROM claim WHERE owner = ?', (owner,))
+            else:
+                db.execute('DELETE FROM claim WHERE job = ? AND owner = ?', (job, owner))
+        finally:
+            db.close()
+
+
+class GalaxyPipeline(object):
+    """ Run Galaxy jobs through upload, readiness, submission and collection stages concurrently
+
+    :param workers: dictionary of worker threads count per stage, defaults to ``galaxy_settings.PIPELINE``
+    :param poll_interval: delay (seconds) before checking again a job not ready / not finished
+    :param readiness_timeout: max time (seconds) waiting for a job inputs upload
+    :param claims: :class:`JobClaims` shared with other pipelines, defaults to ``claim_ttl`` setting ones
+    """
+
+    def __init__(self, workers=None, poll_interval=None, readiness_timeout=None, claims=None):
+        config = galaxy_settings.PIPELINE or {}
+        self.workers = dict((stage, int((workers or {}).get(stage, config.get(stage, 1)))) for stage in STAGES)
+        self.poll_interval = poll_interval or config.get('poll_interval', 5)
+        self.readiness_timeout = readiness_timeout or config.get('readiness_timeout', 360)
+        self.claims = claims or JobClaims(config.get('claim_ttl', 60))
+        #: Claims owner name
+        self.owner = '%s:%i:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self._queues = dict((stage, queue.Queue()) for stage in STAGES)
+        self._delayed = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._active = dict((stage, 0) for stage in STAGES)
+        self._in_pipeline = set()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """ Start stages worker threads """
+        for stage in STAGES:
+            for index in range(self.workers[stage]):
+                self._start_thread('%s-%i' % (stage, index), self._work, stage)
+        self._start_thread('delayed', self._release_delayed)
+
+    def _start_thread(self, name, target, *args):
+        thread = threading.Thread(target=target, args=args, name='galaxy-pipeline-%s' % name)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """ Stop workers once their current task is done, release claimed jobs """
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self.claims.release(self.owner)
+
+    def submit(self, job):
+        """ Claim job and add it in pipeline, at the stage matching its status
+
+        :return: False if job is already in pipeline, claimed by another pipeline or has nothing left to do
+        """
+        if job.status == JobStatus.JOB_CREATED:
+            stage = 'upload'
+        elif job.status == JobStatus.JOB_PREPARED:
+            # Inputs uploads may still be in progress
+            stage = 'readiness'
+        elif JobStatus.JOB_QUEUED <= job.status <= JobStatus.JOB_COMPLETED:
+            stage = 'collection'
+        else:
+            return False
+        with self._lock:
+            if job.slug in self._in_pipeline:
+                return False
+            self._in_pipeline.add(job.slug)
+        if not self.claims.claim('%s' % job.slug, self.owner):
+            with self._lock:
+                self._in_pipeline.discard(job.slug)
+            return False
+        self._queues[stage].put(job)
+        return True
+
+    def queue_depths(self):
+        """ Per stage jobs count: 'queued' (waiting for a worker), 'delayed' (waiting for next check) and
+        'active' (being processed)
+        """
+        with self._lock:
+            delayed = [item[2] for item in self._delayed]
+            active = dict(self._active)
+        return dict((stage, dict(queued=self._queues[stage].qsize(), delayed=delayed.count(stage),
+                                 active=active[stage])) for stage in STAGES)
+
+    def _later(self, stage, job):
+        with self._lock:
+            heapq.heappush(self._delayed, (time.time() + self.poll_interval, next(self._counter), stage, job))
+
+    def _done(self, job):
+        with self._lock:
+            self._in_pipeline.discard(job.slug)
+        self.claims.release(self.owner, '%s' % job.slug)
+
+    def _release_delayed(self):
+        renewed = time.time()
+        while not self._stopping.is_set():
+            if time.time() - renewed > self.claims.ttl / 3.:
+                self.claims.renew(self.owner)
+                renewed = time.time()
+            with self._lock:
+                due = []
+                while self._delayed and self._delayed[0][0] <= time.time():
+                    due.append(heapq.heappop(self._delayed))
+            for _, _, stage, job in due:
+                self._queues[stage].put(job)
+            time.sleep(0.2)
+
+    def _work(self, stage):
+        from django.db import close_old_connections
+
+        while not self._stopping.is_set():
+            try:
+                job = self._queues[stage].get(timeout=1)
+            except queue.Empty:
+                continue
+            with self._lock:
+                self._active[stage] += 1
+            try:
+                next_stage = getattr(self, '_%s' % stage)(job)
+            except Exception as e:
+                logger.exception('Unexpected error in %s stage for job %s: %s', stage, job.slug, e)
+                job.fatal_error(e)
+                job.save()
+                next_stage = None
+            finally:
+                with self._lock:
+                    self._active[stage] -= 1
+                close_old_connections()
+            if next_stage is None:
+                self._done(job)
+            elif next_stage == stage:
+                self._later(stage, job)
+            else:
+                self._queues[next_stage].put(job)
+
+    def _upload(self, job):
+        with deferred_readiness():
+            job.run_prepare()
+        # Job run actions save job before setting their final status, whatever their outcome
+        job.refresh_from_db()
+        if job.status == JobStatus.JOB_CREATED:
+            # Retry recorded by run_prepare
+            return 'upload'
+        if job.status != JobStatus.JOB_PREPARED:
+            return None
+        JobPhaseTimer(job).mark(READINESS_MARK, replace=True)
+        return 'readiness'
+
+    def _readiness(self, job):
+        timer = JobPhaseTimer(job)
+        # Job prepared before pipeline start: start waiting now
+        timer.mark(READINESS_MARK)
+        started = timer.data['marks'][READINESS_MARK]
+        try:
+            ready = job.adaptor.inputs_ready(job)
+        except GalaxyAdaptorConnectionError as e:
+            job.retry(e.message)
+            job.save()
+            return 'readiness' if job.status == JobStatus.JOB_PREPARED else None
+        except AdaptorException as e:
+            job.error(e.message)
+            job.save()
+            return None
+        if ready:
+            timer.record('readiness', time.time() - started)
+            return 'submission'
+        if time.time() - started > self.readiness_timeout:
+            job.retry('Maximum time reached to prepare job')
+            job.save()
+            timer.mark(READINESS_MARK, replace=True)
+            return 'readiness' if job.status == JobStatus.JOB_PREPARED else None
+        return 'readiness'
+
+    def _submission(self, job):
+        job.run_launch()
+        job.refresh_from_db()
+        if job.status == JobStatus.JOB_QUEUED:
+            return 'collection'
+        return 'submission' if job.status == JobStatus.JOB_PREPARED else None
+
+    def _collection(self, job):
+        if not job.remote_job_id:
+            # Held in admission backlog
+            try:
+                if job.adaptor.release_held(job):
+                    job.save()
+            except AdaptorException as e:
+                logger.warning('Job %s not released from backlog: %s', job.slug, e)
+        job.run_status()
+        return 'collection' if job.status <= JobStatus.JOB_COMPLETED else None
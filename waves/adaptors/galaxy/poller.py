@@ -0,0 +1,206 @@
+""" Centralised status polling for Galaxy jobs
+
+One poller process per Galaxy host (see ``galaxy_poller`` management command) keeps a state table of remote jobs
+up to date with incremental list queries on ``/api/jobs``, only asking for jobs updated since last refresh. Galaxy
+only lists jobs of the user owning the API key, there is one table per Galaxy host and API key.
+Adaptors then read remote jobs states from this table (:meth:`JobStateStore.get`) instead of querying Galaxy for
+each job, falling back to network when the table is missing or stale.
+
+State table is a sqlite database in ``galaxy_settings.SHARED_DIR``, shared by all WAVES processes on this host.
+A single poller lists each host with one request per page of updated jobs. For very large job counts, several pollers
+may share the load instead: each shard then skips the list query and only asks Galaxy for the active jobs whose remote
+id hash falls in its shard. Jobs enter the table when an adaptor first falls back to network for their status.
+"""
+from __future__ import unicode_literals
+
+import errno
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from os.path import join
+
+from bioblend import ConnectionError
+
+from waves.adaptors.galaxy.settings import galaxy_settings
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['JobStateStore', 'GalaxyStatusPoller', 'get_store', 'store_key', 'shard_of']
+
+#: Remote states after which Galaxy job does not change anymore
+FINAL_STATES = ('ok', 'error', 'deleted')
+
+
+def shard_of(remote_job_id, shards):
+    """ Shard number handling ``remote_job_id`` among ``shards`` pollers """
+    return zlib.crc32(remote_job_id.encode('utf-8')) % shards if shards > 1 else 0
+
+
+class JobStateStore(object):
+    """ Shared table of Galaxy jobs states for one Galaxy host and user
+
+    :param url: Galaxy host url
+    :param api_key: Galaxy api key jobs are listed with
+    """
+
+    def __init__(self, url, shared_dir=None, api_key=None):
+        self.url = url
+        directory = join(shared_dir or galaxy_settings.SHARED_DIR, 'states')
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        owner = url if api_key is None else '%s|%s' % (url, api_key)
+        self.db_path = join(directory, '%s.sqlite' % hashlib.md5(owner.encode('utf-8')).hexdigest())
+        with self._connection() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS job_state (remote_job_id TEXT PRIMARY KEY, state TEXT, '
+                       'update_time TEXT, refreshed REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS sync (shard INTEGER PRIMARY KEY, update_time TEXT, '
+                       'refreshed REAL)')
+
+    def _connection(self):
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    def get(self, remote_job_id, max_age=None):
+        """ Stored state for remote job, None if unknown or not refreshed for more than ``max_age`` seconds """
+        with self._connection() as db:
+            row = db.execute('SELECT state, refreshed FROM job_state WHERE remote_job_id = ?',
+                             (remote_job_id,)).fetchone()
+        if row is None:
+            return None
+        state, refreshed = row
+        if max_age is not None and state not in FINAL_STATES and time.time() - refreshed > max_age:
+            return None
+        return state
+
+    def update(self, remote_jobs):
+        """ Store states from Galaxy jobs list items (dictionaries with 'id', 'state' and 'update_time') """
+        now = time.time()
+        with self._connection() as db:
+            db.executemany('INSERT OR REPLACE INTO job_state VALUES (?, ?, ?, ?)',
+                           [(remote_job['id'], remote_job['state'], remote_job.get('update_time'), now)
+                            for remote_job in remote_jobs])
+
+    def touch(self, shard=0, shards=1):
+        """ Mark all active jobs of shard as refreshed now: nothing changed for them since last refresh, as long as
+        they were all listed with the store API key
+        """
+        with self._connection() as db:
+            db.executemany('UPDATE job_state SET refreshed = ? WHERE remote_job_id = ?',
+                           [(time.time(), remote_job_id) for remote_job_id in self.active(shard, shards)])
+
+    def active(self, shard=0, shards=1):
+        """ Remote ids of jobs in shard not in a final state """
+        with self._connection() as db:
+            rows = db.execute('SELECT remote_job_id FROM job_state WHERE state NOT IN (%s)' %
+                              ','.join('?' * len(FINAL_STATES)), FINAL_STATES).fetchall()
+        return [row[0] for row in rows if shard_of(row[0], shards) == shard]
+
+    def last_sync(self, shard=0):
+        """ Most recent remote ``update_time`` seen by shard, None if never synced """
+        with self._connection() as db:
+            row = db.execute('SELECT update_time FROM sync WHERE shard = ?', (shard,)).fetchone()
+        return row[0] if row else None
+
+    def set_last_sync(self, update_time, shard=0):
+        with self._connection() as db:
+            db.execute('INSERT OR REPLACE INTO sync VALUES (?, ?, ?)', (shard, update_time, time.time()))
+
+    def purge(self, older_than):
+        """ Remove jobs in a final state not refreshed for ``older_than`` seconds """
+        with self._connection() as db:
+            db.execute('DELETE FROM job_state WHERE refreshed < ? AND state IN (%s)' %
+                       ','.join('?' * len(FINAL_STATES)), (time.time() - older_than,) + FINAL_STATES)
+
+
+_stores = {}
+
+
+def store_key(url, api_key):
+    """ Key of state store for Galaxy host ``url`` and user ``api_key`` (hashed) """
+    return url, hashlib.sha256(('%s' % api_key).encode('utf-8')).hexdigest()
+
+
+def get_store(url, api_key=None):
+    """ Return state store for Galaxy host ``url`` and user ``api_key``, shared within current process """
+    key = store_key(url, api_key)
+    if key not in _stores:
+        _stores[key] = JobStateStore(url, api_key=api_key)
+    return _stores[key]
+
+
+class GalaxyStatusPoller(object):
+    """ Refresh state table for one Galaxy host and user
+
+    :param gi: connected bioblend :class:`bioblend.galaxy.GalaxyInstance`
+    :param url: Galaxy host url
+    :param shard: shard handled by this poller, in [0, shards[
+    :param shards: total number of pollers sharing this host
+    :param api_key: Galaxy api key ``gi`` is connected with
+    """
+    #: Max jobs asked per list request
+    page_size = 500
+
+    def __init__(self, gi, url, shard=0, shards=1, store=None, api_key=None):
+        self.gi = gi
+        self.url = url
+        self.shard = shard
+        self.shards = max(shards, 1)
+        self.store = store or get_store(url, api_key)
+
+    def _list_jobs(self, since):
+        """ Jobs updated since remote time ``since`` (all jobs if None), paginated for recent Galaxy versions """
+        remote_jobs, seen = [], set()
+        offset = 0
+        while True:
+            params = dict(limit=self.page_size, offset=offset, order_by='update_time')
+            if since:
+                params['date_range_min'] = since
+            page = self.gi.jobs._get(params=params)
+            # Older Galaxy versions ignore limit / offset and return all jobs at once
+            new = [remote_job for remote_job in page if remote_job['id'] not in seen]
+            seen.update(remote_job['id'] for remote_job in new)
+            remote_jobs.extend(new)
+            if len(page) < self.page_size or not new:
+                return remote_jobs
+            offset += len(page)
+
+    def refresh(self):
+        """ Fetch jobs updated since last refresh, or only active jobs belonging to this shard when sharded
+
+        :return: number of jobs states updated
+        """
+        if self.shards > 1:
+            return self._refresh_shard()
+        since = self.store.last_sync()
+        remote_jobs = self._list_jobs(since)
+        self.store.touch()
+        self.store.update(remote_jobs)
+        update_times = [remote_job['update_time'] for remote_job in remote_jobs if remote_job.get('update_time')]
+        if update_times:
+            # Remote time is used to avoid any clock skew between hosts, jobs updated on this exact time are
+            # listed again next time
+            self.store.set_last_sync(max(update_times))
+        logger.debug('Galaxy %s: %i jobs states updated', self.url, len(remote_jobs))
+        return len(remote_jobs)
+
+    def _refresh_shard(self):
+        """ Ask Galaxy for each active job of this shard, one request per job """
+        remote_jobs = []
+        for remote_job_id in self.store.active(self.shard, self.shards):
+            try:
+                remote_job = self.gi.jobs.show_job(remote_job_id)
+            except ConnectionError as e:
+                logger.warning('Galaxy %s job %s state not refreshed: %s', self.url, remote_job_id, e)
+                continue
+            remote_jobs.append(dict(id=remote_job_id, state=remote_job['state'],
+                                    update_time=remote_job.get('update_time')))
+        self.store.update(remote_jobs)
+        logger.debug('Galaxy %s shard %i: %i jobs states updated', self.url, self.shard, len(remote_jobs))
+        return len(remote_jobs)
@@ -0,0 +1,163 @@
+""" Host wide limiter for Galaxy API traffic
+
+Limits are shared between all WAVES processes running on the same machine through files in
+``galaxy_settings.SHARED_DIR``:
+
+- requests in flight are capped with a pool of slot files, each one held with an exclusive ``flock`` during a
+  request (locks are released by the system if a process dies)
+- requests rate is limited by a token bucket whose state is stored in a json file, updated under ``flock``
+
+Each traffic category ('upload', 'submit', 'poll', 'default') has its own budget.
+"""
+from __future__ import unicode_literals
+
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from os.path import join
+
+from waves.adaptors.galaxy.settings import galaxy_settings
+from waves.adaptors.galaxy.transport import add_request_layer, classify_request
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['GalaxyRateLimiter', 'get_limiter', 'install_limiter']
+
+#: Sleep between two attempts to get a free request slot (seconds)
+SLOT_POLL_INTERVAL = 0.05
+
+
+class GalaxyRateLimiter(object):
+    """
+    Limit concurrency and rate of requests sent to one Galaxy host, for all processes on this machine
+
+    :param url: Galaxy host url, used to share limits between processes
+    :param limits: dictionary {category: dict(in_flight=int, rate=float)}, merged with default settings
+    """
+
+    def __init__(self, url, limits=None, shared_dir=None):
+        self.url = url
+        self.limits = dict(galaxy_settings.RATE_LIMITS or {})
+        self.limits.update(limits or {})
+        self.shared_dir = join(shared_dir or galaxy_settings.SHARED_DIR, 'limits',
+                               hashlib.md5(url.encode('utf-8')).hexdigest())
+        self._stats = {}
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(self.shared_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _budget(self, category):
+        return self.limits.get(category) or self.limits.get('default')
+
+    @contextmanager
+    def limit(self, category):
+        """ Wait for a free request slot and a rate token in ``category``, hold slot during enclosed block """
+        budget = self._budget(category)
+        if not budget:
+            yield 0
+            return
+        start = time.time()
+        slot = self._acquire_slot(category, int(budget.get('in_flight', 0)))
+        try:
+            self._take_token(category, float(budget.get('rate', 0)))
+            waited = time.time() - start
+            self._record(category, waited)
+            yield waited
+        finally:
+            if slot is not None:
+                fcntl.flock(slot, fcntl.LOCK_UN)
+                os.close(slot)
+
+    def _acquire_slot(self, category, in_flight):
+        if in_flight <= 0:
+            return None
+        while True:
+            for index in range(in_flight):
+                fd = os.open(join(self.shared_dir, '%s.slot.%i' % (category, index)), os.O_CREAT | os.O_RDWR)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except IOError as e:
+                    os.close(fd)
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+            time.sleep(SLOT_POLL_INTERVAL)
+
+    def _take_token(self, category, rate):
+        if rate <= 0:
+            return
+        capacity = max(rate, 1)
+        with open(join(self.shared_dir, '%s.bucket' % category), 'a+') as fp:
+            while True:
+                fcntl.flock(fp, fcntl.LOCK_EX)
+                try:
+                    fp.seek(0)
+                    try:
+                        bucket = json.loads(fp.read())
+                    except ValueError:
+                        bucket = dict(tokens=capacity, stamp=time.time())
+                    now = time.time()
+                    tokens = min(capacity, bucket['tokens'] + (now - bucket['stamp']) * rate)
+                    taken = tokens >= 1
+                    if taken:
+                        tokens -= 1
+                    fp.seek(0)
+                    fp.truncate()
+                    fp.write(json.dumps(dict(tokens=tokens, stamp=now)))
+                    fp.flush()
+                finally:
+                    fcntl.flock(fp, fcntl.LOCK_UN)
+                if taken:
+                    return
+                time.sleep((1 - tokens) / rate)
+
+    def _record(self, category, waited):
+        with self._lock:
+            stats = self._stats.setdefault(category, dict(requests=0, waited=0.0, max_wait=0.0))
+            stats['requests'] += 1
+            stats['waited'] += waited
+            stats['max_wait'] = max(stats['max_wait'], waited)
+        if waited > 1:
+            logger.debug('Waited %.2fs for a %s request slot on %s', waited, category, self.url)
+
+    @property
+    def stats(self):
+        """ Requests count, total and max wait time (seconds) for each category, for current process """
+        with self._lock:
+            return dict((category, dict(stats)) for category, stats in self._stats.items())
+
+    def __call__(self, method, url, kwargs, send):
+        """ Request layer, see :func:`waves.adaptors.galaxy.transport.add_request_layer` """
+        with self.limit(classify_request(method, url, kwargs.get('files_attached', False))):
+            return send()
+
+
+_limiters = {}
+
+
+def get_limiter(url):
+    """ Return limiter for Galaxy host ``url``, shared within current process """
+    if url not in _limiters:
+        _limiters[url] = GalaxyRateLimiter(url)
+    return _limiters[url]
+
+
+def install_limiter(gi, url):
+    """ Apply host limiter on all requests sent with bioblend ``gi`` if limits are enabled in settings
+
+    :return: installed limiter or None
+    """
+    if not galaxy_settings.RATE_LIMITS:
+        return None
+    limiter = get_limiter(url)
+    add_request_layer(gi, limiter)
+    return limiter
@@ -0,0 +1,191 @@
+""" Load balanced Galaxy adaptor, dispatching jobs over several Galaxy instances sharing the same tools """
+from __future__ import unicode_literals
+
+import json
+import logging
+from collections import OrderedDict
+from os.path import isfile, join
+
+from six.moves.urllib.parse import urlparse
+
+from waves.adaptors.galaxy.tool import GalaxyJobAdaptor
+from waves.wcore.adaptors.exceptions import AdaptorConnectException
+
+logger = logging.getLogger(__name__)
+
+__group__ = 'Galaxy'
+__all__ = ['GalaxyRouterAdaptor']
+
+#: Json file name storing the Galaxy endpoint chosen for a job, in job working dir
+ENDPOINT_FILE = 'job_galaxy_endpoint.json'
+#: Remote states counted as load on an endpoint, with their weight
+LOAD_STATES = dict(new=1, queued=1, running=1)
+
+
+class GalaxyRouterAdaptor(GalaxyJobAdaptor):
+    """
+    Send each new job to the least loaded healthy Galaxy endpoint, load is the number of current remote user's
+    jobs waiting or running on each one. Chosen endpoint is stored in job working dir, so that all following
+    calls for this job (status, results, details...) go to the same Galaxy instance.
+
+    **Init parameters:**
+        Same as :class:`waves.adaptors.galaxy.tool.GalaxyJobAdaptor`, plus:
+
+        :param endpoints: other Galaxy instances urls, one per line (or comma separated), each one may be
+            followed by its own api key: ``https://galaxy2.example.org|api_key``. Current host is always the first
+            endpoint.
+    """
+    name = 'Galaxy load balanced tool adaptor (api_key)'
+    endpoints = ''
+
+    def __init__(self, command=None, protocol='http', host="localhost", port='', api_base_path='', api_endpoint='',
+                 app_key=None, library_dir="", endpoints='', **kwargs):
+        super(GalaxyRouterAdaptor, self).__init__(command, protocol, host, port, api_base_path, api_endpoint,
+                                                  app_key, library_dir, **kwargs)
+        self.endpoints = endpoints
+        self._adaptors = {}
+
+    @property
+    def init_params(self):
+        base_params = super(GalaxyRouterAdaptor, self).init_params
+        base_params.update(dict(endpoints=self.endpoints))
+        return base_params
+
+    @property
+    def endpoint_list(self):
+        """ List of (url, api_key) for all Galaxy endpoints, current host first """
+        endpoints = [(self.complete_url, self.app_key)]
+        for endpoint in (self.endpoints or '').replace(',', '\n').splitlines():
+            if endpoint.strip():
+                url, _, api_key = endpoint.strip().partition('|')
+                endpoints.append((url.strip().rstrip('/'), api_key.strip() or self.app_key))
+        return endpoints
+
+    def endpoint_adaptor(self, url):
+        """ Return a :class:`GalaxyJobAdaptor` for endpoint ``url`` """
+        if url not in self._adaptors:
+            api_key = dict(self.endpoint_list).get(url, self.app_key)
+            parsed = urlparse(url)
+            self._adaptors[url] = GalaxyJobAdaptor(command=self.command,
+                                                   protocol=parsed.scheme or 'http',
+                                                   host=parsed.hostname,
+                                                   port=str(parsed.port or ''),
+                                                   api_base_path=parsed.path.strip('/'),
+                                                   app_key=api_key,
+                                                   library_dir=self.library_dir)
+        adaptor = self._adaptors[url]
+        adaptor.command = self.command
+        return adaptor
+
+    def endpoint_load(self, url):
+        """ Number of current user's jobs waiting or running on endpoint
+
+        :return: load, or None if endpoint is not reachable
+        """
+        try:
+            gi = self.endpoint_adaptor(url).connect().gi
+            remote_jobs = gi.jobs._get(params=dict(state=list(LOAD_STATES.keys())))
+            return sum(LOAD_STATES.get(remote_job.get('state'), 0) for remote_job in remote_jobs)
+        except Exception as e:
+            logger.warning('Galaxy endpoint %s is unavailable: %s', url, e)
+            return None
+
+    def choose_endpoint(self):
+        """ Return least loaded healthy endpoint url
+
+        :raise: :class:`waves.wcore.adaptors.exceptions.AdaptorConnectException` if none is available
+        """
+        loads = [(load, index, url) for index, (url, load) in
+                 enumerate((url, self.endpoint_load(url)) for url, _ in self.endpoint_list) if load is not None]
+        if not loads:
+            raise AdaptorConnectException('No Galaxy endpoint available')
+        logger.debug('Galaxy endpoints load %s', loads)
+        return min(loads)[2]
+
+    def job_endpoint(self, job):
+        """ Galaxy endpoint url recorded for job, defaults to current host """
+        file_path = join(job.working_dir, ENDPOINT_FILE)
+        if isfile(file_path):
+            with open(file_path) as fp:
+                return json.load(fp)['url']
+        return self.complete_url
+
+    def _record_endpoint(self, job, url):
+        with open(join(job.working_dir, ENDPOINT_FILE), 'w') as fp:
+            json.dump(dict(url=url), fp)
+        job.logger.info('Job routed to Galaxy %s', url)
+
+    def _job_adaptor(self, job):
+        adaptor = self.endpoint_adaptor(self.job_endpoint(job))
+        adaptor.connect()
+        return adaptor
+
+    def _connect(self):
+        """ Connect to first available endpoint, used for tools import and connection test """
+        for url, _ in self.endpoint_list:
+            try:
+                adaptor = self.endpoint_adaptor(url)
+                self.connector = adaptor.connect()
+                self.cassette = adaptor.cassette
+                self.limiter = adaptor.limiter
+                self.breaker = adaptor.breaker
+                return
+            except AdaptorConnectException as e:
+                logger.warning('Galaxy endpoint %s is unavailable: %s', url, e)
+        raise AdaptorConnectException('No Galaxy endpoint available')
+
+    def _prepare_job(self, job):
+        url = self.choose_endpoint()
+        self._record_endpoint(job, url)
+        return self._job_adaptor(job)._prepare_job(job)
+
+    def _start_prepare(self, job, timer):
+        url = self.choose_endpoint()
+        self._record_endpoint(job, url)
+        return self._job_adaptor(job)._start_prepare(job, timer)
+
+    def run_jobs_batch(self, jobs):
+        """ Send each batch of jobs to the least loaded endpoint, chosen and recorded once for all its jobs: batch is
+        prepared, checked and submitted by this endpoint adaptor (see
+        :meth:`waves.adaptors.galaxy.tool.GalaxyJobAdaptor.run_jobs_batch`)
+        """
+        groups = OrderedDict()
+        for job in jobs:
+            groups.setdefault(self._batch_key(job), []).append(job)
+        batched = []
+        for group in groups.values():
+            url = self.choose_endpoint()
+            for job in group:
+                self._record_endpoint(job, url)
+            batched.extend(self.endpoint_adaptor(url).run_jobs_batch(group))
+        return batched
+
+    def _inputs_ready(self, job):
+        return self._job_adaptor(job)._inputs_ready(job)
+
+    def _run_job(self, job):
+        return self._job_adaptor(job)._run_job(job)
+
+    def _cancel_job(self, job):
+        return self._job_adaptor(job)._cancel_job(job)
+
+    def release_held(self, job):
+        return self._job_adaptor(job).release_held(job)
+
+    def cancel_jobs(self, jobs, purge=None):
+        by_endpoint = {}
+        for job in jobs:
+            by_endpoint.setdefault(self.job_endpoint(job), []).append(job)
+        failed = []
+        for url, endpoint_jobs in by_endpoint.items():
+            failed.extend(self.endpoint_adaptor(url).cancel_jobs(endpoint_jobs, purge))
+        return failed
+
+    def _job_status(self, job):
+        return self._job_adaptor(job)._job_status(job)
+
+    def _job_results(self, job):
+        return self._job_adaptor(job)._job_results(job)
+
+    def _job_run_details(self, job):
+        return self._job_adaptor(job)._job_run_details(job)
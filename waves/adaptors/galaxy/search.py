@@ -0,0 +1,153 @@
+""" Search index over Galaxy tools catalog
+
+Tools are indexed on their id, name, description, panel section and EDAM topics / operations: each field text is
+split in lowercase alphanumeric tokens, each token lists the tools it appears in with the weight of its best field.
+Tokens are kept sorted for prefix queries (bisection), fuzzy queries also match tokens differing by a typo (one wrong,
+missing, extra or swapped character) through a lazily built map of tokens with one character removed.
+
+A query matches tools containing all its tokens, ranked by the sum of matched tokens weights. Index is updated
+record per record along with its :class:`waves.adaptors.galaxy.catalog.ToolCatalog`.
+"""
+from __future__ import unicode_literals
+
+import bisect
+import heapq
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['ToolIndex', 'tokenize']
+
+#: Weights of indexed fields, a tool matching a token in its name ranks first
+FIELD_WEIGHTS = (('name', 8), ('id', 4), ('section', 4), ('edam_topics', 2), ('edam_operations', 2),
+                 ('description', 1))
+#: Weight factors of prefix and fuzzy matches (exact token matches: 1)
+PREFIX_FACTOR = 0.75
+FUZZY_FACTOR = 0.5
+#: Shortest query token matched fuzzily
+FUZZY_MIN_LENGTH = 4
+
+_token_re = re.compile(r'[^\W_]+', re.UNICODE)
+
+
+def tokenize(text):
+    """ Lowercase alphanumeric tokens in text """
+    return _token_re.findall(text.lower()) if text else []
+
+
+def _deletions(token):
+    return set([token] + [token[:i] + token[i + 1:] for i in range(len(token))])
+
+
+class ToolIndex(object):
+    """ Inverted index over tools records
+
+    :param records: :class:`waves.adaptors.galaxy.catalog.ToolRecord` list
+    """
+
+    def __init__(self, records=()):
+        #: Tools per token: dictionary of tool ids with token weight
+        self._postings = {}
+        self._tokens = []
+        self._records = {}
+        self._variants = None
+        for record in records:
+            self.add(record)
+
+    def __len__(self):
+        return len(self._records)
+
+    @staticmethod
+    def _record_tokens(record):
+        weights = {}
+        for field, weight in FIELD_WEIGHTS:
+            value = getattr(record, field)
+            for token in tokenize(' '.join(value) if isinstance(value, tuple) else value):
+                weights[token] = max(weight, weights.get(token, 0))
+        return weights
+
+    def add(self, record):
+        """ Index tool record, replacing previous one with same id """
+        self.remove(record.id)
+        self._records[record.id] = record
+        for token, weight in self._record_tokens(record).items():
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = {}
+                bisect.insort(self._tokens, token)
+                if self._variants is not None:
+                    for variant in _deletions(token):
+                        self._variants.setdefault(variant, set()).add(token)
+            postings[record.id] = weight
+
+    def remove(self, tool_id):
+        """ Remove tool from index, if present """
+        record = self._records.pop(tool_id, None)
+        if record is None:
+            return
+        for token in self._record_tokens(record):
+            postings = self._postings[token]
+            postings.pop(tool_id, None)
+            if not postings:
+                del self._postings[token]
+                del self._tokens[bisect.bisect_left(self._tokens, token)]
+                if self._variants is not None:
+                    for variant in _deletions(token):
+                        self._variants[variant].discard(token)
+                        if not self._variants[variant]:
+                            del self._variants[variant]
+
+    def _prefixed(self, prefix):
+        for i in range(bisect.bisect_left(self._tokens, prefix), len(self._tokens)):
+            if not self._tokens[i].startswith(prefix):
+                break
+            yield self._tokens[i]
+
+    def _similar(self, token):
+        if self._variants is None:
+            self._variants = {}
+            for indexed in self._tokens:
+                for variant in _deletions(indexed):
+                    self._variants.setdefault(variant, set()).add(indexed)
+        similar = set()
+        for variant in _deletions(token):
+            similar.update(self._variants.get(variant, ()))
+        return similar
+
+    def _matches(self, query_token, fuzzy):
+        """ Tools matching one query token: dictionary of tool ids with their score """
+        scores = {}
+        candidates = [(token, PREFIX_FACTOR if token != query_token else 1) for token in self._prefixed(query_token)]
+        if fuzzy and len(query_token) >= FUZZY_MIN_LENGTH:
+            candidates.extend((token, FUZZY_FACTOR) for token in self._similar(query_token))
+        for token, factor in candidates:
+            for tool_id, weight in self._postings[token].items():
+                scores[tool_id] = max(weight * factor, scores.get(tool_id, 0))
+        return scores
+
+    def search(self, query, limit=20, fuzzy=False):
+        """ Search tools matching all query tokens, as prefixes (or with a typo if ``fuzzy``)
+
+        :param query: free text query
+        :param limit: max number of results, None for all
+        :return: list of matching records, best matches first
+        """
+        scores = None
+        for query_token in set(tokenize(query)):
+            matches = self._matches(query_token, fuzzy)
+            if scores is None:
+                scores = matches
+            else:
+                scores = dict((tool_id, score + matches[tool_id]) for tool_id, score in scores.items()
+                              if tool_id in matches)
+            if not scores:
+                return []
+        if scores is None:
+            return []
+
+        def rank(tool_id):
+            return -scores[tool_id], self._records[tool_id].name or ''
+
+        ranked = sorted(scores, key=rank) if limit is None else heapq.nsmallest(limit, scores, key=rank)
+        return [self._records[tool_id] for tool_id in ranked]
@@ -0,0 +1,101 @@
+"""
+WAVES Galaxy adaptor settings
+These settings may be overridden in your Django main configuration file with a ``WAVES_GALAXY`` dictionary
+"""
+from __future__ import unicode_literals
+
+import tempfile
+from os.path import join
+
+from django.conf import settings
+
+__all__ = ['DEFAULTS', 'galaxy_settings']
+
+DEFAULTS = {
+    #: Directory for files shared between WAVES processes on this host (locks, token buckets...)
+    'SHARED_DIR': join(tempfile.gettempdir(), 'waves_galaxy'),
+    #: Per Galaxy host request budgets: max requests in flight and requests per second for each traffic category,
+    #: set to None to disable limiter
+    'RATE_LIMITS': {
+        'upload': dict(in_flight=4, rate=2),
+        'submit': dict(in_flight=4, rate=5),
+        'poll': dict(in_flight=16, rate=20),
+        'default': dict(in_flight=8, rate=10),
+    },
+    #: Connection timeout (seconds) for Galaxy GET requests
+    'CONNECT_TIMEOUT': 10,
+    #: Per Galaxy host circuit breaker: consecutive failures before opening, delay (seconds) before probing again,
+    #: set to None to disable breaker
+    'CIRCUIT_BREAKER': dict(failures=5, reset_timeout=30),
+    #: Retries for idempotent calls (status, downloads...), first retry delay (seconds) is randomized up to
+    #: ``delay``, doubled for each following attempt
+    'RETRY': dict(attempts=3, delay=1),
+    #: Shared jobs state table refreshed by ``galaxy_poller`` command, e.g. dict(interval=5, max_age=30): states
+    #: refreshed more than ``max_age`` seconds ago are fetched from Galaxy, ``interval`` is poller refresh period
+    #: (seconds). None (default) to always query Galaxy for jobs states, set it only when the command is running
+    'STATUS_POLLER': None,
+    #: Tools list and details cache: Django cache alias (None for a file based cache in SHARED_DIR, which also replaces
+    #: local memory caches), values time to live and max time spent fetching a value by one process (seconds), set to
+    #: None to disable
+    'METADATA_CACHE': dict(alias=None, timeout=3600, lock_timeout=120),
+    #: Jobs cancellation: purge cancelled jobs datasets, max time (seconds) waiting for Galaxy to confirm jobs
+    #: are stopped
+    'CANCEL': dict(purge=False, confirm_timeout=30),
+    #: Admission control: hold jobs locally while Galaxy has ``max_active`` jobs queued or running for adaptor's
+    #: user, ``load_ttl`` is max age (seconds) of active jobs count, ``priority`` dotted path to a function
+    #: returning job priority (higher first). Held jobs are submitted by ``galaxy_pipeline`` or ``galaxy_release``
+    #: management commands. Set to None to submit jobs immediately. e.g:
+    #: ``dict(max_active=500, load_ttl=10, priority='waves.adaptors.galaxy.admission.default_priority')``
+    'ADMISSION': None,
+    #: Results memoisation: jobs identical to a previous successful one (same tool version, inputs content and
+    #: params) reuse its outputs, ``retention`` is max age (seconds) of reused results (None: no limit),
+    #: ``use_cached_job`` also asks Galaxy (>= 19.05) to reuse equivalent jobs. Set to None to disable. e.g:
+    #: ``dict(retention=30 * 86400, use_cached_job=False)``
+    'MEMO': None,
+    #: Pipelined scheduler (``galaxy_pipeline`` command): worker threads per stage, delay (seconds) between two
+    #: checks of a job not ready / not finished, max time (seconds) waiting for inputs upload, lifetime (seconds) of
+    #: jobs claims not renewed by their pipeline
+    'PIPELINE': dict(upload=4, readiness=2, submission=2, collection=4, poll_interval=5, readiness_timeout=360,
+                     claim_ttl=60),
+    #: Submit tool runs as soon as inputs uploads are started, without waiting for them to complete. Galaxy then
+    #: pauses jobs whose inputs upload failed, which are reported as errors
+    'FAST_SUBMIT': False,
+    #: Galaxy histories for jobs: ``strategy`` 'job' creates a new history per job, 'user' / 'service' reuse a rolling
+    #: history per WAVES user / per service tool, replaced once it holds ``max_datasets`` datasets or is older than
+    #: ``max_age`` seconds (None: no limit)
+    'HISTORY': dict(strategy='job', max_datasets=1000, max_age=86400),
+    #: Download job outputs as a single archive when job has at least ``min_outputs`` outputs, totalling at most
+    #: ``max_size`` bytes (None: no limit), one download per output otherwise. Set to None to disable. e.g:
+    #: ``dict(min_outputs=10, max_size=100 * 1024 * 1024)``
+    'ARCHIVE_DOWNLOAD': None,
+    #: Galaxy hosts heartbeat: host checked every ``interval`` seconds, ``test_connection`` returns last check result
+    #: when not older than ``max_age`` seconds, ``history`` checks are kept. None (default) to check on each call,
+    #: e.g: ``dict(interval=30, max_age=90, history=20)``
+    'HEALTH': None,
+    #: Validate jobs params against Galaxy tool inputs description before creating their history (needs tool details
+    #: from Galaxy, see METADATA_CACHE)
+    'VALIDATE': False,
+    #: Record / replay Galaxy HTTP sessions (tests): requests sent to Galaxy and their responses are recorded in
+    #: ``path`` cassette file in 'record' ``mode``, replayed without any Galaxy host in 'replay' mode, waiting for
+    #: recorded latencies scaled by ``latency`` (0: no wait). Set to None to disable. e.g:
+    #: ``dict(path='tests/cassettes/mafft.json', mode='replay', latency=0)``
+    'CASSETTE': None,
+    #: Tools catalogs delta sync (``galaxy_sync`` command): period (seconds) between two syncs of each Galaxy host
+    'CATALOG_SYNC': dict(interval=300),
+    #: Request only needed fields in jobs preparation, submission and status checks: history and datasets states
+    #: (``keys`` parameter) instead of their full descriptions, job outputs from tool run response instead of job
+    #: full details
+    'MINIMAL_PAYLOADS': True,
+}
+
+
+class GalaxySettings(object):
+    """ Read settings from Django ``WAVES_GALAXY`` dictionary on each access, falling back to ``DEFAULTS`` """
+
+    def __getattr__(self, attr):
+        if attr not in DEFAULTS:
+            raise AttributeError("Invalid WAVES Galaxy setting: '%s'" % attr)
+        return getattr(settings, 'WAVES_GALAXY', {}).get(attr, DEFAULTS[attr])
+
+
+galaxy_settings = GalaxySettings()
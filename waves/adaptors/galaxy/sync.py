@@ -0,0 +1,153 @@
+""" Delta sync of Galaxy tools catalogs
+
+``galaxy_sync`` management command lists each Galaxy host tools every few minutes (a single request), then compares
+this list fingerprint (tools ids with version and section) with the previous one, recorded in a sqlite database in
+``galaxy_settings.SHARED_DIR``: only changes are written. Fresh list is shared through metadata cache, adaptors
+catalogs then only update changed tools (see :mod:`waves.adaptors.galaxy.catalog`).
+
+WAVES services imported from this host are checked against current list: services whose remote tool was removed,
+changed version in place, or has a newer version installed are recorded as drifted, see :attr:`CatalogSync.drifted`.
+"""
+from __future__ import unicode_literals
+
+import errno
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from os.path import join
+
+from waves.adaptors.galaxy.catalog import diff_fingerprints, tool_lineage, version_key
+from waves.adaptors.galaxy.settings import galaxy_settings
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['CatalogSync', 'service_drift', 'DRIFT_REMOVED', 'DRIFT_VERSION', 'DRIFT_UPGRADED']
+
+#: Service remote tool is no longer listed
+DRIFT_REMOVED = 'removed'
+#: Service remote tool version changed (same tool id)
+DRIFT_VERSION = 'version'
+#: A newer version of service remote tool is installed
+DRIFT_UPGRADED = 'upgraded'
+
+
+def latest_versions(current):
+    """ Latest version per tool lineage (see :func:`waves.adaptors.galaxy.catalog.tool_lineage`)
+
+    :param current: tools fingerprint
+    """
+    latest = {}
+    for tool_id, (version, _) in current.items():
+        lineage = tool_lineage(tool_id)
+        if lineage not in latest or version_key(version) > version_key(latest[lineage]):
+            latest[lineage] = version
+    return latest
+
+
+def service_drift(remote_service_id, service_version, current, latest=None):
+    """ Check service imported from tool ``remote_service_id`` against current tools list
+
+    :param current: tools fingerprint
+    :param latest: latest versions per lineage, computed from ``current`` if not set
+    :return: tuple (drift reason, remote version), None if service is up to date
+    """
+    if remote_service_id not in current:
+        return DRIFT_REMOVED, None
+    version = current[remote_service_id][0]
+    # Services versions are at most 10 characters long
+    if service_version and version and service_version != version[:10]:
+        return DRIFT_VERSION, version
+    newest = (latest if latest is not None else latest_versions(current)).get(tool_lineage(remote_service_id))
+    if newest is not None and version_key(newest) > version_key(version):
+        return DRIFT_UPGRADED, newest
+    return None
+
+
+class CatalogSync(object):
+    """ Recorded tools list fingerprint and drifted services for one Galaxy host
+
+    :param url: Galaxy host url
+    """
+
+    def __init__(self, url, shared_dir=None):
+        self.url = url
+        directory = join(shared_dir or galaxy_settings.SHARED_DIR, 'catalog')
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.db_path = join(directory, '%s.sqlite' % hashlib.md5(url.encode('utf-8')).hexdigest())
+        with self._connection() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS tool (id TEXT PRIMARY KEY, version TEXT, section TEXT)')
+            db.execute('CREATE TABLE IF NOT EXISTS drift (service_id INTEGER PRIMARY KEY, remote_service_id TEXT, '
+                       'service_version TEXT, remote_version TEXT, reason TEXT, detected REAL)')
+
+    def _connection(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    @property
+    def previous(self):
+        """ Last recorded tools fingerprint """
+        with self._connection() as db:
+            return dict((tool_id, (version, section))
+                        for tool_id, version, section in db.execute('SELECT id, version, section FROM tool'))
+
+    def update(self, current):
+        """ Record ``current`` tools fingerprint, only writing changes
+
+        :return: :data:`waves.adaptors.galaxy.catalog.ToolsDelta` from previous fingerprint
+        """
+        delta = diff_fingerprints(self.previous, current)
+        with self._connection() as db:
+            db.executemany('DELETE FROM tool WHERE id = ?', [(tool_id,) for tool_id in delta.removed])
+            db.executemany('INSERT OR REPLACE INTO tool VALUES (?, ?, ?)',
+                           [(tool_id,) + tuple(current[tool_id]) for tool_id in
+                            delta.added + delta.upgraded + delta.moved])
+        if any(delta):
+            logger.info('Galaxy %s tools: %s', self.url,
+                        ', '.join('%i %s' % (len(ids), name) for name, ids in zip(delta._fields, delta)))
+        return delta
+
+    def check_services(self, services, current):
+        """ Record drifted services among ``services``, forgetting previous drifts of up to date (or deleted) ones
+
+        :param services: all WAVES services imported from this Galaxy host
+        :param current: tools fingerprint
+        :return: list of drifted services, as dict(service_id, remote_service_id, service_version, remote_version,
+            reason, detected)
+        """
+        latest = latest_versions(current)
+        drifted = []
+        with self._connection() as db:
+            checked = set(service.pk for service in services)
+            db.executemany('DELETE FROM drift WHERE service_id = ?',
+                           [row for row in db.execute('SELECT service_id FROM drift') if row[0] not in checked])
+            for service in services:
+                drift = service_drift(service.remote_service_id, service.version, current, latest)
+                if drift is None:
+                    db.execute('DELETE FROM drift WHERE service_id = ?', (service.pk,))
+                    continue
+                row = db.execute('SELECT reason, remote_version, detected FROM drift WHERE service_id = ?',
+                                 (service.pk,)).fetchone()
+                detected = row[2] if row is not None and tuple(row[:2]) == drift else time.time()
+                if row is None or detected != row[2]:
+                    logger.warning('Service %s drifted from Galaxy %s tool %s: %s %s', service, self.url,
+                                   service.remote_service_id, drift[0], drift[1] or '')
+                db.execute('INSERT OR REPLACE INTO drift VALUES (?, ?, ?, ?, ?, ?)',
+                           (service.pk, service.remote_service_id, service.version, drift[1], drift[0], detected))
+                drifted.append(dict(service_id=service.pk, remote_service_id=service.remote_service_id,
+                                    service_version=service.version, remote_version=drift[1], reason=drift[0],
+                                    detected=detected))
+        return drifted
+
+    @property
+    def drifted(self):
+        """ Recorded drifted services, see :meth:`check_services` """
+        with self._connection() as db:
+            rows = db.execute('SELECT service_id, remote_service_id, service_version, remote_version, reason, '
+                              'detected FROM drift ORDER BY service_id').fetchall()
+        return [dict(zip(('service_id', 'remote_service_id', 'service_version', 'remote_version', 'reason',
+                          'detected'), row)) for row in rows]
@@ -1,17 +1,50 @@
 """Galaxy Adaptor test cases """
 from __future__ import unicode_literals
 
+import collections
+import fcntl
 import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+import zipfile
 from os.path import dirname, join
 
+import requests
+from bioblend import ConnectionError
+from bioblend.galaxy import GalaxyInstance
 from django.conf import settings
-from django.test import override_settings
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase, override_settings
 
-from waves.adaptors.galaxy.tool import GalaxyJobAdaptor
+from waves.adaptors.galaxy.admission import AdmissionController, _controllers
+from waves.adaptors.galaxy.archive import extract_archive, use_archive
+from waves.adaptors.galaxy.breaker import CircuitBreaker, CircuitOpenError, _breakers, install_breaker
+from waves.adaptors.galaxy.cache import GalaxyMetadataCache, details_name, get_metadata_cache
+from waves.adaptors.galaxy.cassette import Cassette, CassetteError, _cassettes
+from waves.adaptors.galaxy.catalog import ToolCatalog, ToolsDelta, diff_fingerprints, fingerprint
+from waves.adaptors.galaxy.exception import GalaxyAdaptorConnectionError
+from waves.adaptors.galaxy.health import HealthMonitor, _monitors, get_health_monitor
+from waves.adaptors.galaxy.histories import HistoryPool
+from waves.adaptors.galaxy.importers import flatten_tool_inputs
+from waves.adaptors.galaxy.memo import ResultCache, memo_key
+from waves.adaptors.galaxy.pipeline import GalaxyPipeline, JobClaims
+from waves.adaptors.galaxy.poller import GalaxyStatusPoller, JobStateStore, store_key
+from waves.adaptors.galaxy.ratelimit import GalaxyRateLimiter
+from waves.adaptors.galaxy.router import GalaxyRouterAdaptor
+from waves.adaptors.galaxy.sync import CatalogSync
+from waves.adaptors.galaxy.timing import JobPhaseTimer, aggregate_phase_timings
+from waves.adaptors.galaxy.tool import GalaxyJobAdaptor, _collection_inputs
+from waves.adaptors.galaxy.transport import add_request_layer
 from waves.adaptors.galaxy.utils import skip_unless_galaxy, skip_unless_tool
+from waves.adaptors.galaxy.validation import ToolValidator, get_validator
 from waves.adaptors.galaxy.workflow import GalaxyWorkFlowAdaptor
-from waves.wcore.adaptors.exceptions import AdaptorConnectException
+from waves.wcore.adaptors.const import JobStatus
+from waves.wcore.adaptors.exceptions import AdaptorConnectException, AdaptorExecException, AdaptorJobException
 from waves.wcore.models import get_service_model, Job, JobInput, JobOutput
 from waves.wcore.models.const import ParamType, OptType
 from waves.wcore.tests.base import BaseTestCase, TestJobWorkflowMixin
@@ -150,3 +183,1149 @@ class GalaxyWorkFlowRunnerTestCase(unittest.TestCase):
             remote_tool_param = updated.srv_run_params.get(name='remote_tool_id')
             logger.debug('Remote too id for service %s : %s', updated, remote_tool_param.value)
             self.importer.import_remote_service(tool_id=remote_tool_param.value)
+
+
+class FakeJob(object):
+    """ Minimal job stand-in for tests not needing database """
+
+    def __init__(self, working_dir, service='fake', slug='fake-job'):
+        self.working_dir = working_dir
+        self.service = service
+        self.slug = slug
+
+
+class FakeRecord(object):
+    """ Job input file / output stand-in """
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def save(self):
+        pass
+
+
+class SharedDirMixin(object):
+    """ Temporary ``shared_dir`` for host wide state databases """
+
+    def setUp(self):
+        super(SharedDirMixin, self).setUp()
+        self.shared_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.shared_dir)
+
+
+class FakeGalaxyMixin(object):
+    """ Test case stands for bioblend GalaxyInstance (objects and plain one) and its clients, as ``self.adaptor``
+    connector: test cases define the clients methods called by tested adaptor code
+    """
+
+    def setUp(self):
+        super(FakeGalaxyMixin, self).setUp()
+        self.adaptor = GalaxyJobAdaptor(command='cat1')
+        self.adaptor.connector = self
+
+    @property
+    def gi(self):
+        return self
+
+    jobs = datasets = histories = tools = gi
+
+
+class GalaxyPhaseTimingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def test_phases_persisted(self):
+        job = FakeJob(self.working_dir)
+        timer = JobPhaseTimer(job)
+        timer.record('upload', 1.5, label='first')
+        timer.record('upload', 0.5, label='second')
+        timer.mark('submitted', when=100)
+        timer.update_remote_times(None, 130, 190)
+        phases = JobPhaseTimer(job).data['phases']
+        self.assertEqual(phases['upload'], 2)
+        self.assertEqual(phases['queue'], 30)
+        self.assertEqual(phases['run'], 60)
+        self.assertEqual(len(JobPhaseTimer(job).data['uploads']), 2)
+
+    def test_aggregate_per_service(self):
+        job = FakeJob(self.working_dir)
+        JobPhaseTimer(job).record('run', 10)
+        JobPhaseTimer(job).record('upload', 2)
+        stats = aggregate_phase_timings([job, job])
+        self.assertEqual(stats['fake']['jobs'], 2)
+        self.assertEqual(stats['fake']['dominant'], 'run')
+        self.assertEqual(stats['fake']['phases']['upload']['mean'], 2)
+
+
+class GalaxyRateLimiterTestCase(SharedDirMixin, unittest.TestCase):
+    def test_rate_limited(self):
+        limiter = GalaxyRateLimiter('http://galaxy.test', limits={'poll': dict(in_flight=1, rate=10)},
+                                    shared_dir=self.shared_dir)
+        for _ in range(12):
+            with limiter.limit('poll'):
+                pass
+        stats = limiter.stats['poll']
+        self.assertEqual(stats['requests'], 12)
+        # burst of 10 requests, then 2 more at 10 req/s
+        self.assertGreater(stats['waited'], 0.1)
+
+    def test_in_flight_shared(self):
+        limits = {'upload': dict(in_flight=1, rate=0)}
+        limiter = GalaxyRateLimiter('http://galaxy.test', limits=limits, shared_dir=self.shared_dir)
+        other = GalaxyRateLimiter('http://galaxy.test', limits=limits, shared_dir=self.shared_dir)
+        with limiter.limit('upload'):
+            fd = os.open(join(other.shared_dir, 'upload.slot.0'), os.O_RDWR)
+            self.assertRaises(IOError, fcntl.flock, fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.close(fd)
+
+    def test_output_downloads_limited(self):
+        sent = []
+
+        def galaxy(method, url, kwargs, send):
+            sent.append((url, kwargs.get('stream', False)))
+            response = requests.Response()
+            response.status_code, response._content_consumed = 200, True
+            response._content = b'>seq' if url.endswith('/display') else \
+                b'{"state": "ok", "file_ext": "fasta", "download_url": "/api/histories/h1/contents/hda1/display"}'
+            return response
+
+        limiter = GalaxyRateLimiter('http://galaxy.test', shared_dir=self.shared_dir)
+        gi = add_request_layer(add_request_layer(GalaxyInstance('http://galaxy.test', key='key'), galaxy), limiter)
+        adaptor = GalaxyJobAdaptor(command='cat1')
+        adaptor.connector = collections.namedtuple('Connector', 'gi')(gi)
+        adaptor._download_dataset('hda1', join(self.shared_dir, 'out.fasta'))
+        self.assertEqual(sent, [('http://galaxy.test/api/datasets/hda1', False),
+                                ('http://galaxy.test/api/histories/h1/contents/hda1/display', True)])
+        self.assertEqual(limiter.stats['poll']['requests'], 2)
+        with open(join(self.shared_dir, 'out.fasta')) as output:
+            self.assertEqual(output.read(), '>seq')
+
+
+class GalaxyRouterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.adaptor = GalaxyRouterAdaptor(host='galaxy1.test', app_key='key1',
+                                           endpoints='https://galaxy2.test:8080/galaxy|key2\nhttp://galaxy3.test')
+
+    def test_endpoint_list(self):
+        self.assertEqual(self.adaptor.endpoint_list, [('http://galaxy1.test', 'key1'),
+                                                      ('https://galaxy2.test:8080/galaxy', 'key2'),
+                                                      ('http://galaxy3.test', 'key1')])
+        self.assertEqual(self.adaptor.endpoint_adaptor('https://galaxy2.test:8080/galaxy').complete_url,
+                         'https://galaxy2.test:8080/galaxy')
+
+    def test_choose_least_loaded_healthy(self):
+        loads = {'http://galaxy1.test': 12, 'https://galaxy2.test:8080/galaxy': None, 'http://galaxy3.test': 3}
+        self.adaptor.endpoint_load = loads.get
+        self.assertEqual(self.adaptor.choose_endpoint(), 'http://galaxy3.test')
+        self.adaptor.endpoint_load = lambda url: None
+        self.assertRaises(AdaptorConnectException, self.adaptor.choose_endpoint)
+
+    def test_batch_routed_to_one_endpoint(self):
+        working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, working_dir)
+        jobs = [FakeJob(working_dir, slug='job%i' % i) for i in range(2)]
+        for job in jobs:
+            job.status, job.input_files, job.logger = JobStatus.JOB_CREATED, [], logger
+        self.adaptor.choose_endpoint = lambda: 'http://galaxy3.test'
+        endpoint = self.adaptor.endpoint_adaptor('http://galaxy3.test')
+        endpoint.run_jobs_batch = lambda batch: batch
+        self.assertEqual(self.adaptor.run_jobs_batch(jobs), jobs)
+        self.assertEqual(self.adaptor.job_endpoint(jobs[0]), 'http://galaxy3.test')
+
+
+class GalaxyCircuitBreakerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker('http://galaxy.test', failures=2, reset_timeout=60)
+
+    def _refused(self):
+        raise requests.exceptions.ConnectionError('Connection refused')
+
+    def test_open_fails_fast(self):
+        for _ in range(2):
+            self.assertRaises(requests.exceptions.ConnectionError, self.breaker, 'get', 'url', {}, self._refused)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpenError, self.breaker, 'get', 'url', {}, lambda: None)
+
+    def test_half_open_probe(self):
+        for _ in range(2):
+            self.assertRaises(requests.exceptions.ConnectionError, self.breaker, 'get', 'url', {}, self._refused)
+        self.breaker.opened_at -= 60
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.breaker.probe = lambda: False
+        self.assertRaises(CircuitOpenError, self.breaker, 'get', 'url', {}, lambda: None)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.breaker.opened_at -= 60
+        self.breaker.probe = lambda: True
+        self.assertEqual(self.breaker('get', 'url', {}, lambda: 'response'), 'response')
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failures_counted_across_threads(self):
+        self.breaker.max_failures = 1000
+
+        def fail():
+            for _ in range(200):
+                self.breaker.record_failure('Connection refused')
+
+        threads = [threading.Thread(target=fail) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.breaker.failures, 800)
+
+    def test_probe_owned_by_breaker(self):
+        with override_settings(WAVES_GALAXY={'CIRCUIT_BREAKER': dict(failures=2, reset_timeout=60)}):
+            breaker = install_breaker(GalaxyInstance('http://probe.test', key='key1'), 'http://probe.test')
+            self.addCleanup(_breakers.pop, 'http://probe.test')
+            # Connecting other adaptors never replaces host probe
+            self.assertIs(install_breaker(GalaxyInstance('http://probe.test', key='key2'), 'http://probe.test'),
+                          breaker)
+        self.assertEqual(breaker.probe, breaker.check_host)
+
+    def test_error_without_body(self):
+        self.assertEqual(GalaxyAdaptorConnectionError(CircuitOpenError('Circuit open')).message, 'Circuit open')
+        self.assertEqual(GalaxyAdaptorConnectionError(CircuitOpenError('Error', body='<html>')).message, 'Error')
+        self.assertEqual(GalaxyAdaptorConnectionError(
+            CircuitOpenError('Error', body='{"err_msg": "Galaxy message"}')).message, 'Galaxy message')
+
+
+class GalaxyCollectionInputsTestCase(unittest.TestCase):
+    def test_nested_collection_inputs(self):
+        tool_inputs = [
+            dict(name='reads', type='data_collection', collection_types=['paired']),
+            dict(name='options', type='section', inputs=[dict(name='threshold', type='integer')]),
+            dict(name='mode', type='conditional', cases=[
+                dict(value='single', inputs=[dict(name='sample', type='data')]),
+                dict(value='multi', inputs=[dict(name='samples', type='data_collection')]),
+            ])
+        ]
+        self.assertEqual(_collection_inputs(tool_inputs), dict(reads='paired', samples='list'))
+
+
+class GalaxyBatchTestCase(unittest.TestCase):
+    def _job(self, files, **params):
+        job = FakeJob(tempfile.gettempdir())
+        job.status = JobStatus.JOB_CREATED
+        job.input_files = [collections.namedtuple('File', 'name')(name) for name in files]
+        job.input_params = [collections.namedtuple('Param', 'name value')(name, value)
+                            for name, value in params.items()]
+        return job
+
+    def test_batch_key(self):
+        adaptor = GalaxyJobAdaptor(command='cat1')
+        first = adaptor._batch_key(self._job(['input1'], mode='fast'))
+        self.assertEqual(first, adaptor._batch_key(self._job(['input1'], mode='fast')))
+        self.assertNotEqual(first, adaptor._batch_key(self._job(['input1'], mode='slow')))
+        self.assertIsNone(adaptor._batch_key(self._job([], mode='fast')))
+        self.assertIsNone(adaptor._batch_key(self._job(['input1', 'input1'], mode='fast')))
+        queued = self._job(['input1'], mode='fast')
+        queued.status = JobStatus.JOB_QUEUED
+        self.assertIsNone(adaptor._batch_key(queued))
+
+
+class GalaxyStatusPollerTestCase(SharedDirMixin, unittest.TestCase):
+    def setUp(self):
+        super(GalaxyStatusPollerTestCase, self).setUp()
+        self.store = JobStateStore('http://galaxy.test', shared_dir=self.shared_dir)
+        self.requests = []
+        self.remote_jobs = [dict(id='job%i' % i, state='running', update_time='2018-01-01T10:00:0%i' % i)
+                            for i in range(6)]
+
+    @property
+    def jobs(self):
+        # Stands for both bioblend GalaxyInstance and its jobs client
+        return self
+
+    def _get(self, params):
+        self.requests.append(params)
+        return [remote_job for remote_job in self.remote_jobs
+                if remote_job['update_time'] >= params.get('date_range_min', '')]
+
+    def show_job(self, job_id):
+        self.requests.append(job_id)
+        return next(remote_job for remote_job in self.remote_jobs if remote_job['id'] == job_id)
+
+    def test_incremental_refresh(self):
+        poller = GalaxyStatusPoller(self, 'http://galaxy.test', store=self.store)
+        self.assertEqual(poller.refresh(), 6)
+        for remote_job in self.remote_jobs:
+            self.assertEqual(self.store.get(remote_job['id'], max_age=30), 'running')
+        self.remote_jobs[0].update(state='ok', update_time='2018-01-01T10:01:00')
+        since = self.store.last_sync()
+        # job5 was updated on last sync time, it is listed again
+        self.assertEqual(poller.refresh(), 2)
+        self.assertEqual(self.requests[-1]['date_range_min'], since)
+        self.assertEqual(self.store.get('job0', max_age=0), 'ok')
+        self.assertIsNone(self.store.get('job1', max_age=-1))
+        self.assertIsNone(self.store.get('unknown'))
+
+    def test_sharded_refresh(self):
+        # Each shard only asks for its own active jobs, never lists the whole host
+        self.store.update(self.remote_jobs)
+        self.remote_jobs[0].update(state='ok')
+        pollers = [GalaxyStatusPoller(self, 'http://galaxy.test', shard, 2, store=self.store) for shard in range(2)]
+        for poller in pollers:
+            owned = self.store.active(poller.shard, 2)
+            del self.requests[:]
+            self.assertEqual(poller.refresh(), len(owned))
+            self.assertEqual(sorted(self.requests), sorted(owned))
+        self.assertEqual(self.store.get('job0', max_age=0), 'ok')
+        self.assertEqual(len(self.store.active(0, 1)), 5)
+
+    def test_store_per_api_key(self):
+        # Galaxy lists only jobs of api key user: another user jobs are neither listed nor marked refreshed
+        other = JobStateStore('http://galaxy.test', shared_dir=self.shared_dir, api_key='other')
+        other.update([dict(id='other1', state='running')])
+        GalaxyStatusPoller(self, 'http://galaxy.test', store=self.store).refresh()
+        self.assertEqual(self.store.get('job0'), 'running')
+        self.assertIsNone(self.store.get('other1'))
+        self.assertEqual(other.active(), ['other1'])
+        self.assertNotEqual(store_key('http://galaxy.test', 'key1'), store_key('http://galaxy.test', 'key2'))
+
+
+class GalaxyMetadataCacheTestCase(SharedDirMixin, unittest.TestCase):
+    def setUp(self):
+        super(GalaxyMetadataCacheTestCase, self).setUp()
+        self.cache = GalaxyMetadataCache('http://galaxy.test', cache=LocMemCache('galaxy-test', {}), lock_timeout=1)
+        # Local memory caches with the same name share their content
+        self.cache.cache.clear()
+        self.fetched = []
+
+    def _fetch(self):
+        self.fetched.append(1)
+        return ['tool%i' % len(self.fetched)]
+
+    def test_versioned_keys(self):
+        self.assertEqual(self.cache.get_or_fetch('tools', self._fetch), ['tool1'])
+        self.assertEqual(self.cache.get_or_fetch('tools', self._fetch), ['tool1'])
+        self.cache.invalidate()
+        self.assertEqual(self.cache.get_or_fetch('tools', self._fetch), ['tool2'])
+        other_host = GalaxyMetadataCache('http://other.test', cache=self.cache.cache)
+        self.assertEqual(other_host.get_or_fetch('tools', self._fetch), ['tool3'])
+
+    def test_sync_generations(self):
+        self.assertEqual(self.cache.generation, 0)
+        self.assertEqual(self.cache.bump_generation(), 1)
+        self.assertEqual(self.cache.generation, 1)
+        self.assertEqual(self.cache.get_or_fetch(details_name('cat1', io_details=True), self._fetch), ['tool1'])
+        self.cache.forget('cat1')
+        self.assertEqual(self.cache.tool_generation('cat1'), 1)
+        self.assertEqual(self.cache.get_or_fetch(details_name('cat1', io_details=True), self._fetch), ['tool2'])
+        # Dropped validators of previous tool details generation
+        validator = get_validator('http://galaxy.test', 'cat1', '1.0', list)
+        self.assertIs(get_validator('http://galaxy.test', 'cat1', '1.0', list), validator)
+        self.assertIsNot(get_validator('http://galaxy.test', 'cat1', '1.0', list, generation=1), validator)
+
+    def test_stampede_protection(self):
+        key = self.cache.key('tools')
+        # Another process holds fetch lock and stores value meanwhile
+        self.cache.cache.add('%s:lock' % key, 1)
+        timer = threading.Timer(0.3, self.cache.cache.set, (key, ['shared']))
+        timer.start()
+        self.assertEqual(self.cache.get_or_fetch('tools', self._fetch), ['shared'])
+        self.assertEqual(self.fetched, [])
+        timer.join()
+
+    def test_shared_between_processes(self):
+        # Default local memory cache is not shared between processes, file based cache is used instead
+        for alias in (None, 'default'):
+            with override_settings(WAVES_GALAXY={'SHARED_DIR': self.shared_dir,
+                                                 'METADATA_CACHE': dict(alias=alias)}):
+                metadata_cache = get_metadata_cache('http://galaxy.test')
+            self.assertIsInstance(metadata_cache.cache, FileBasedCache)
+            self.assertEqual(metadata_cache.cache._dir, join(self.shared_dir, 'metadata'))
+
+
+@override_settings(WAVES_GALAXY={'CANCEL': dict(purge=True, confirm_timeout=0)})
+class GalaxyCancelTestCase(FakeGalaxyMixin, SimpleTestCase):
+    def setUp(self):
+        super(GalaxyCancelTestCase, self).setUp()
+        self.states = dict(job1='running', upload1='queued', upload2='ok')
+        self.data_sets = dict(hda1=dict(state='queued', creating_job='upload1'),
+                              hda2=dict(state='ok', creating_job='upload2'))
+        self.purged = []
+
+    def _delete(self, id):
+        if self.states[id] != 'ok':
+            self.states[id] = 'deleted'
+        return True
+
+    def show_job(self, job_id):
+        return dict(id=job_id, state=self.states[job_id])
+
+    def show_dataset(self, dataset_id):
+        return self.data_sets[dataset_id]
+
+    def delete_dataset(self, history_id, dataset_id, purge=False):
+        self.purged.append(dataset_id)
+
+    def _job(self):
+        job = FakeJob(tempfile.gettempdir())
+        job.remote_job_id = 'job1'
+        job.remote_history_id = 'history1'
+        job.logger = logger
+        job.input_files = [collections.namedtuple('File', 'remote_input_id')(hda) for hda in ('hda1', 'hda2')]
+        job.outputs = collections.namedtuple('Outputs', 'all')(lambda: [])
+        return job
+
+    def test_cancel_job_and_uploads(self):
+        self.adaptor._cancel_job(self._job())
+        self.assertEqual(self.states, dict(job1='deleted', upload1='deleted', upload2='ok'))
+        self.assertEqual(self.purged, ['hda1', 'hda2'])
+
+    def test_cancel_not_confirmed(self):
+        self._delete = lambda id: False
+        self.assertRaises(AdaptorJobException, self.adaptor._cancel_job, self._job())
+        self.assertEqual(self.purged, [])
+
+
+class GalaxyAdmissionTestCase(SharedDirMixin, unittest.TestCase):
+    def setUp(self):
+        super(GalaxyAdmissionTestCase, self).setUp()
+        self.controller = AdmissionController('http://galaxy.test', max_active=2, load_ttl=0,
+                                              shared_dir=self.shared_dir)
+        self.active = 1
+
+    def _admit(self, job, priority=0):
+        return self.controller.admit(job, priority, lambda: self.active)
+
+    def test_hold_and_release_by_priority(self):
+        self.assertTrue(self._admit('job1'))
+        self.active = 2
+        self.assertFalse(self._admit('job2'))
+        self.assertFalse(self._admit('job3'))
+        self.assertFalse(self._admit('urgent', priority=1))
+        self.assertEqual([held['job'] for held in self.controller.backlog], ['urgent', 'job2', 'job3'])
+        self.active = 1
+        # Only one slot: released in priority, then submission order
+        self.assertFalse(self._admit('job2'))
+        self.assertTrue(self._admit('urgent', priority=1))
+        self.assertEqual([held['job'] for held in self.controller.backlog], ['job2', 'job3'])
+        self.controller.remove('job3')
+        self.assertEqual([held['job'] for held in self.controller.backlog], ['job2'])
+
+    def test_load_cached(self):
+        self.controller.load_ttl = 60
+        self.assertTrue(self._admit('job1'))
+        self.active = 0
+        # Count from Galaxy not refreshed, job1 admission counted locally
+        self.assertFalse(self._admit('job2'))
+
+    def test_prune_jobs_no_longer_waiting(self):
+        self.active = 2
+        for job in ('job1', 'job2', 'job3'):
+            self.assertFalse(self._admit(job))
+        self.assertEqual(self.controller.prune(lambda jobs: [job for job in jobs if job != 'job1']), ['job1'])
+        self.assertFalse(self.controller.holds('job1'))
+        self.assertTrue(self.controller.holds('job2'))
+        self.active = 1
+        self.assertTrue(self._admit('job2'))
+
+    def test_leased_job_held_until_submitted(self):
+        self.active = 2
+        self.assertFalse(self._admit('job1'))
+        self.active = 1
+        self.assertTrue(self.controller.admit('job1', 0, lambda: self.active, lease=60))
+        self.assertTrue(self.controller.holds('job1'))
+        # Being submitted: not admitted twice
+        self.assertFalse(self._admit('job1'))
+        self.controller.requeue('job1')
+        self.assertTrue(self.controller.admit('job1', 0, lambda: self.active, lease=60))
+        self.controller.remove('job1')
+        self.assertEqual(self.controller.backlog, [])
+
+    def test_release_held_once_submitted(self):
+        self.active = 2
+        self.assertFalse(self._admit('fake-job'))
+        self.active = 1
+        job = FakeJob(self.shared_dir)
+        job.remote_job_id, job.status, job.logger = None, JobStatus.JOB_QUEUED, logger
+        adaptor = GalaxyJobAdaptor(command='cat1')
+        adaptor.connect = lambda: None
+        adaptor._admit = lambda held, lease=0: self.controller.admit(held.slug, 0, lambda: self.active, lease=lease)
+
+        def submit_failed(held):
+            raise AdaptorExecException(None, 'Galaxy unavailable')
+
+        _controllers[adaptor.complete_url] = self.controller
+        self.addCleanup(_controllers.pop, adaptor.complete_url)
+        with override_settings(WAVES_GALAXY={'ADMISSION': dict(max_active=2)}):
+            # Status checks never submit held jobs
+            self.assertEqual(adaptor._job_status(job), 'held')
+            adaptor._submit_job = submit_failed
+            with self.assertRaises(AdaptorExecException):
+                adaptor.release_held(job)
+            self.assertTrue(self.controller.holds('fake-job'))
+            adaptor._submit_job = lambda held: setattr(held, 'remote_job_id', 'job1')
+            self.assertTrue(adaptor.release_held(job))
+            self.assertFalse(self.controller.holds('fake-job'))
+            self.assertFalse(adaptor.release_held(job))
+
+    def test_unsubmitted_job_status_unchanged(self):
+        job = FakeJob(self.shared_dir)
+        job.remote_job_id = None
+        adaptor = GalaxyJobAdaptor(command='cat1')
+        for status, state in ((JobStatus.JOB_PREPARED, 'prepared'), (JobStatus.JOB_ERROR, 'error'),
+                              (JobStatus.JOB_QUEUED, 'held')):
+            job.status = status
+            # Admission control disabled: nothing held, job is not submitted
+            self.assertEqual(adaptor._job_status(job), state)
+            self.assertEqual(adaptor._states_map[state], status)
+
+
+class GalaxyResultCacheTestCase(SharedDirMixin, unittest.TestCase):
+    def setUp(self):
+        super(GalaxyResultCacheTestCase, self).setUp()
+        self.results = ResultCache('http://galaxy.test', shared_dir=self.shared_dir)
+
+    def test_memo_key_normalised(self):
+        key = memo_key('cat1', '1.0', [('input2', 'b'), ('input1', 'a')], dict(lines=10, mode='fast'))
+        self.assertEqual(key, memo_key('cat1', '1.0', [('input1', 'a'), ('input2', 'b')],
+                                       dict(mode='fast', lines='10')))
+        self.assertNotEqual(key, memo_key('cat1', '1.1', [('input1', 'a'), ('input2', 'b')],
+                                          dict(lines=10, mode='fast')))
+        self.assertNotEqual(key, memo_key('cat1', '1.0', [('input1', 'b'), ('input2', 'a')],
+                                          dict(lines=10, mode='fast')))
+
+    def test_hits_retention_and_tool_update(self):
+        self.results.store('key1', 'cat1', '1.0', 'job1', 'history1', dict(out_file1='hda1'))
+        self.assertEqual(self.results.get('key1'),
+                         dict(remote_job_id='job1', history_id='history1', outputs=dict(out_file1='hda1')))
+        self.results.get('key1')
+        self.assertEqual(self.results.stats, dict(cat1=dict(results=1, hits=2)))
+        self.results.store('key2', 'cat1', '1.1', 'job2', 'history2', dict(out_file1='hda2'))
+        self.assertIsNone(self.results.get('key1'))
+        self.results.retention = -1
+        self.assertIsNone(self.results.get('key2'))
+        self.assertEqual(self.results.stats, {})
+
+    def test_results_per_api_key(self):
+        self.results.store('key1', 'cat1', '1.0', 'job1', 'history1', dict(out_file1='hda1'))
+        other = ResultCache('http://galaxy.test', shared_dir=self.shared_dir, api_key='other')
+        self.assertIsNone(other.get('key1'))
+
+
+class GalaxyPipelineTestCase(SharedDirMixin, unittest.TestCase):
+    """ Pipeline stages with a fake adaptor: upload of 'slow' job blocks until released """
+
+    def setUp(self):
+        super(GalaxyPipelineTestCase, self).setUp()
+        self.release = threading.Event()
+        self.claims = JobClaims(shared_dir=self.shared_dir)
+        self.pipeline = GalaxyPipeline(workers=dict(upload=1, readiness=1, submission=1, collection=1),
+                                       poll_interval=0.05, claims=self.claims)
+
+    def tearDown(self):
+        self.release.set()
+        self.pipeline.stop()
+
+    def inputs_ready(self, job):
+        job.checks = getattr(job, 'checks', 0) + 1
+        return job.checks > 1
+
+    def _prepare(self, job):
+        if job.slug == 'slow':
+            self.release.wait()
+        job.status = JobStatus.JOB_PREPARED
+
+    def release_held(self, job):
+        job.releases = getattr(job, 'releases', 0) + 1
+        if job.releases > 1:
+            job.remote_job_id = 'remote'
+        return job.remote_job_id is not None
+
+    def _job(self, slug, status=JobStatus.JOB_CREATED):
+        job = FakeJob(join(self.shared_dir, slug), slug=slug)
+        os.makedirs(job.working_dir)
+        job.status, job.adaptor = status, self
+        job.remote_job_id = 'remote' if status == JobStatus.JOB_RUNNING else None
+        job.save = job.refresh_from_db = lambda: None
+        job.run_prepare = lambda: self._prepare(job)
+        job.run_launch = lambda: job.__dict__.update(status=JobStatus.JOB_QUEUED, remote_job_id='remote')
+        job.run_status = lambda: setattr(job, 'status', JobStatus.JOB_TERMINATED)
+        return job
+
+    def _wait(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_slow_upload_does_not_block_other_stages(self):
+        self.pipeline.start()
+        slow, other, running = self._job('slow'), self._job('other'), self._job('running', JobStatus.JOB_RUNNING)
+        for job in (slow, running, other):
+            self.assertTrue(self.pipeline.submit(job))
+        self.assertFalse(self.pipeline.submit(running))
+        self._wait(lambda: running.status == JobStatus.JOB_TERMINATED)
+        self.assertEqual(self.pipeline.queue_depths()['upload'], dict(queued=1, delayed=0, active=1))
+        self.release.set()
+        self._wait(lambda: slow.status == other.status == JobStatus.JOB_TERMINATED)
+        self.assertEqual(slow.checks, 2)
+        self.assertIn('readiness', JobPhaseTimer(slow).data['phases'])
+
+    def test_claimed_jobs(self):
+        job = self._job('claimed', JobStatus.JOB_RUNNING)
+        self.assertTrue(self.pipeline.submit(job))
+        other = GalaxyPipeline(claims=JobClaims(ttl=-1, shared_dir=self.shared_dir))
+        self.assertFalse(other.submit(job))
+        # Claims not renewed expire
+        self.assertTrue(other.claims.claim('expired', 'stopped pipeline'))
+        self.assertTrue(self.claims.claim('expired', self.pipeline.owner))
+        self.pipeline.stop()
+        self.assertTrue(other.submit(job))
+
+    def test_held_job_released_before_status_check(self):
+        self.pipeline.start()
+        job = self._job('held', JobStatus.JOB_QUEUED)
+        job.run_status = lambda: setattr(job, 'status',
+                                         JobStatus.JOB_TERMINATED if job.remote_job_id else JobStatus.JOB_QUEUED)
+        self.assertTrue(self.pipeline.submit(job))
+        self._wait(lambda: job.status == JobStatus.JOB_TERMINATED)
+        self.assertEqual(job.releases, 2)
+
+
+@override_settings(WAVES_GALAXY={'FAST_SUBMIT': True, 'STATUS_POLLER': None, 'VALIDATE': False})
+class GalaxyFastSubmitTestCase(FakeGalaxyMixin, SimpleTestCase):
+    def setUp(self):
+        super(GalaxyFastSubmitTestCase, self).setUp()
+        self.data_sets = dict(hda1=dict(state='ok'), hda2=dict(state='queued'))
+        self.working_dir = tempfile.mkdtemp()
+        self.job = FakeJob(self.working_dir)
+        self.job.title = 'fast'
+        self.job.job_inputs = collections.namedtuple('Inputs', 'count')(lambda: 2)
+        input_file = collections.namedtuple('File', 'name remote_input_id')
+        self.job.input_files = [input_file('first', 'hda1'), input_file('second', 'hda2')]
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    id = 'history1'
+
+    def create(self, name):
+        return self
+
+    def show_dataset(self, dataset_id):
+        return self.data_sets[dataset_id]
+
+    def _get(self, id, params=None):
+        return self.data_sets[id]
+
+    def get(self, job_id):
+        return collections.namedtuple('Job', 'state wrapped')('paused', {})
+
+    def test_no_wait_for_uploads(self):
+        self.job.input_files = []
+        self.assertFalse(self.adaptor._start_prepare(self.job, JobPhaseTimer(self.job)))
+        self.assertEqual(self.job.remote_history_id, 'history1')
+
+    def test_failed_upload_reported(self):
+        self.job.remote_job_id = 'job1'
+        self.assertEqual(self.adaptor._job_status(self.job), 'paused')
+        self.data_sets['hda2']['state'] = 'error'
+        self.assertEqual(self.adaptor._job_status(self.job), 'error')
+        self.assertEqual(self.job.message, 'Input files upload failed: second')
+
+
+class GalaxyHistoryPoolTestCase(SharedDirMixin, unittest.TestCase):
+    def setUp(self):
+        super(GalaxyHistoryPoolTestCase, self).setUp()
+        self.pool = HistoryPool('http://galaxy.test', max_datasets=10, max_age=3600, shared_dir=self.shared_dir)
+        self.created = []
+
+    def _create(self):
+        self.created.append('history%i' % len(self.created))
+        return self.created[-1]
+
+    def test_rolling_history(self):
+        self.assertEqual(self.pool.reserve('user:1', 4, self._create), 'history0')
+        self.assertEqual(self.pool.reserve('user:1', 6, self._create), 'history0')
+        self.assertEqual(self.pool.reserve('user:2', 1, self._create), 'history1')
+        # Size cap reached
+        self.assertEqual(self.pool.reserve('user:1', 1, self._create), 'history2')
+        self.pool.max_age = -1
+        self.assertEqual(self.pool.reserve('user:1', 1, self._create), 'history3')
+        self.pool.discard('user:1', 'history3')
+        self.assertEqual([history['history_id'] for history in self.pool.current], ['history1'])
+
+    def test_pool_per_api_key(self):
+        other = HistoryPool('http://galaxy.test', shared_dir=self.shared_dir, api_key='other')
+        self.assertEqual(self.pool.reserve('service:cat1', 1, self._create), 'history0')
+        self.assertEqual(other.reserve('service:cat1', 1, self._create), 'history1')
+
+
+class GalaxyArchiveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def test_use_archive(self):
+        self.assertFalse(use_archive([10] * 5, min_outputs=10))
+        self.assertTrue(use_archive([10] * 10, min_outputs=10, max_size=100))
+        self.assertFalse(use_archive([10] * 10, min_outputs=10, max_size=99))
+        self.assertTrue(use_archive([None] * 10, min_outputs=10, max_size=99))
+
+    def test_extract_to_outputs_paths(self):
+        archive_path = join(self.working_dir, 'outputs.zip')
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            archive.writestr('job outputs/hda1.txt', 'first')
+            archive.writestr('job outputs/hda2.tabular', 'second')
+            archive.writestr('job outputs/other.txt', 'ignored')
+        targets = dict(hda1=join(self.working_dir, 'out1.txt'), hda2=join(self.working_dir, 'out2.tsv'),
+                       hda3=join(self.working_dir, 'out3.txt'))
+        self.assertEqual(extract_archive(archive_path, targets), {'hda1', 'hda2'})
+        with open(targets['hda2']) as fp:
+            self.assertEqual(fp.read(), 'second')
+        self.assertFalse(os.path.exists(targets['hda3']))
+
+
+class GalaxyHealthMonitorTestCase(SharedDirMixin, unittest.TestCase):
+    def setUp(self):
+        super(GalaxyHealthMonitorTestCase, self).setUp()
+        self.checks = []
+        self.monitor = HealthMonitor('http://galaxy.test', self._probe, interval=60, history=2,
+                                     shared_dir=self.shared_dir)
+
+    def tearDown(self):
+        self.monitor.stop()
+
+    def _probe(self):
+        self.checks.append(time.time())
+        if len(self.checks) == 2:
+            raise requests.ConnectionError('Connection refused')
+        return True
+
+    def test_history_and_last_error(self):
+        self.assertIsNone(self.monitor.status())
+        self.assertTrue(self.monitor.measure()['available'])
+        status = self.monitor.measure()
+        self.assertEqual((status['available'], status['error']), (False, 'Connection refused'))
+        status = self.monitor.measure()
+        self.assertTrue(status['available'])
+        self.assertEqual(len(status['history']), 2)
+        self.assertIsNone(status['history'][1])
+        self.assertEqual(status['last_error']['error'], 'Connection refused')
+        self.assertIsNone(self.monitor.status(max_age=-1))
+
+    def test_heartbeat_shared(self):
+        self.monitor.measure()
+        # Another process heartbeat does not check host again while last check is recent
+        other = HealthMonitor('http://galaxy.test', self._probe, interval=60, shared_dir=self.shared_dir)
+        other.start()
+        time.sleep(0.1)
+        other.stop()
+        self.assertEqual(len(self.checks), 1)
+
+    def test_monitor_per_api_key(self):
+        self.addCleanup(_monitors.clear)
+        # Heartbeat is opt-in
+        self.assertIsNone(get_health_monitor('http://galaxy.test', 'key1', self._probe))
+        with override_settings(WAVES_GALAXY={'HEALTH': dict(interval=60), 'SHARED_DIR': self.shared_dir}):
+            monitor = get_health_monitor('http://galaxy.test', 'key1', self._probe)
+            self.assertIs(get_health_monitor('http://galaxy.test', 'key1', self._probe), monitor)
+            other = get_health_monitor('http://galaxy.test', 'key2', self._probe)
+        self.assertIsNot(other, monitor)
+        self.assertNotEqual(other.db_path, monitor.db_path)
+
+    def test_probe_through_connector(self):
+        sent = []
+
+        def galaxy(method, url, kwargs, send):
+            sent.append(url)
+            response = requests.Response()
+            response.status_code, response._content = 200, b'{"username": "waves", "deleted": false}'
+            return response
+
+        adaptor = GalaxyJobAdaptor(command='cat1', host='galaxy.test', app_key='key1')
+        adaptor.connector = collections.namedtuple('Connector', 'gi')(
+            add_request_layer(GalaxyInstance('http://galaxy.test', key='key1'), galaxy))
+        adaptor._connected = True
+        self.addCleanup(_monitors.clear)
+        with override_settings(WAVES_GALAXY={'HEALTH': dict(interval=60), 'SHARED_DIR': self.shared_dir}):
+            self.assertTrue(adaptor.test_connection())
+            monitor = get_health_monitor(adaptor.complete_url, adaptor.app_key, None)
+        monitor.stop()
+        self.assertEqual(sent, ['http://galaxy.test/api/users/current'])
+
+
+class GalaxyToolValidatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.validator = ToolValidator([
+            dict(type='data', name='input'),
+            dict(type='data_collection', name='reads', optional=True, collection_types=['paired']),
+            dict(type='section', name='advanced', inputs=[
+                dict(type='integer', name='threads', min=1, max=16),
+                dict(type='float', name='ratio', min='', max=''),
+            ]),
+            dict(type='conditional', name='mode', test_param=dict(
+                type='select', name='kind', options=[['Fast', 'fast', True], ['Accurate', 'accurate', False]]),
+                cases=[dict(value='fast', inputs=[dict(type='boolean', name='quick', truevalue='--quick',
+                                                       falsevalue='')])]),
+            dict(type='repeat', name='queries', inputs=[dict(type='data', name='query')]),
+            dict(type='select', name='db', is_dynamic=True, options=[]),
+        ])
+
+    def test_valid_run(self):
+        self.assertEqual(self.validator.errors(dict(threads='4', ratio='0.5', kind='fast', quick='--quick', db='x'),
+                                               ['input']), [])
+
+    def test_invalid_run(self):
+        errors = self.validator.errors(dict(threads='32', ratio='half', kind='fast', quick='maybe'), ['reads'])
+        self.assertEqual(sorted(errors), [
+            'input: missing input file',
+            'quick: expected a boolean value, got "maybe"',
+            'ratio: expected a number value, got "half"',
+            'reads: paired collection expects 2 files, got 1',
+            'threads: value 32 is greater than 16',
+        ])
+        # Params of inactive conditional cases are not checked
+        self.assertEqual(self.validator.errors(dict(kind='slow', quick='maybe'), ['input']),
+                         ['kind: unexpected value(s) "slow"'])
+
+    def test_conditional_cases(self):
+        validator = ToolValidator([
+            dict(type='conditional', name='mode', test_param=dict(type='select', name='type', value='a', options=[
+                ['A', 'a', True], ['B', 'b', False]]), cases=[
+                dict(value='a', inputs=[dict(type='integer', name='value')]),
+                dict(value='b', inputs=[dict(type='select', name='value', options=[['X', 'x', True]])])]),
+            dict(type='section', name='first', inputs=[dict(type='integer', name='size')]),
+            dict(type='section', name='second', inputs=[dict(type='float', name='size')]),
+        ])
+        self.assertEqual(validator.errors(dict(type='b', value='x'), []), [])
+        self.assertEqual(validator.errors(dict(type='b', value='y'), []), ['value: unexpected value(s) "y"'])
+        # Test param default value selects case
+        self.assertEqual(validator.errors(dict(value='x'), []), ['value: expected an integer value, got "x"'])
+        # Ambiguous names are not checked
+        self.assertEqual(validator.errors(dict(size='big'), []), [])
+
+
+class GalaxyFlattenInputsTestCase(unittest.TestCase):
+    def test_flatten_order_and_links(self):
+        params, repeats = flatten_tool_inputs([
+            dict(type='data', name='input'),
+            dict(type='section', name='advanced', inputs=[
+                dict(type='repeat', name='queries', inputs=[dict(type='text', name='query')])]),
+            dict(type='conditional', name='mode', test_param=dict(type='select', name='kind'), cases=[
+                dict(value='a', inputs=[dict(type='integer', name='size')]),
+                dict(value='b', inputs=[dict(type='conditional', name='sub',
+                                             test_param=dict(type='boolean', name='flag'),
+                                             cases=[dict(value='true', inputs=[dict(type='float', name='ratio')])])])]),
+        ])
+        self.assertEqual([node.tool_input['name'] for node in params],
+                         ['input', 'query', 'kind', 'size', 'flag', 'ratio'])
+        self.assertEqual([(node.parent, node.when_value) for node in params],
+                         [(None, None), (None, None), (None, None), (2, 'a'), (2, 'b'), (4, 'true')])
+        self.assertEqual([node.repeat for node in params], [None, 0, None, None, None, None])
+        self.assertEqual([repeat['name'] for repeat in repeats], ['queries'])
+
+    def test_deep_nesting(self):
+        tool_inputs = [dict(type='text', name='leaf')]
+        for depth in range(5000):
+            tool_inputs = [dict(type='section', name='section%i' % depth, inputs=tool_inputs)]
+        params, _ = flatten_tool_inputs(tool_inputs)
+        self.assertEqual([node.tool_input['name'] for node in params], ['leaf'])
+
+
+class GalaxyCassetteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = join(self.directory, 'session.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def _response(content):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = content
+        return response
+
+    def _refused(self):
+        raise ConnectionError('Unexpected HTTP status code: 503', body='', status_code=503)
+
+    def test_record_replay(self):
+        recorder = Cassette(self.path, Cassette.RECORD)
+        with recorder.section('prepare_job'):
+            recorder('post', 'http://galaxy.test/api/histories', {}, lambda: dict(id='h1'))
+            recorder('get', 'http://galaxy.test/api/datasets/d1/display', dict(stream=True),
+                     lambda: self._response(b'\x00>seq'))
+        with recorder.section('job_status'):
+            self.assertRaises(ConnectionError, recorder, 'get', 'http://galaxy.test/api/jobs/j1', {}, self._refused)
+            recorder('get', 'http://galaxy.test/api/jobs/j1', {}, lambda: self._response(b'{"state": "ok"}'))
+        recorder.save()
+
+        player = Cassette(self.path, Cassette.REPLAY, latency=0)
+        with player.section('prepare_job'):
+            self.assertEqual(player('post', 'http://other.test/api/histories', dict(payload={}), None), dict(id='h1'))
+            download = player('get', 'http://other.test/api/datasets/d1/display', dict(stream=True), None)
+            self.assertEqual(b''.join(download.iter_content(2)), b'\x00>seq')
+        with player.section('job_status'):
+            with self.assertRaises(ConnectionError) as context:
+                player('get', 'http://other.test/api/jobs/j1', {}, None)
+            self.assertEqual(context.exception.status_code, 503)
+            self.assertEqual(player('get', 'http://other.test/api/jobs/j1', {}, None).json(), dict(state='ok'))
+            self.assertRaises(CassetteError, player, 'get', 'http://other.test/api/jobs/j1', {}, None)
+        self.assertEqual(player.remaining, 0)
+        self.assertEqual([(section, stats['calls']) for section, stats in player.stats().items()],
+                         [('prepare_job', 2), ('job_status', 2)])
+
+    def test_api_key_not_recorded(self):
+        recorder = Cassette(self.path, Cassette.RECORD)
+        response = self._response(b'[]')
+        response.url = 'http://galaxy.test/api/histories?key=secret&deleted=false'
+        recorder('get', 'http://galaxy.test/api/histories', {}, lambda: response)
+
+        def refused():
+            raise requests.exceptions.ConnectionError('Max retries exceeded with url: /api/jobs?key=secret')
+        self.assertRaises(requests.exceptions.ConnectionError, recorder, 'get', 'http://galaxy.test/api/jobs', {},
+                          refused)
+        recorder.save()
+        with open(self.path) as cassette:
+            recorded = cassette.read()
+        self.assertNotIn('secret', recorded)
+        self.assertIn('key=***', recorded)
+
+    def test_replayed_job_lifecycle(self):
+        cassette_path = join(dirname(__file__), 'fixtures', 'tests', 'cassettes', 'cat1_lifecycle.json')
+        with open(join(self.directory, 'input.txt'), 'w') as input_file:
+            input_file.write('first line\n')
+        job = FakeJob(self.directory, slug='lifecycle')
+        job.title, job.logger, job.stdout, job.stderr = 'lifecycle', logger, 'job.stdout', 'job.stderr'
+        job.remote_history_id = job.remote_job_id = None
+        job.input_files = [FakeRecord(name='input1', value='input.txt', remote_input_id=None)]
+        job.input_params = []
+        job.job_inputs = collections.namedtuple('Inputs', 'count')(lambda: 1)
+        outputs = [FakeRecord(api_name='out_file1', remote_output_id=None, file_path='output.txt')]
+        job.outputs = collections.namedtuple('Outputs', 'all count')(lambda: outputs, lambda: len(outputs))
+        _cassettes.pop(cassette_path, None)
+        self.addCleanup(_cassettes.pop, cassette_path, None)
+        with override_settings(WAVES_GALAXY={'CASSETTE': dict(path=cassette_path, mode='replay', latency=0),
+                                             'SHARED_DIR': self.directory, 'METADATA_CACHE': None,
+                                             'VALIDATE': False, 'HEALTH': None}):
+            adaptor = GalaxyJobAdaptor(command='cat1', host='galaxy.test', app_key='key')
+            adaptor.connect()
+            cassette = adaptor.cassette
+            with cassette.section('prepare_job'):
+                adaptor._prepare_job(job)
+            with cassette.section('run_job'):
+                adaptor._run_job(job)
+            with cassette.section('job_status'):
+                self.assertEqual(adaptor._job_status(job), 'ok')
+            with cassette.section('job_results'):
+                adaptor._job_results(job)
+        self.assertEqual((job.remote_history_id, job.remote_job_id, outputs[0].remote_output_id), ('h1', 'j1', 'hda2'))
+        with open(join(self.directory, 'output.txt')) as output:
+            self.assertEqual(output.read(), 'first line\n')
+        # API calls budget of each lifecycle step
+        self.assertEqual([(section, stats['calls']) for section, stats in cassette.stats().items()],
+                         [('prepare_job', 5), ('run_job', 3), ('job_status', 1), ('job_results', 3)])
+        self.assertEqual(cassette.remaining, 0)
+
+
+class GalaxyToolCatalogTestCase(unittest.TestCase):
+    def _tool(self, tool_id, name, section='Alignment', version='1.0', model_class='Tool'):
+        return dict(id=tool_id, name=name, version=version, description='', panel_section_name=section,
+                    model_class=model_class)
+
+    def test_choices_and_lookups(self):
+        catalog = ToolCatalog([self._tool('mafft/7.2', 'MAFFT', version='7.2'), self._tool('clustal', 'Clustal'),
+                               self._tool('upload1', 'Upload', section='Get Data'),
+                               self._tool('data_manager', 'Fetch', model_class='DataManagerTool')])
+        self.assertEqual(len(catalog), 3)
+        self.assertNotIn('data_manager', catalog)
+        self.assertEqual(catalog.get('mafft/7.2').label, 'MAFFT 7.2')
+        self.assertEqual(catalog.choices(exclude_sections=['Get Data']),
+                         [('Alignment', [('clustal', 'Clustal 1.0'), ('mafft/7.2', 'MAFFT 7.2')])])
+        # Repeated strings are shared
+        self.assertIs(catalog.get('clustal').section, catalog.get('mafft/7.2').section)
+        catalog.add(self._tool('clustal', 'Clustal', section='Phylogeny', version='2.0'))
+        catalog.remove('upload1')
+        self.assertEqual(catalog.sections, ['Alignment', 'Phylogeny'])
+        self.assertEqual(catalog.get('clustal').version, '2.0')
+
+
+class GalaxyToolSearchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.catalog = ToolCatalog([
+            dict(id='toolshed/repos/rnateam/mafft/rbc_mafft/7.221.3', name='MAFFT', version='7.221.3',
+                 description='Multiple alignment program for amino acid or nucleotide sequences',
+                 panel_section_name='Alignment', edam_operations=['operation_0492']),
+            dict(id='phyml', name='PhyML', version='3.1', description='Phylogeny software based on Maximum-likelihood',
+                 panel_section_name='Phylogeny', edam_topics=['topic_0084']),
+            dict(id='fastme', name='FastME', version='2.1', description='Distance based phylogeny',
+                 panel_section_name='Phylogeny', edam_topics=['topic_0084']),
+        ])
+
+    def _ids(self, query, **kwargs):
+        return [record.id for record in self.catalog.search(query, **kwargs)]
+
+    def test_prefix_search(self):
+        self.assertEqual(self._ids('maf'), ['toolshed/repos/rnateam/mafft/rbc_mafft/7.221.3'])
+        # Name matches rank first
+        self.assertEqual(self._ids('phy'), ['phyml', 'fastme'])
+        self.assertEqual(self._ids('phylogeny distance'), ['fastme'])
+        # Same score: sorted by name
+        self.assertEqual(self._ids('topic_0084'), ['fastme', 'phyml'])
+        self.assertEqual(self._ids('operation_0492 alignment'), ['toolshed/repos/rnateam/mafft/rbc_mafft/7.221.3'])
+        self.assertEqual(self._ids('phylogeny', exclude_sections=['Phylogeny']), [])
+
+    def test_fuzzy_search(self):
+        self.assertEqual(self._ids('phylogney'), [])
+        self.assertEqual(self._ids('phylogney', fuzzy=True), ['fastme', 'phyml'])
+        self.assertEqual(self._ids('mafff', fuzzy=True), ['toolshed/repos/rnateam/mafft/rbc_mafft/7.221.3'])
+
+    def test_incremental_update(self):
+        self._ids('fast', fuzzy=True)
+        self.catalog.remove('fastme')
+        self.catalog.add(dict(id='fasttree', name='FastTree', version='2.1', panel_section_name='Phylogeny'))
+        self.assertEqual(self._ids('fast'), ['fasttree'])
+        self.assertEqual(self._ids('fastree', fuzzy=True), ['fasttree'])
+        self.assertEqual(self._ids('distance'), [])
+
+
+class GalaxyCatalogSyncTestCase(SharedDirMixin, unittest.TestCase):
+    shed = 'toolshed.g2.bx.psu.edu/repos/rnateam/mafft/rbc_mafft/'
+
+    def setUp(self):
+        super(GalaxyCatalogSyncTestCase, self).setUp()
+        self.tools = [dict(id=self.shed + '7.221.1', name='MAFFT', version='7.221.1', panel_section_name='Alignment'),
+                      dict(id='cat1', name='Concatenate', version='1.0.0', panel_section_name='Text Manipulation'),
+                      dict(id='sort1', name='Sort', version='1.1.0', panel_section_name='Text Manipulation')]
+
+    def _changed(self):
+        return [dict(id=self.shed + '7.221.1', name='MAFFT', version='7.221.1', panel_section_name='Alignment'),
+                dict(id=self.shed + '7.310.0', name='MAFFT', version='7.310.0', panel_section_name='Alignment'),
+                dict(id='cat1', name='Concatenate', version='1.0.1', panel_section_name='Text Manipulation'),
+                dict(id='sort1', name='Sort', version='1.1.0', panel_section_name='Filter and Sort'),
+                dict(id='fastme', name='FastME', version='2.1', panel_section_name='Phylogeny')]
+
+    def test_diff(self):
+        delta = diff_fingerprints(fingerprint(self.tools), fingerprint(self._changed()))
+        self.assertEqual(delta, ToolsDelta(added=['fastme'], removed=[], upgraded=['cat1', self.shed + '7.310.0'],
+                                           moved=['sort1']))
+        self.assertEqual(diff_fingerprints(fingerprint(self._changed()), fingerprint(self.tools)).removed,
+                         ['fastme', self.shed + '7.310.0'])
+
+    def test_catalog_sync(self):
+        catalog = ToolCatalog(self.tools)
+        self.assertEqual([record.id for record in catalog.search('concatenate')], ['cat1'])
+        catalog.sync(self._changed())
+        self.assertEqual(catalog.fingerprint, fingerprint(self._changed()))
+        self.assertEqual([record.id for record in catalog.search('fastme')], ['fastme'])
+        self.assertEqual(catalog.search('concatenate')[0].version, '1.0.1')
+        self.assertEqual(catalog.sync(self._changed()), ToolsDelta([], [], [], []))
+
+    def test_services_drift(self):
+        Service = collections.namedtuple('Service', 'pk remote_service_id version')
+        services = [Service(1, self.shed + '7.221.1', '7.221.1'), Service(2, 'cat1', '1.0.0'),
+                    Service(3, 'sort1', '1.1.0'), Service(4, 'removed1', '1.0')]
+        catalog_sync = CatalogSync('http://galaxy.test', shared_dir=self.shared_dir)
+        self.assertEqual(len(catalog_sync.update(fingerprint(self.tools)).added), 3)
+        self.assertEqual([drift['service_id'] for drift in catalog_sync.check_services(services,
+                                                                                        catalog_sync.previous)], [4])
+        current = fingerprint(self._changed())
+        catalog_sync.update(current)
+        self.assertEqual(catalog_sync.previous, current)
+        catalog_sync.check_services(services[:3], current)
+        self.assertEqual([(drift['service_id'], drift['reason'], drift['remote_version'])
+                          for drift in catalog_sync.drifted], [(1, 'upgraded', '7.310.0'), (2, 'version', '1.0.1')])
+
+
+class GalaxyMinimalPayloadsTestCase(FakeGalaxyMixin, SimpleTestCase):
+    def setUp(self):
+        super(GalaxyMinimalPayloadsTestCase, self).setUp()
+        self.requests = []
+
+    def _get(self, id, params=None):
+        self.requests.append((id, params))
+        return dict(id=id, state='ok', deleted=False, purged=False)
+
+    def get(self, id_, full_details=False):
+        self.requests.append((id_, dict(full=full_details)))
+        return collections.namedtuple('Remote', 'state wrapped')('queued', dict(
+            outputs=dict(out_file1=dict(id='hda2', src='hda'))))
+
+    def test_history_state_only(self):
+        self.assertTrue(self.adaptor._history_ready('history1'))
+        self.assertEqual(self.requests, [('history1', dict(keys='state'))])
+        with self.settings(WAVES_GALAXY={'MINIMAL_PAYLOADS': False}):
+            self.assertFalse(self.adaptor._history_ready('history1'))
+        self.assertEqual(self.requests[1:], [('history1', dict(full=False))])
+
+    def test_outputs_from_run_response(self):
+        data_sets = [dict(id='hda2', name='out', output_name='out_file1')]
+        self.assertEqual(self.adaptor._remote_outputs('job1', data_sets), dict(out_file1=dict(id='hda2', src='hda')))
+        self.assertEqual(self.requests, [])
+        # Outputs names missing from response
+        self.assertEqual(self.adaptor._remote_outputs('job1', [dict(id='hda2', name='out')]),
+                         dict(out_file1=dict(id='hda2', src='hda')))
+        self.assertEqual(self.requests, [('job1', dict(full=True))])
+
+
+class GalaxyBatchBindTestCase(FakeGalaxyMixin, SimpleTestCase):
+    def setUp(self):
+        super(GalaxyBatchBindTestCase, self).setUp()
+        self.working_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.working_dir)
+        self.remote_jobs = dict(job1=dict(inputs=dict(input1=dict(id='hda2', src='hda')), outputs=dict()))
+        self.deleted = []
+
+    id = 'batch1'
+
+    def create(self, name):
+        return self
+
+    def delete_history(self, history_id, purge=False):
+        self.deleted.append((history_id, purge))
+
+    def get(self, id_, full_details=False):
+        if id_ not in self.remote_jobs:
+            raise ConnectionError('Galaxy unreachable')
+        return collections.namedtuple('Remote', 'wrapped')(self.remote_jobs[id_])
+
+    def _job(self, remote_input_id):
+        job = FakeJob(self.working_dir, slug=remote_input_id)
+        job.input_files = [collections.namedtuple('File', 'name remote_input_id')('input1', remote_input_id)]
+        job.status, job.remote_job_id, job.save = JobStatus.JOB_CREATED, None, lambda: None
+        return job
+
+    def test_unbound_jobs_in_error(self):
+        jobs = [self._job('hda1'), self._job('hda2')]
+        # Connection lost while binding second remote job: its WAVES job must not be submitted again
+        self.adaptor._bind_batch(jobs, [dict(input1=job.input_files[0]) for job in jobs],
+                                 dict(jobs=[dict(id='job1'), dict(id='job2')], outputs=[]),
+                                 [JobPhaseTimer(job) for job in jobs])
+        self.assertEqual([(job.remote_job_id, job.status) for job in jobs],
+                         [(None, JobStatus.JOB_ERROR), ('job1', JobStatus.JOB_QUEUED)])
+
+    def test_failed_batch_history_deleted(self):
+        def upload_failed(job, history, timer):
+            raise IOError('disk full')
+
+        jobs = [self._job('hda1'), self._job('hda2')]
+        for job in jobs:
+            job.title = 'batch'
+        self.adaptor._upload_inputs = upload_failed
+        with self.assertRaises(AdaptorJobException):
+            self.adaptor._run_batch(jobs)
+        self.assertEqual(self.deleted, [('batch1', True)])
+        self.assertEqual([job.remote_history_id for job in jobs], [None, None])
+
+    def test_jobs_run_alone_launched_once_prepared(self):
+        launched = []
+        jobs = [self._job('hda1'), self._job('hda2')]
+        for job, saved_status in zip(jobs, (JobStatus.JOB_PREPARED, JobStatus.JOB_ERROR)):
+            job.input_files = []
+            # Prepared status is set in memory whatever run_prepare outcome, saved status tells failures
+            job.run_prepare = lambda job=job: setattr(job, 'status', JobStatus.JOB_PREPARED)
+            job.refresh_from_db = lambda job=job, status=saved_status: setattr(job, 'status', status)
+            job.run_launch = lambda job=job: launched.append(job.slug)
+        self.adaptor.connect = lambda: self
+        self.assertEqual(self.adaptor.run_jobs_batch(jobs), [])
+        self.assertEqual(launched, ['hda1'])
@@ -0,0 +1,141 @@
+""" WAVES side phase timings for jobs run on a remote Galaxy
+
+Timings are saved as json in job working dir, next to WAVES ``job_run_details.json``, so they survive across the
+daemon processes running each job step and may be aggregated later per service.
+"""
+from __future__ import unicode_literals
+
+import calendar
+import json
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from os.path import isdir, isfile, join
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['PHASES', 'PHASE_FILE', 'JobPhaseTimer', 'load_phase_timings', 'aggregate_phase_timings']
+
+#: Json file name for timings, stored in job working dir
+PHASE_FILE = 'job_phase_timings.json'
+
+#: Recorded phases, in job lifecycle order
+PHASES = ('history', 'upload', 'readiness', 'submission', 'queue', 'run', 'download', 'logs')
+
+
+def _galaxy_time_to_epoch(value):
+    """ Convert a Galaxy ISO formatted UTC date ('2018-03-01T16:16:48.640550') to epoch seconds """
+    try:
+        return calendar.timegm(datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S').timetuple())
+    except (TypeError, ValueError):
+        return None
+
+
+class JobPhaseTimer(object):
+    """
+    Record duration for each Galaxy job phase, data is persisted after each recorded phase
+
+    Phases durations are cumulative (e.g: 'upload' is the sum for all uploaded inputs), each upload is also
+    recorded in 'uploads' with its own duration.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.data = load_phase_timings(job)
+
+    @property
+    def file_path(self):
+        return join(self.job.working_dir, PHASE_FILE)
+
+    @contextmanager
+    def phase(self, name, label=None):
+        """ Time enclosed block as phase ``name``, ``label`` is used to detail each upload """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start, label)
+
+    def record(self, name, duration, label=None, cumulative=True):
+        """ Add ``duration`` (in seconds) to phase ``name`` and save """
+        phases = self.data['phases']
+        if cumulative:
+            phases[name] = round(phases.get(name, 0) + duration, 3)
+        else:
+            phases[name] = round(duration, 3)
+        if name == 'upload':
+            self.data['uploads'].append(dict(name=label, duration=round(duration, 3)))
+        self.save()
+
+    def mark(self, event, when=None, replace=False):
+        """ Record once the time when ``event`` first occurred (used to compute queue / run times while polling)
+
+        :param replace: record time even if event already occurred
+        :return: True if mark has been set by this call
+        """
+        if event in self.data['marks'] and not replace:
+            return False
+        self.data['marks'][event] = when or time.time()
+        self.save()
+        return True
+
+    def update_remote_times(self, created, started, finished):
+        """ Compute 'queue' and 'run' phases, prefer Galaxy job metrics, fall back to polling marks """
+        marks = self.data['marks']
+        created = _galaxy_time_to_epoch(created) or marks.get('submitted')
+        started = float(started) if started else marks.get('running')
+        finished = float(finished) if finished else marks.get('finished')
+        if created and started:
+            self.record('queue', max(started - created, 0), cumulative=False)
+        if started and finished:
+            self.record('run', max(finished - started, 0), cumulative=False)
+
+    def save(self):
+        if not isdir(self.job.working_dir):
+            return
+        try:
+            with open(self.file_path, 'w') as fp:
+                json.dump(self.data, fp)
+        except IOError as e:
+            logger.warning('Unable to save phase timings for job %s: %s', self.job.slug, e)
+
+
+def load_phase_timings(job):
+    """ Load previously recorded phase timings for ``job``
+
+    :return: dictionary with keys 'phases' (name: seconds), 'uploads' (list) and 'marks' (event: epoch)
+    """
+    data = dict(phases={}, uploads=[], marks={})
+    file_path = join(job.working_dir, PHASE_FILE)
+    if isfile(file_path):
+        try:
+            with open(file_path) as fp:
+                data.update(json.load(fp))
+        except (IOError, ValueError) as e:
+            logger.warning('Unable to load phase timings from %s: %s', file_path, e)
+    return data
+
+
+def aggregate_phase_timings(jobs):
+    """ Aggregate recorded phase timings per service
+
+    :param jobs: iterable of jobs
+    :return: dictionary {service: {'jobs': nb, 'phases': {phase: {count, total, mean, max}}, 'dominant': phase}}
+    """
+    services = {}
+    for job in jobs:
+        phases = load_phase_timings(job)['phases']
+        if not phases:
+            continue
+        service = services.setdefault(job.service, dict(jobs=0, phases={}, dominant=None))
+        service['jobs'] += 1
+        for name, duration in phases.items():
+            stats = service['phases'].setdefault(name, dict(count=0, total=0, mean=0, max=0))
+            stats['count'] += 1
+            stats['total'] = round(stats['total'] + duration, 3)
+            stats['mean'] = round(stats['total'] / stats['count'], 3)
+            stats['max'] = max(stats['max'], duration)
+    for service in services.values():
+        service['dominant'] = max(service['phases'], key=lambda p: service['phases'][p]['total'])
+    return services
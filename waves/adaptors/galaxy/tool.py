@@ -2,24 +2,84 @@
 from __future__ import unicode_literals
 
 import logging
+import os
+import threading
 import time
-from os.path import join
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from os.path import basename, join
 
-import bioblend
-import requests
-from bioblend.galaxy.client import ConnectionError
-from bioblend.galaxy.objects import GalaxyInstance
+from bioblend import ConnectionError
+from django.utils.module_loading import import_string
+from six.moves.urllib.parse import urljoin
 
 from waves.wcore.adaptors.const import JobStatus, JobRunDetails
 from exception import GalaxyAdaptorConnectionError
+from waves.adaptors.galaxy.admission import RELEASE_LEASE, active_remote_jobs, get_admission_controller
+from waves.adaptors.galaxy.archive import extract_archive, use_archive
+from waves.adaptors.galaxy.breaker import install_breaker, get_breaker, retry_idempotent
+from waves.adaptors.galaxy.cassette import install_cassette
+from waves.adaptors.galaxy.cache import get_metadata_cache, tool_details
+from waves.adaptors.galaxy.health import get_health_monitor
+from waves.adaptors.galaxy.histories import get_history_pool, history_key, job_tag
+from waves.adaptors.galaxy.memo import file_hash, get_result_cache, load_job_memo, memo_key, save_job_memo
+from waves.adaptors.galaxy.poller import get_store
+from waves.adaptors.galaxy.ratelimit import install_limiter
+from waves.adaptors.galaxy.settings import galaxy_settings
+from waves.adaptors.galaxy.timing import JobPhaseTimer
+from waves.adaptors.galaxy.validation import get_validator
 from waves.wcore.adaptors.api import ApiKeyAdaptor
-from waves.wcore.adaptors.exceptions import AdaptorJobException, AdaptorExecException, AdaptorConnectException
-from waves.wcore.models import JobOutput
+from waves.wcore.adaptors.exceptions import AdaptorJobException, AdaptorExecException, AdaptorConnectException, \
+    AdaptorException
+from waves.wcore.exceptions.jobs import JobPrepareException
 
 logger = logging.getLogger(__name__)
 
 __group__ = 'Galaxy'
-__all__ = ['GalaxyJobAdaptor']
+__all__ = ['GalaxyJobAdaptor', 'deferred_readiness']
+
+_deferred = threading.local()
+
+
+@contextmanager
+def deferred_readiness():
+    """ Jobs prepared in current thread within block don't wait for their inputs uploads to complete: check it with
+    :meth:`GalaxyJobAdaptor.inputs_ready` before launching them (see :mod:`waves.adaptors.galaxy.pipeline`)
+    """
+    previous = getattr(_deferred, 'active', False)
+    _deferred.active = True
+    try:
+        yield
+    finally:
+        _deferred.active = previous
+
+
+def _waiting_jobs(slugs):
+    """ Among jobs slugs, those of existing jobs still waiting for their submission to Galaxy """
+    from django.db.models import Q
+    from waves.wcore.models import Job
+
+    return ['%s' % slug for slug in Job.objects.filter(
+        Q(remote_job_id__isnull=True) | Q(remote_job_id=''), slug__in=slugs,
+        _status__in=(JobStatus.JOB_PREPARED, JobStatus.JOB_QUEUED)).values_list('slug', flat=True)]
+
+
+def _collection_inputs(tool_inputs):
+    """ Find data collection inputs in Galaxy tool inputs description (including sections, repeats and conditionals)
+
+    :return: dictionary of collection inputs names with their (first) expected collection type
+    """
+    collections = {}
+    pending = list(tool_inputs)
+    while pending:
+        tool_input = pending.pop()
+        if tool_input.get('type') == 'data_collection':
+            collections[tool_input['name']] = (tool_input.get('collection_types') or ['list'])[0]
+        pending.extend(tool_input.get('inputs', []))
+        for case in tool_input.get('cases', []):
+            pending.extend(case.get('inputs', []))
+    return collections
 
 
 class GalaxyJobAdaptor(ApiKeyAdaptor):
@@ -42,9 +102,28 @@ class GalaxyJobAdaptor(ApiKeyAdaptor):
         running=JobStatus.JOB_RUNNING,
         waiting=JobStatus.JOB_RUNNING,
         error=JobStatus.JOB_ERROR,
-        ok=JobStatus.JOB_COMPLETED
+        ok=JobStatus.JOB_COMPLETED,
+        deleted=JobStatus.JOB_CANCELLED,
+        paused=JobStatus.JOB_SUSPENDED,
+        held=JobStatus.JOB_QUEUED,
+        # Jobs unknown to Galaxy keep their current status, see _job_status
+        created=JobStatus.JOB_CREATED,
+        prepared=JobStatus.JOB_PREPARED,
+        undefined=JobStatus.JOB_UNDEFINED
     )
+    #: Galaxy jobs states where job does not use any resource anymore
+    _stopped_states = ('deleted', 'deleted_new', 'ok', 'error')
+    #: Galaxy datasets states meaning creating (upload) job is not finished
+    _pending_dataset_states = ('new', 'upload', 'queued', 'running', 'paused', 'setting_metadata')
+    #: Galaxy datasets states meaning upload failed
+    _failed_dataset_states = ('error', 'failed_metadata', 'discarded')
     library_dir = ""
+    #: Host wide requests limiter, see :mod:`waves.adaptors.galaxy.ratelimit`
+    limiter = None
+    #: Galaxy host circuit breaker, see :mod:`waves.adaptors.galaxy.breaker`
+    breaker = None
+    #: Recorded session requests are sent to or replayed from, see :mod:`waves.adaptors.galaxy.cassette`
+    cassette = None
 
     def __init__(self, command=None, protocol='http', host="localhost", port='', api_base_path='', api_endpoint='',
                  app_key=None, library_dir="", **kwargs):
@@ -76,8 +155,13 @@ class GalaxyJobAdaptor(ApiKeyAdaptor):
         """ Create a bioblend galaxy object
         :raise: `waves.wcore.adaptors.addons.adaptors.galaxy.exception.GalaxyAdaptorConnectionError`
         """
+        from bioblend.galaxy.objects import GalaxyInstance
+
         try:
             self.connector = GalaxyInstance(url=self.complete_url, api_key=self.app_key)
+            self.cassette = install_cassette(self.connector.gi, self.complete_url)
+            self.limiter = install_limiter(self.connector.gi, self.complete_url)
+            self.breaker = install_breaker(self.connector.gi, self.complete_url)
         except ConnectionError as exc:
             self._connected = False
             raise GalaxyAdaptorConnectionError(exc)
@@ -92,145 +176,767 @@ class GalaxyJobAdaptor(ApiKeyAdaptor):
             - upload job input files to galaxy in this newly created history
             - associate uploaded files galaxy id with input
         """
-        import os
+        timer = JobPhaseTimer(job)
+        if self._start_prepare(job, timer):
+            if getattr(_deferred, 'active', False):
+                job.message = 'Job prepared with %i args, uploads in progress' % job.job_inputs.count()
+                return job
+            try:
+                # PATCH wait for upload complete completion (history state ok)
+                self._wait_ready(lambda: self._inputs_ready(job), timer)
+            except ConnectionError as e:
+                exc = GalaxyAdaptorConnectionError(e)
+                job.message = exc.message
+                raise exc
+            job.message = 'Job prepared with %i args ' % job.job_inputs.count()
+            logger.debug(u'History initialized [galaxy_history_id: %s]', job.slug)
+        return job
+
+    def _start_prepare(self, job, timer):
+        """ Create job history and upload its input files, without waiting for uploads to complete
+
+        :return: False if there is nothing to wait for (job reuses previous results, or ``FAST_SUBMIT`` is set)
+        """
         try:
-            history = self.connector.histories.create(name=job.title)
+            self._validate(job)
+            if self._memo_lookup(job):
+                job.remote_history_id = load_job_memo(job)['hit']['history_id']
+                job.message = 'Job prepared, reusing results of an identical previous job'
+                return False
+            with timer.phase('history'):
+                history = self._job_history(job)
             job.remote_history_id = history.id
             logger.debug(u'New galaxy history to ' + history.id)
             if len(job.input_files) == 0:
                 logger.info("No inputs files for galaxy service ??? %s ", job)
-            for job_input_file in job.input_files:
-                file_full_path = os.path.join(job.working_dir, job_input_file.value)
-                upload = history.upload_file(file_full_path, file_name=job_input_file.name)
-                job_input_file.remote_input_id = upload.id
-                logger.debug('Remote data id %s for %s (%s)', job_input_file.remote_input_id, job_input_file.name,
-                             job_input_file.value)
-            # PATCH wait for upload complete completion (history state ok)
-            state_history = self.connector.histories.get(id_=str(job.remote_history_id))
-            # FIXME : to not wait until the end of time !
-            t0 = time.clock()
-            max_time = 360
-            while state_history.state != 'ok' and time.clock() - t0 < max_time:
-                time.sleep(2.5)
-                state_history = self.connector.histories.get(id_=str(job.remote_history_id))
-            if state_history.state != 'ok':
-                raise AdaptorExecException('Maximum time reached to prepare job')
-            job.message = 'Job prepared with %i args ' % job.job_inputs.count()
-            logger.debug(u'History initialized [galaxy_history_id: %s]', job.slug)
-            return job
-        except bioblend.galaxy.client.ConnectionError as e:
+            self._upload_inputs(job, history, timer)
+            self._tag_datasets(job, [job_input_file.remote_input_id for job_input_file in job.input_files])
+            if galaxy_settings.FAST_SUBMIT:
+                job.message = 'Job prepared with %i args, uploads in progress' % job.job_inputs.count()
+                return False
+            return True
+        except ConnectionError as e:
             exc = GalaxyAdaptorConnectionError(e)
             job.message = exc.message
             raise exc
         except IOError as e:
             raise AdaptorJobException('File upload error %s' % e.message)
 
+    def _validate(self, job):
+        """ Check job params against tool inputs description, before any remote work (see ``VALIDATE`` setting)
+
+        :raise: :class:`waves.wcore.exceptions.jobs.JobPrepareException` if job params are invalid
+        """
+        if not galaxy_settings.VALIDATE:
+            return
+        galaxy_tool = tool_details(self.connector, self.complete_url, self.command, io_details=True)
+        metadata_cache = get_metadata_cache(self.complete_url)
+        validator = get_validator(self.complete_url, self.command, galaxy_tool.version,
+                                  lambda: galaxy_tool.wrapped.get('inputs', []),
+                                  metadata_cache.tool_generation(self.command) if metadata_cache is not None else 0)
+        errors = validator.errors(self._tool_params(job), [job_input_file.name for job_input_file in job.input_files])
+        if errors:
+            raise JobPrepareException('Invalid params for %s: %s' % (self.command, '; '.join(errors)), job)
+
+    def _job_history(self, job):
+        """ New history for job, or current shared history for job user / service (see ``HISTORY`` setting) """
+        pool = get_history_pool(self.complete_url, self.app_key)
+        if pool is None:
+            return self.connector.histories.create(name=job.title)
+        key = history_key(galaxy_settings.HISTORY['strategy'], job, self.command)
+        datasets = len(job.input_files) + job.outputs.count()
+        while True:
+            history = self._history(
+                pool.reserve(key, datasets, lambda: self.connector.histories.create(name='WAVES %s' % key).id))
+            if not history.deleted:
+                return history
+            logger.warning('Shared history %s for %s deleted on Galaxy', history.id, key)
+            pool.discard(key, history.id)
+
+    def _history(self, history_id):
+        """ History wrapper, without its contents list with ``MINIMAL_PAYLOADS`` """
+        from bioblend.galaxy.objects import wrappers
+
+        if galaxy_settings.MINIMAL_PAYLOADS:
+            return wrappers.History(self.connector.gi.histories._get(id=str(history_id),
+                                                                     params=dict(keys='id,name,deleted')),
+                                    gi=self.connector)
+        return self.connector.histories.get(id_=str(history_id))
+
+    def _tag_datasets(self, job, data_set_ids):
+        """ Tag job datasets with job slug in shared histories """
+        if get_history_pool(self.complete_url, self.app_key) is None:
+            return
+        for data_set_id in data_set_ids:
+            self.connector.gi.histories.update_dataset(job.remote_history_id, data_set_id, tags=[job_tag(job)])
+
+    def _upload_inputs(self, job, history, timer):
+        """ Upload job input files to history, associate uploaded files galaxy id with input """
+        for job_input_file in job.input_files:
+            file_full_path = join(job.working_dir, job_input_file.value)
+            with timer.phase('upload', label=job_input_file.name):
+                if galaxy_settings.MINIMAL_PAYLOADS:
+                    # History wrapper upload refreshes whole history, then retrieves uploaded dataset description
+                    upload_id = self.connector.gi.tools.upload_file(file_full_path, history.id,
+                                                                    file_name=job_input_file.name)['outputs'][0]['id']
+                else:
+                    upload_id = history.upload_file(file_full_path, file_name=job_input_file.name).id
+            job_input_file.remote_input_id = upload_id
+            job_input_file.save()
+            logger.debug('Remote data id %s for %s (%s)', job_input_file.remote_input_id, job_input_file.name,
+                         job_input_file.value)
+
+    def _wait_ready(self, ready, timer, max_time=360):
+        """ Wait for uploads to complete
+
+        :param ready: callable checking once whether uploads are complete
+        :raise: :class:`waves.wcore.adaptors.exceptions.AdaptorExecException` if not ready after ``max_time`` seconds
+        """
+        with timer.phase('readiness'):
+            t0 = time.time()
+            while not ready():
+                if time.time() - t0 >= max_time:
+                    raise AdaptorExecException('Maximum time reached to prepare job')
+                time.sleep(2.5)
+
+    def inputs_ready(self, job):
+        """ Check once whether a job prepared with :func:`deferred_readiness` can be launched: its inputs uploads
+        are complete, or it doesn't need them (results reused from a previous job, ``FAST_SUBMIT`` setting)
+
+        :raise: :class:`waves.adaptors.galaxy.exception.GalaxyAdaptorConnectionError` if Galaxy is not reachable
+        :raise: :class:`waves.wcore.adaptors.exceptions.AdaptorExecException` if an upload failed
+        """
+        if galaxy_settings.FAST_SUBMIT or load_job_memo(job).get('hit'):
+            return True
+        self.connect()
+        try:
+            return self._inputs_ready(job)
+        except ConnectionError as e:
+            raise GalaxyAdaptorConnectionError(e)
+
+    def _inputs_ready(self, job):
+        """ Check once whether job inputs uploads are complete: job history state when job has its own history,
+        job input datasets states in a shared history
+
+        :raise: :class:`waves.wcore.adaptors.exceptions.AdaptorExecException` if an upload failed
+        """
+        if get_history_pool(self.complete_url, self.app_key) is None:
+            return self._history_ready(job.remote_history_id)
+        states = dict((job_input_file.name, self._data_set(job_input_file.remote_input_id)['state'])
+                      for job_input_file in job.input_files)
+        failed = [name for name, state in states.items() if state in self._failed_dataset_states]
+        if failed:
+            raise AdaptorExecException('Input files upload failed: %s' % ', '.join(sorted(failed)))
+        return all(state == 'ok' for state in states.values())
+
+    def _history_ready(self, history_id):
+        """ Check once whether all history datasets are ready
+
+        :raise: :class:`waves.wcore.adaptors.exceptions.AdaptorExecException` if an upload failed
+        """
+        state = self._history_state(history_id)
+        if state == 'error':
+            raise AdaptorExecException('Input files upload failed in history %s' % history_id)
+        return state == 'ok'
+
+    def _history_state(self, history_id):
+        """ History state, only requesting this field with ``MINIMAL_PAYLOADS`` (full history description and
+        contents list otherwise)
+        """
+        if galaxy_settings.MINIMAL_PAYLOADS:
+            return self.connector.gi.histories._get(id=str(history_id), params=dict(keys='state'))['state']
+        return self.connector.histories.get(id_=str(history_id)).state
+
+    def _data_set(self, data_set_id, keys=('state',)):
+        """ History dataset description, restricted to ``keys`` fields with ``MINIMAL_PAYLOADS`` """
+        if galaxy_settings.MINIMAL_PAYLOADS:
+            return self.connector.gi.datasets._get(id=data_set_id, params=dict(hda_ldda='hda', keys=','.join(keys)))
+        return self.connector.gi.datasets.show_dataset(data_set_id)
+
     def _run_job(self, job):
         """
-        Launch the job with current parameters from associated history
+        Launch the job with current parameters from associated history, or hold it in local backlog if Galaxy
+        already has too many active jobs (see :mod:`waves.adaptors.galaxy.admission`)
         Args:
             job:
         """
+        memo = load_job_memo(job)
+        if memo.get('hit'):
+            return self._reuse_result(job, memo['hit'])
+        if not self._admit(job):
+            job.message = "Job held, waiting for Galaxy queue to free up"
+            job.logger.info('Job held in local backlog for %s', self.complete_url)
+            return job
+        return self._submit_job(job)
+
+    def _admit(self, job, lease=0):
+        controller = get_admission_controller(self.complete_url)
+        if controller is None:
+            return True
+        controller.prune(_waiting_jobs, min_interval=controller.load_ttl)
+        priority = import_string(galaxy_settings.ADMISSION.get('priority') or
+                                 'waves.adaptors.galaxy.admission.default_priority')
+        return controller.admit('%s' % job.slug, priority(job), lambda: active_remote_jobs(self.connector.gi),
+                                lease=lease)
+
+    def _held(self, job):
+        """ Tell whether job is held in local backlog """
+        controller = get_admission_controller(self.complete_url)
+        return controller is not None and controller.holds('%s' % job.slug)
+
+    def release_held(self, job):
+        """ Submit job held in local backlog if Galaxy has room for it now. Job leaves backlog only once
+        submitted, it is held again if submission fails. Caller saves job.
+
+        :param job: queued job, not yet submitted
+        :return: True if job was submitted
+        """
+        if job.remote_job_id or not self._held(job):
+            return False
+        self.connect()
+        if not self._admit(job, lease=RELEASE_LEASE):
+            return False
+        controller = get_admission_controller(self.complete_url)
+        try:
+            self._submit_job(job)
+        except Exception:
+            controller.requeue('%s' % job.slug)
+            raise
+        controller.remove('%s' % job.slug)
+        job.logger.info('Job released from local backlog')
+        return True
+
+    @property
+    def backlog(self):
+        """ Jobs held locally before submission to Galaxy, in admission order """
+        controller = get_admission_controller(self.complete_url)
+        return controller.backlog if controller is not None else []
+
+    def _submit_job(self, job):
+        """ Run Galaxy tool for job """
+        from requests.exceptions import RequestException
+
         try:
-            history = self.connector.histories.get(id_=str(job.remote_history_id))
-            logger.debug("First attempts %s ", history.state)
-            if history.state == 'ok':
-                galaxy_tool = self.connector.tools.get(id_=self.command)
+            if self._inputs_ready(job) or galaxy_settings.FAST_SUBMIT:
+                galaxy_tool = tool_details(self.connector, self.complete_url, self.command, io_details=True)
                 if galaxy_tool and type(galaxy_tool) is not list:
                     logger.debug('Galaxy tool %s', galaxy_tool)
-                    inputs = {}
-                    for input_file in job.input_files:
-                        inputs[input_file.remote_input_id] = input_file.name
-
-                    for input_param in job.input_params:
-                        if input_param.value != 'None' and input_param.value is not None:
-                            inputs[input_param.name] = input_param.value
+                    inputs = self._file_inputs(job, job.remote_history_id,
+                                               _collection_inputs(galaxy_tool.wrapped.get('inputs', [])))
+                    inputs.update(self._tool_params(job))
                     logger.debug(u'Inputs added ' + str(inputs))
-                    output_data_sets = galaxy_tool.run(inputs, history=history, wait=False)
-                    for data_set in output_data_sets:
-                        job.remote_job_id = data_set.wrapped['creating_job']
-                        logger.debug(u'Job ID ' + job.remote_job_id)
-                        break
-                    remote_job = self.connector.jobs.get(job.remote_job_id, full_details=True)
-                    logger.debug('Job info %s', remote_job)
-                    remote_outputs = remote_job.wrapped['outputs']
-                    for remote_output in remote_outputs:
-                        output_data = remote_outputs[remote_output]
-                        logger.debug('Current output %s', remote_output)
-                        logger.debug('Remote output details %s', output_data)
-                        logger.debug('Remote output id %s', output_data['id'])
-
-                        job_output = next((x for x in job.outputs.all() if x.api_name == remote_output), None)
-                        if job_output is not None:
-                            job_output.remote_output_id = str(output_data['id'])
-                            job_output.save()
-                        else:
-                            logger.warn('Unable to retrieve job output in job description ! [%s]', remote_output)
-                            logger.info('Searched in %s', [x.name + "/" + x.api_name for x in job.outputs.all()])
-                            job.outputs.add(JobOutput.objects.create(_name=remote_output,
-                                                                     job=job,
-                                                                     remote_output_id=output_data['id']))
-                    for data_set in output_data_sets:
-                        logger.debug('Dataset Info %s', data_set)
-                        job_output = next((x for x in job.outputs.all() if x.remote_output_id == data_set.id), None)
-                        if job_output is not None:
-                            logger.debug("Dataset updates job output %s with %s, %s",
-                                         job_output,
-                                         data_set.name,
-                                         data_set.file_ext
-                                         )
-                            job_output.value = data_set.name
-                            job_output.extension = data_set.file_ext
-                            job_output.save()
-                            logger.debug(u'Output value updated [%s - %s]' % (
-                                data_set.id, '.'.join([data_set.name, data_set.file_ext])))
+                    timer = JobPhaseTimer(job)
+                    with timer.phase('submission'):
+                        response = self._run_tool(job.remote_history_id, inputs)
+                    timer.mark('submitted')
+                    job.remote_job_id = response['jobs'][0]['id']
+                    logger.debug(u'Job ID ' + job.remote_job_id)
+                    self._bind_outputs(job, self._remote_outputs(job.remote_job_id, response['outputs']),
+                                       response['outputs'])
+                    self._tag_datasets(job, [data_set['id'] for data_set in response['outputs']])
                     job.message = "Job queued"
                     return job
                 else:
                     raise AdaptorExecException(None, 'Unable to retrieve associated tool %s' % self.command)
             else:
                 raise AdaptorExecException(None, 'History not ready %s' % self.command)
-        except requests.exceptions.RequestException as e:
+        except RequestException as e:
             # TODO Manage specific Exception to be more precise
             job.message = 'Error in request for run %s ' % e.message
             raise AdaptorConnectException(e, 'RequestError')
-        except bioblend.galaxy.client.ConnectionError as e:
-            job.message = 'Connexion error for run %s:%s', (e.message, e.body)
-            raise GalaxyAdaptorConnectionError(e)
+        except ConnectionError as e:
+            exc = GalaxyAdaptorConnectionError(e)
+            job.message = 'Connexion error for run %s' % exc.message
+            raise exc
+
+    def _remote_outputs(self, remote_job_id, data_sets):
+        """ Galaxy job 'outputs' dictionary (output name: dict(id, src)), built from tool run response output
+        datasets with ``MINIMAL_PAYLOADS`` (retrieved from job full details otherwise, or for Galaxy versions not
+        naming them)
+        """
+        if galaxy_settings.MINIMAL_PAYLOADS and data_sets and all('output_name' in data_set for data_set in data_sets):
+            return dict((data_set['output_name'], dict(id=data_set['id'], src='hda')) for data_set in data_sets)
+        remote_job = self.connector.jobs.get(remote_job_id, full_details=True)
+        logger.debug('Job info %s', remote_job)
+        return remote_job.wrapped['outputs']
+
+    def _run_tool(self, history_id, inputs):
+        """ Post tool run request, asking Galaxy to reuse an equivalent job if enabled in ``MEMO`` settings
+
+        :return: Galaxy response, with created 'jobs' and 'outputs' datasets
+        """
+        payload = dict(history_id=history_id, tool_id=self.command, inputs=inputs)
+        if (galaxy_settings.MEMO or {}).get('use_cached_job'):
+            payload['use_cached_job'] = True
+        return self.connector.gi.tools._tool_post(payload)
+
+    def _memo_lookup(self, job):
+        """ Look for results of an identical previous job, record memoisation key (and hit) for job
+
+        :return: True if previous results are still available on Galaxy
+        """
+        results = get_result_cache(self.complete_url, self.app_key)
+        if results is None:
+            return False
+        tool_version = tool_details(self.connector, self.complete_url, self.command).version
+        key = memo_key(self.command, tool_version,
+                       [(job_input_file.name, file_hash(join(job.working_dir, job_input_file.value)))
+                        for job_input_file in job.input_files],
+                       self._tool_params(job))
+        previous = results.get(key)
+        if previous is not None and not self._remote_result_available(previous):
+            logger.info('Results of job %s no longer available on Galaxy', previous['remote_job_id'])
+            results.invalidate(key)
+            previous = None
+        save_job_memo(job, dict(key=key, tool_version=tool_version, hit=previous))
+        return previous is not None
+
+    def _remote_result_available(self, previous):
+        if self.connector.gi.jobs.show_job(previous['remote_job_id'])['state'] != 'ok':
+            return False
+        for data_set_id in previous['outputs'].values():
+            data_set = self._data_set(data_set_id, keys=('state', 'deleted', 'purged'))
+            if data_set.get('deleted') or data_set.get('purged') or data_set.get('state') != 'ok':
+                return False
+        return True
+
+    def _reuse_result(self, job, previous):
+        """ Bind job to previous remote job and its outputs, results are downloaded as for any other job """
+        job.remote_job_id = previous['remote_job_id']
+        for job_output in job.outputs.all():
+            job_output.remote_output_id = previous['outputs'].get(job_output.api_name)
+            job_output.save()
+        JobPhaseTimer(job).mark('submitted')
+        job.message = "Job results reused from Galaxy job %s" % previous['remote_job_id']
+        job.logger.info('Identical job found, reuse Galaxy job %s results', previous['remote_job_id'])
+        return job
+
+    def _memo_store(self, job, remote_job):
+        """ Record successful job results for next identical jobs """
+        results = get_result_cache(self.complete_url, self.app_key)
+        memo = load_job_memo(job)
+        if results is None or not memo.get('key') or memo.get('hit') or remote_job.wrapped.get('exit_code'):
+            return
+        results.store(memo['key'], self.command, memo['tool_version'], job.remote_job_id, job.remote_history_id,
+                      dict((job_output.api_name, job_output.remote_output_id) for job_output in job.outputs.all()
+                           if job_output.remote_output_id))
+
+    @staticmethod
+    def _tool_params(job):
+        """ Job (non file) input params, as expected for Galaxy tool inputs """
+        inputs = {}
+        for input_param in job.input_params:
+            if input_param.value != 'None' and input_param.value is not None:
+                inputs[input_param.name] = input_param.value
+        return inputs
+
+    def _bind_outputs(self, job, remote_outputs, data_sets):
+        """ Associate Galaxy job outputs with job expected outputs, create missing ones
+
+        :param remote_outputs: Galaxy job 'outputs' dictionary (output name: dict(id, src))
+        :param data_sets: Galaxy output datasets dictionaries (with 'id', 'name' and 'file_ext' or 'extension')
+        """
+        from waves.wcore.models import JobOutput
+
+        for remote_output in remote_outputs:
+            output_data = remote_outputs[remote_output]
+            logger.debug('Current output %s', remote_output)
+            logger.debug('Remote output details %s', output_data)
+            logger.debug('Remote output id %s', output_data['id'])
+
+            job_output = next((x for x in job.outputs.all() if x.api_name == remote_output), None)
+            if job_output is not None:
+                job_output.remote_output_id = str(output_data['id'])
+                job_output.save()
+            else:
+                logger.warn('Unable to retrieve job output in job description ! [%s]', remote_output)
+                logger.info('Searched in %s', [x.name + "/" + x.api_name for x in job.outputs.all()])
+                job.outputs.add(JobOutput.objects.create(_name=remote_output,
+                                                         job=job,
+                                                         remote_output_id=output_data['id']))
+        for data_set in data_sets:
+            logger.debug('Dataset Info %s', data_set)
+            file_ext = data_set.get('file_ext', data_set.get('extension'))
+            job_output = next((x for x in job.outputs.all() if x.remote_output_id == data_set['id']), None)
+            if job_output is not None:
+                logger.debug("Dataset updates job output %s with %s, %s", job_output, data_set['name'], file_ext)
+                job_output.value = data_set['name']
+                job_output.extension = file_ext
+                job_output.save()
+                logger.debug(u'Output value updated [%s - %s]' % (data_set['id'], '.'.join([data_set['name'],
+                                                                                             file_ext])))
+
+    def _file_inputs(self, job, history_id, collection_inputs):
+        """ Map uploaded job input files to Galaxy tool inputs
+
+        Files for a tool collection input are grouped in a new dataset collection, created in one call, so that
+        Galaxy runs tool once over the whole collection. Several files for a simple data input are passed together.
+
+        :param collection_inputs: dictionary of tool collection inputs names, with their collection type
+        :return: tool inputs dictionary
+        """
+        grouped = OrderedDict()
+        for input_file in job.input_files:
+            grouped.setdefault(input_file.name, []).append(input_file)
+        inputs = {}
+        for name, input_files in grouped.items():
+            if name in collection_inputs:
+                inputs[name] = dict(src='hdca', id=self._create_collection(history_id, name, collection_inputs[name],
+                                                                           input_files))
+            elif len(input_files) > 1:
+                inputs[name] = dict(values=[dict(src='hda', id=input_file.remote_input_id)
+                                            for input_file in input_files])
+            else:
+                inputs[name] = dict(src='hda', id=input_files[0].remote_input_id)
+        return inputs
+
+    def _create_collection(self, history_id, name, collection_type, input_files):
+        """ Create a 'list' or 'paired' dataset collection in history from uploaded input files
+
+        :return: created collection id
+        """
+        if collection_type == 'paired':
+            if len(input_files) != 2:
+                raise AdaptorJobException('Paired collection %s expects 2 files, got %i' % (name, len(input_files)))
+            element_names = ['forward', 'reverse']
+        elif collection_type == 'list':
+            element_names = []
+            for input_file in input_files:
+                element_name = basename(input_file.value)
+                while element_name in element_names:
+                    element_name = '_' + element_name
+                element_names.append(element_name)
+        else:
+            raise AdaptorJobException('Unmanaged collection type %s for input %s' % (collection_type, name))
+        collection = self.connector.gi.histories.create_dataset_collection(history_id, dict(
+            name=name,
+            collection_type=collection_type,
+            element_identifiers=[dict(name=identifier, src='hda', id=input_file.remote_input_id)
+                                 for identifier, input_file in zip(element_names, input_files)]))
+        logger.debug('Created %s collection %s for %s', collection_type, collection['id'], name)
+        return collection['id']
+
+    def run_jobs_batch(self, jobs):
+        """ Prepare and run several jobs for this adaptor tool at once
+
+        Jobs with the same params values, differing only by their input files (one file per input), share one
+        Galaxy history and are submitted in a single tool request using Galaxy batch mode: Galaxy creates one remote
+        job per set of input files, each remote job and its outputs are then associated back with its WAVES job.
+        Jobs join a batch once they passed the same checks as single jobs: params validation, results memoisation
+        lookup (jobs reusing previous results are not submitted) and admission control.
+        Other jobs, or jobs from a batch which could not be submitted, are prepared and launched one by one as usual.
+
+        :param jobs: list of jobs in 'created' status
+        :return: list of jobs submitted in a batch
+        """
+        self.connect()
+        groups = OrderedDict()
+        for job in jobs:
+            groups.setdefault(self._batch_key(job), []).append(job)
+        batched = []
+        for key, group in groups.items():
+            alone = group
+            if key is not None and len(group) > 1:
+                members = [job for job in group if self._batch_ready(job)]
+                if len(members) > 1:
+                    members = [job for job in members if self._admit(job)]
+                if len(members) > 1:
+                    try:
+                        self._run_batch(members)
+                        batched.extend(members)
+                        alone = [job for job in group if job not in members]
+                    except AdaptorException as e:
+                        logger.warning('Batch submission failed for %i jobs, run them one by one: %s', len(members),
+                                       e)
+            for job in alone:
+                job.run_prepare()
+                # Job run actions save job before setting their final status, whatever their outcome
+                job.refresh_from_db()
+                if job.status == JobStatus.JOB_PREPARED:
+                    job.run_launch()
+        return batched
+
+    def _batch_key(self, job):
+        """ Key grouping jobs compatible for a batch submission, None if job can't be part of a batch """
+        if job.status > JobStatus.JOB_CREATED:
+            return None
+        input_names = [input_file.name for input_file in job.input_files]
+        if not input_names or len(set(input_names)) != len(input_names):
+            return None
+        return tuple(sorted(input_names)), tuple(sorted(self._tool_params(job).items()))
+
+    def _batch_ready(self, job):
+        """ Check job params and look for previous results to reuse, as for a single job submission
+
+        :return: False if job must be prepared and launched on its own (invalid params are then reported)
+        """
+        try:
+            self._validate(job)
+            return not self._memo_lookup(job)
+        except (JobPrepareException, ConnectionError) as e:
+            logger.debug('Job %s left out of batch: %s', job.slug, e)
+            return False
+
+    def _run_batch(self, jobs):
+        """ Upload all jobs inputs in one history and submit them in one Galaxy batch tool run
+
+        :raise: :class:`waves.wcore.adaptors.exceptions.AdaptorException` if batch could not be submitted (jobs may
+            then be run one by one, batch history is deleted). Once Galaxy created the batch jobs, errors are reported
+            on jobs instead, see :meth:`_bind_batch`
+        """
+        history = None
+        try:
+            try:
+                timers = [JobPhaseTimer(job) for job in jobs]
+                start = time.time()
+                history = self.connector.histories.create(name='%s (batch of %i)' % (jobs[0].title, len(jobs)))
+                for job, timer in zip(jobs, timers):
+                    timer.record('history', time.time() - start)
+                    job.remote_history_id = history.id
+                    self._upload_inputs(job, history, timer)
+                start = time.time()
+                self._wait_ready(lambda: self._history_ready(history.id), timers[0])
+                for timer in timers[1:]:
+                    timer.record('readiness', time.time() - start)
+                jobs_files = [dict((input_file.name, input_file) for input_file in job.input_files) for job in jobs]
+                inputs = dict((name, dict(batch=True, values=[dict(src='hda', id=job_files[name].remote_input_id)
+                                                              for job_files in jobs_files]))
+                              for name in jobs_files[0])
+                inputs.update(self._tool_params(jobs[0]))
+                logger.debug(u'Batch inputs %s', inputs)
+                start = time.time()
+                response = self._run_tool(history.id, inputs)
+            except ConnectionError as e:
+                raise GalaxyAdaptorConnectionError(e)
+            except IOError as e:
+                raise AdaptorJobException('Batch submission error %s' % e)
+        except AdaptorException:
+            if history is not None:
+                self._delete_batch_history(jobs, history.id)
+            raise
+        for timer in timers:
+            timer.record('submission', time.time() - start)
+        self._bind_batch(jobs, jobs_files, response, timers)
+
+    def _delete_batch_history(self, jobs, history_id):
+        """ Delete and purge history of a batch not submitted, with its uploaded datasets: jobs run one by one
+        upload their inputs again in their own history
+        """
+        for job in jobs:
+            job.remote_history_id = None
+        try:
+            self.connector.gi.histories.delete_history(history_id, purge=True)
+        except ConnectionError as e:
+            logger.warning('Unable to delete batch history %s: %s', history_id, GalaxyAdaptorConnectionError(e))
+
+    def _bind_batch(self, jobs, jobs_files, response, timers):
+        """ Associate Galaxy jobs created by a batch tool run back with their WAVES jobs, through their inputs
+        datasets (Galaxy may create jobs in any order)
+
+        Jobs left without a remote job (unexpected jobs count, connection lost meanwhile) are set in error: their
+        inputs may already be processed on Galaxy, they must not be submitted again.
+        """
+        if len(response.get('jobs', [])) != len(jobs):
+            logger.warning('Batch submission created %i jobs, %i expected', len(response.get('jobs', [])), len(jobs))
+        jobs_by_input = dict((input_file.remote_input_id, index) for index, job_files in enumerate(jobs_files)
+                             for input_file in job_files.values())
+        unbound = list(range(len(jobs)))
+        try:
+            for remote_job in response.get('jobs', []):
+                # Default job description lists its inputs and outputs, full details add its command line, logs...
+                details = self.connector.jobs.get(remote_job['id'],
+                                                  full_details=not galaxy_settings.MINIMAL_PAYLOADS).wrapped
+                index = next((jobs_by_input[remote_input['id']] for remote_input in details.get('inputs', {}).values()
+                              if remote_input['id'] in jobs_by_input), None)
+                if index not in unbound:
+                    logger.warning('Galaxy job %s from batch does not match any pending job', remote_job['id'])
+                    continue
+                job = jobs[index]
+                job.remote_job_id = remote_job['id']
+                output_ids = [output['id'] for output in details['outputs'].values()]
+                self._bind_outputs(job, details['outputs'],
+                                   [output for output in response.get('outputs', []) if output['id'] in output_ids])
+                timers[index].mark('submitted')
+                job.message = "Job queued (batch of %i)" % len(jobs)
+                job.status = JobStatus.JOB_QUEUED
+                job.save()
+                unbound.remove(index)
+        except ConnectionError as e:
+            logger.error('Batch jobs association interrupted: %s', GalaxyAdaptorConnectionError(e))
+        for index in unbound:
+            job = jobs[index]
+            job.message = 'No Galaxy job found for job inputs after batch submission'
+            job.status = JobStatus.JOB_ERROR
+            job.save()
+
+    def cancel_jobs(self, jobs, purge=None):
+        """ Cancel several jobs in one pass, e.g. for admin cleanups
+
+        Cancellation requests are sent for all jobs first, then their remote states are checked together. Jobs
+        confirmed stopped on Galaxy are set to 'cancelled'.
+
+        :param jobs: list of jobs to cancel
+        :param purge: purge jobs datasets, defaults to ``galaxy_settings.CANCEL['purge']``
+        :return: list of jobs which could not be cancelled
+        """
+        self.connect()
+        failed = self._cancel_remote(jobs, purge)
+        for job in jobs:
+            if job not in failed:
+                job.message = 'Job cancelled'
+                job.status = JobStatus.JOB_CANCELLED
+                job.save()
+        return failed
 
     def _cancel_job(self, job):
-        """ Jobs cannot be cancelled for Galaxy runners
+        """ Stop remote job and pending upload jobs in its history, optionally purge its datasets
+
+        :raise: :class:`waves.wcore.adaptors.exceptions.AdaptorJobException` if remote jobs are still active
         """
-        pass
+        controller = get_admission_controller(self.complete_url)
+        if controller is not None:
+            controller.remove('%s' % job.slug)
+        if self._cancel_remote([job]):
+            raise AdaptorJobException('Galaxy job %s still active after cancellation' % job.remote_job_id)
+
+    def _cancel_remote(self, jobs, purge=None):
+        """ Send cancellation requests for jobs, wait for Galaxy to confirm they are stopped
+
+        :return: list of jobs not confirmed stopped
+        """
+        config = galaxy_settings.CANCEL or {}
+        purge = config.get('purge', False) if purge is None else purge
+        failed, pending = [], []
+        for job in jobs:
+            try:
+                remote_ids = self._pending_upload_jobs(job)
+                if job.remote_job_id:
+                    remote_ids.append(job.remote_job_id)
+                for remote_id in remote_ids:
+                    self.connector.gi.jobs._delete(id=remote_id)
+                pending.append((job, remote_ids))
+                job.logger.info('Cancellation requested for Galaxy jobs %s', ', '.join(remote_ids))
+            except ConnectionError as e:
+                logger.warning('Unable to cancel job %s on Galaxy: %s', job.slug, GalaxyAdaptorConnectionError(e))
+                failed.append(job)
+        deadline = time.time() + config.get('confirm_timeout', 30)
+        while pending:
+            still_pending = []
+            for job, remote_ids in pending:
+                try:
+                    states = [retry_idempotent(self.connector.gi.jobs.show_job, remote_id)['state']
+                              for remote_id in remote_ids]
+                except ConnectionError as e:
+                    logger.warning('Unable to check job %s state on Galaxy: %s', job.slug, e)
+                    states = [None]
+                if all(state in self._stopped_states for state in states):
+                    if purge:
+                        self._purge_datasets(job)
+                else:
+                    still_pending.append((job, remote_ids))
+            pending = still_pending
+            if pending and time.time() < deadline:
+                time.sleep(2.5)
+            else:
+                break
+        failed.extend(job for job, _ in pending)
+        return failed
+
+    def _pending_upload_jobs(self, job):
+        """ Galaxy ids of upload jobs for job inputs not finished yet """
+        upload_jobs = []
+        for job_input_file in job.input_files:
+            if job_input_file.remote_input_id:
+                data_set = self.connector.gi.datasets.show_dataset(job_input_file.remote_input_id)
+                if data_set.get('state') in self._pending_dataset_states and data_set.get('creating_job'):
+                    upload_jobs.append(data_set['creating_job'])
+        return upload_jobs
+
+    def _purge_datasets(self, job):
+        """ Delete and purge job inputs and outputs datasets from Galaxy """
+        if load_job_memo(job).get('hit'):
+            # Datasets belong to a previous job
+            return
+        data_set_ids = [job_input_file.remote_input_id for job_input_file in job.input_files] + \
+                       [job_output.remote_output_id for job_output in job.outputs.all()]
+        for data_set_id in [data_set_id for data_set_id in data_set_ids if data_set_id]:
+            try:
+                self.connector.gi.histories.delete_dataset(job.remote_history_id, data_set_id, purge=True)
+            except ConnectionError as e:
+                logger.warning('Unable to purge dataset %s: %s', data_set_id, e)
 
     def _job_status(self, job):
+        if not job.remote_job_id:
+            # Not submitted (held in local backlog until released, launch failed, or not launched yet): nothing to
+            # check on Galaxy
+            return self._current_state(job)
+        poller = galaxy_settings.STATUS_POLLER
+        store = get_store(self.complete_url, self.app_key) if poller else None
+        if store is not None:
+            state = store.get(job.remote_job_id, max_age=poller.get('max_age'))
+            if state is not None:
+                logger.debug('Current job remote state %s (from state table)', state)
+                self._mark_remote_state(job, state)
+                return self._check_paused(job, state)
         try:
-            remote_job = self.connector.jobs.get(job.remote_job_id)
+            remote_job = retry_idempotent(self.connector.jobs.get, job.remote_job_id)
             logger.debug('Current job remote state %s', remote_job.state)
-            return remote_job.state
-        except bioblend.galaxy.client.ConnectionError as e:
-            job.message = 'Connexion error for run %s:%s', (e.message, e.body)
+            if store is not None:
+                store.update([dict(id=job.remote_job_id, state=remote_job.state,
+                                   update_time=remote_job.wrapped.get('update_time'))])
+            self._mark_remote_state(job, remote_job.state)
+            return self._check_paused(job, remote_job.state)
+        except ConnectionError as e:
+            exc = GalaxyAdaptorConnectionError(e)
+            job.message = 'Connexion error for run %s' % exc.message
             logger.error('Galaxy connexion error %s', e)
-            raise GalaxyAdaptorConnectionError(e)
+            raise exc
+
+    def _current_state(self, job):
+        """ Raw state mapped to job current status, for jobs Galaxy does not know about """
+        if job.status == JobStatus.JOB_QUEUED:
+            return 'held'
+        return next((state for state, status in sorted(self._states_map.items()) if status == job.status),
+                    'undefined')
+
+    def _check_paused(self, job, state):
+        """ Galaxy pauses jobs whose inputs are in error: report them as errors when an input upload failed
+
+        :return: 'error' for a paused job with a failed upload, ``state`` otherwise
+        """
+        if state != 'paused':
+            return state
+        failed = [job_input_file.name for job_input_file in job.input_files
+                  if job_input_file.remote_input_id and
+                  self._data_set(job_input_file.remote_input_id)['state'] in self._failed_dataset_states]
+        if failed:
+            job.message = 'Input files upload failed: %s' % ', '.join(failed)
+            return 'error'
+        return state
+
+    def _mark_remote_state(self, job, state):
+        """ Keep track of first time a remote state is seen, used when Galaxy does not provide job metrics """
+        if state in ('running', 'ok', 'error'):
+            timer = JobPhaseTimer(job)
+            timer.mark('running')
+            if state != 'running':
+                timer.mark('finished')
 
     def _job_results(self, job):
+        timer = JobPhaseTimer(job)
         try:
-            remote_job = self.connector.jobs.get(job.remote_job_id, full_details=True)
+            remote_job = retry_idempotent(self.connector.jobs.get, job.remote_job_id, full_details=True)
             logger.debug('Retrieve job results from Galaxy %s', job.remote_job_id)
             if remote_job:
                 job.exit_code = remote_job.wrapped['exit_code']
                 if remote_job.state == 'ok':
                     logger.debug('Job info %s', remote_job)
-                    for job_output in job.outputs.all():
-                        if job_output.remote_output_id:
-                            logger.debug("Retrieved data from output %s:%s", job_output, job_output.remote_output_id)
-                            self.connector.gi.histories.download_dataset(job.remote_job_id,
-                                                                         job_output.remote_output_id,
-                                                                         join(job.working_dir, job_output.file_path),
-                                                                         use_default_filename=False)
-                            logger.debug("Saving output to %s" % join(job.working_dir, job_output.file_path))
+                    with timer.phase('download'):
+                        self._download_outputs(job, [job_output for job_output in job.outputs.all()
+                                                     if job_output.remote_output_id])
+                    self._memo_store(job, remote_job)
                 # GET stdout / stderr from Galaxy
-                with open(join(job.working_dir, job.stdout), 'a') as out, \
+                with timer.phase('logs'), open(join(job.working_dir, job.stdout), 'a') as out, \
                         open(join(job.working_dir, job.stderr), 'a') as err:
                     try:
                         if remote_job.wrapped['stdout']:
@@ -248,13 +954,90 @@ class GalaxyJobAdaptor(ApiKeyAdaptor):
             else:
                 logger.warning("Job not found %s ", job.remote_job_id)
             return job
-        except bioblend.galaxy.client.ConnectionError as e:
+        except ConnectionError as e:
             job.results_available = False
-            job.message = 'Connexion error for run %s:%s', (e.message, e.body)
-            raise GalaxyAdaptorConnectionError(e)
+            exc = GalaxyAdaptorConnectionError(e)
+            job.message = 'Connexion error for run %s' % exc.message
+            raise exc
+
+    def _download_outputs(self, job, job_outputs):
+        """ Download job outputs in job working dir, as one archive if enabled and worth it (see
+        ``ARCHIVE_DOWNLOAD`` setting), falling back to one download per output for outputs missing from archive
+        """
+        from requests.exceptions import RequestException
+
+        remaining = job_outputs
+        try:
+            if self._use_archive(job, job_outputs):
+                extracted = self._download_archive(job, job_outputs)
+                remaining = [job_output for job_output in job_outputs if job_output.remote_output_id not in extracted]
+        except (ConnectionError, RequestException, IOError, zipfile.BadZipfile) as e:
+            logger.warning('Archive download failed for job %s, download outputs one by one: %s', job.slug, e)
+        for job_output in remaining:
+            logger.debug("Retrieved data from output %s:%s", job_output, job_output.remote_output_id)
+            retry_idempotent(self._download_dataset, job_output.remote_output_id,
+                             join(job.working_dir, job_output.file_path))
+            logger.debug("Saving output to %s" % join(job.working_dir, job_output.file_path))
+
+    def _download_dataset(self, data_set_id, file_path):
+        """ Stream dataset content to ``file_path`` through connector requests layers (bioblend dataset download
+        uses plain ``requests``, out of limiter, breaker and cassette)
+        """
+        gi = self.connector.gi
+        data_set = self._data_set(data_set_id, keys=('state', 'file_ext', 'download_url'))
+        if data_set['state'] != 'ok':
+            raise AdaptorJobException('Dataset %s not ready: %s' % (data_set_id, data_set['state']))
+        url = urljoin(gi.base_url, data_set.get('download_url') or 'datasets/%s/display' % data_set_id)
+        response = gi.make_get_request(url, params=dict(to_ext=data_set['file_ext']), stream=True)
+        response.raise_for_status()
+        with open(file_path, 'wb') as data_file:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                data_file.write(chunk)
+
+    def _use_archive(self, job, job_outputs):
+        config = galaxy_settings.ARCHIVE_DOWNLOAD
+        if not config or len(job_outputs) < config.get('min_outputs', 1):
+            return False
+        contents = retry_idempotent(self.connector.gi.histories._get, id=job.remote_history_id, contents=True,
+                                    params=dict(ids=','.join(job_output.remote_output_id
+                                                             for job_output in job_outputs), details='all'))
+        return use_archive([data_set.get('file_size') for data_set in contents], config.get('min_outputs', 1),
+                           config.get('max_size'))
+
+    def _download_archive(self, job, job_outputs):
+        """ Download job outputs as one zip archive of a temporary dataset collection
+
+        :return: set of extracted outputs datasets ids
+        """
+        gi = self.connector.gi
+        collection = gi.histories.create_dataset_collection(job.remote_history_id, dict(
+            name='%s outputs' % job.slug,
+            collection_type='list',
+            element_identifiers=[dict(name=job_output.remote_output_id, src='hda', id=job_output.remote_output_id)
+                                 for job_output in job_outputs]))
+        archive_path = join(job.working_dir, '.galaxy_outputs.zip')
+        try:
+            response = gi.make_get_request('%s/dataset_collections/%s/download' % (gi.url, collection['id']),
+                                           params={}, stream=True)
+            response.raise_for_status()
+            with open(archive_path, 'wb') as archive:
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    archive.write(chunk)
+            extracted = extract_archive(archive_path, dict(
+                (job_output.remote_output_id, join(job.working_dir, job_output.file_path))
+                for job_output in job_outputs))
+            logger.debug('Extracted %i outputs from archive for job %s', len(extracted), job.slug)
+            return extracted
+        finally:
+            if os.path.exists(archive_path):
+                os.remove(archive_path)
+            try:
+                gi.histories.delete_dataset_collection(job.remote_history_id, collection['id'])
+            except ConnectionError as e:
+                logger.warning('Unable to delete outputs collection %s: %s', collection['id'], e)
 
     def _job_run_details(self, job):
-        remote_job = self.connector.jobs.get(job.remote_job_id, full_details=True)
+        remote_job = retry_idempotent(self.connector.jobs.get, job.remote_job_id, full_details=True)
         finished = None
         started = None
         extra = None
@@ -272,21 +1055,68 @@ class GalaxyJobAdaptor(ApiKeyAdaptor):
         details = JobRunDetails(job.id, str(job.slug), remote_job.id, name, exit_code,
                                 created, started, finished, extra)
         logger.debug('Job Exit Code %s %s', exit_code, finished)
+        timer = JobPhaseTimer(job)
+        timer.update_remote_times(created, started, finished)
+        logger.debug('Job phase timings %s', timer.data['phases'])
         # TODO see if remove history is needed
         # galaxy_allow_purge = self.connector.gi.config.get_config()['allow_user_dataset_purge']
         # self.connector.histories.delete(name=str(job.slug), purge=bool(galaxy_allow_purge))
         return details
 
     def test_connection(self):
+        """ Galaxy host health, from last heartbeat check when recent enough (see ``HEALTH`` setting), checked now
+        otherwise. Host heartbeat is started on first call.
+
+        :raise: :class:`waves.adaptors.galaxy.exception.GalaxyAdaptorConnectionError` if last check failed
+        """
+        monitor = get_health_monitor(self.complete_url, self.app_key, self._check_user)
+        if monitor is None:
+            return self.check_connection()
+        status = monitor.status(max_age=galaxy_settings.HEALTH.get('max_age')) or monitor.measure()
+        # Started once a recent check is recorded, heartbeat does not check host again right away
+        monitor.start()
+        if status['error']:
+            raise GalaxyAdaptorConnectionError(status['error'])
+        return status['available']
+
+    @property
+    def health(self):
+        """ Last recorded Galaxy host health status (latencies history, last error), see
+        :meth:`waves.adaptors.galaxy.health.HealthMonitor.status`
+        """
+        monitor = get_health_monitor(self.complete_url, self.app_key, self._check_user)
+        return monitor.status() if monitor is not None else None
+
+    def check_connection(self):
+        """ Check remote user on Galaxy, always sent even if host circuit is open """
+        breaker = get_breaker(self.complete_url)
         try:
-            self.connector = self.connect()
-            remote_user = self.connector.gi.users.get_current_user()
+            with breaker.probing():
+                remote_user = self.connect().gi.users.get_current_user()
+            breaker.record_success()
             return remote_user['username'] is not None and remote_user['deleted'] is False
         except ConnectionError as exc:
             self._connected = False
             raise GalaxyAdaptorConnectionError(exc)
         return False
 
+    def _check_user(self):
+        """ Health probe: remote user exists and is not deleted, request sent through connector requests layers """
+        remote_user = self.connect().gi.users.get_current_user()
+        return remote_user.get('username') is not None and remote_user.get('deleted') is False
+
+    def job_phase_timings(self, job):
+        """ WAVES side phase timings recorded for job, stored alongside job run details
+
+        :return: dictionary of phase names with durations in seconds, see :mod:`waves.adaptors.galaxy.timing`
+        """
+        return JobPhaseTimer(job).data['phases']
+
+    @property
+    def rate_limit_stats(self):
+        """ Number of requests and time spent waiting for Galaxy host limiter, per traffic category """
+        return self.limiter.stats if self.limiter is not None else {}
+
     def connexion_string(self):
         return self.complete_url + '?api_key=' + str(self.app_key)
 
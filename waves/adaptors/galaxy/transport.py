@@ -0,0 +1,41 @@
+""" Hooks on bioblend HTTP layer, used to wrap every request sent to a Galaxy host """
+from __future__ import unicode_literals
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['classify_request', 'add_request_layer']
+
+#: bioblend GalaxyClient methods issuing HTTP requests
+REQUEST_METHODS = dict(get='make_get_request',
+                       post='make_post_request',
+                       put='make_put_request',
+                       delete='make_delete_request')
+
+
+def classify_request(method, url, files_attached=False):
+    """ Return traffic category for a request: 'upload', 'submit', 'poll' or 'default' """
+    if method == 'get':
+        return 'poll'
+    if method == 'post' and url.rstrip('/').endswith('/api/tools'):
+        return 'upload' if files_attached else 'submit'
+    return 'default'
+
+
+def add_request_layer(gi, layer):
+    """ Wrap all requests issued by bioblend ``gi`` (a :class:`bioblend.galaxy.GalaxyInstance`) with ``layer``
+
+    ``layer`` is called as ``layer(method, url, kwargs, send)`` where ``send`` is a callable performing the
+    request, it must return ``send()`` result. Layers are stacked, last added is called first.
+    """
+    for method, attr in REQUEST_METHODS.items():
+        setattr(gi, attr, _wrap(method, getattr(gi, attr), layer))
+    return gi
+
+
+def _wrap(method, send, layer):
+    def wrapped(url, *args, **kwargs):
+        return layer(method, url, kwargs, lambda: send(url, *args, **kwargs))
+
+    return wrapped
@@ -0,0 +1,173 @@
+""" Local validation of Galaxy tool run parameters
+
+Galaxy tool inputs description (``io_details``) is compiled once per tool version into a :class:`ToolValidator`:
+checks per input path (value type, bounds, allowed options, required data inputs, paired collections).
+Jobs are validated before any remote work (history creation, uploads), invalid ones fail right away instead of after
+their inputs upload.
+
+Only checks Galaxy would enforce are compiled: text values, dynamic options and unknown params are not checked, and
+missing params are left for Galaxy to fill with their default value. Params inside conditionals are only checked for
+the active case, and params sharing their name with another active param can't be told apart and are not checked.
+"""
+from __future__ import unicode_literals
+
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['ToolValidator', 'get_validator']
+
+#: Boolean values accepted by Galaxy besides tool specific true / false values
+BOOLEAN_VALUES = ('true', 'false', 'yes', 'no', 'on', 'off')
+
+
+def _number(cast, low, high):
+    low = cast(low) if low not in (None, '') else None
+    high = cast(high) if high not in (None, '') else None
+
+    def check(value):
+        try:
+            number = cast(value)
+        except (TypeError, ValueError):
+            return 'expected %s value, got "%s"' % ('an integer' if cast is int else 'a number', value)
+        if low is not None and number < low:
+            return 'value %s is lower than %s' % (value, low)
+        if high is not None and number > high:
+            return 'value %s is greater than %s' % (value, high)
+    return check
+
+
+def _boolean(true_value, false_value):
+    allowed = set(BOOLEAN_VALUES) | set(value.lower() for value in (true_value, false_value) if value)
+
+    def check(value):
+        if value.lower() not in allowed:
+            return 'expected a boolean value, got "%s"' % value
+    return check
+
+
+def _select(options, multiple):
+    allowed = set(option[1] for option in options)
+
+    def check(value):
+        values = value.split(',') if multiple else [value]
+        invalid = [item for item in values if item not in allowed]
+        if invalid:
+            return 'unexpected value(s) %s' % ', '.join('"%s"' % item for item in invalid)
+    return check
+
+
+class ToolValidator(object):
+    """ Compiled checks for one Galaxy tool version
+
+    :param tool_inputs: Galaxy tool 'inputs' description, as returned with ``io_details``
+    """
+
+    def __init__(self, tool_inputs):
+        #: Checks per param path ('|' separated, as Galaxy names nested params, conditionals cases values included):
+        #: tuple of param name, conditions (enclosing conditionals test params with case values, with their default)
+        #: and callable returning an error message for an invalid value, None otherwise
+        self.checks = OrderedDict()
+        #: Data inputs names Galaxy requires
+        self.required_data = []
+        #: Paired collections inputs names
+        self.paired = []
+        self._compile(tool_inputs, top_level=True, prefix='', conditions=())
+
+    def _compile(self, tool_inputs, top_level, prefix, conditions):
+        for tool_input in tool_inputs:
+            input_type = tool_input.get('type')
+            name = tool_input.get('name')
+            path = prefix + name if name else prefix
+            if input_type == 'section':
+                self._compile(tool_input.get('inputs', []), top_level, path + '|', conditions)
+            elif input_type == 'repeat':
+                self._compile(tool_input.get('inputs', []), False, path + '|', conditions)
+            elif input_type == 'conditional':
+                test_param = tool_input['test_param']
+                self._compile([test_param], top_level, path + '|', conditions)
+                for case in tool_input.get('cases', []):
+                    condition = (test_param.get('name'), '%s' % case.get('value'), test_param.get('value'),
+                                 test_param.get('type') == 'boolean')
+                    self._compile(case.get('inputs', []), False, '%s|%s|' % (path, case.get('value')),
+                                  conditions + (condition,))
+            elif input_type in ('data', 'data_collection'):
+                if top_level and not tool_input.get('optional') and name not in self.required_data:
+                    self.required_data.append(name)
+                if input_type == 'data_collection' and (tool_input.get('collection_types') or ['list'])[0] == 'paired':
+                    self.paired.append(name)
+            elif path not in self.checks and not tool_input.get('hidden') and not tool_input.get('is_dynamic'):
+                check = self._compile_param(input_type, tool_input)
+                if check is not None:
+                    self.checks[path] = (name, conditions, check)
+
+    @staticmethod
+    def _compile_param(input_type, tool_input):
+        if input_type == 'integer':
+            return _number(int, tool_input.get('min'), tool_input.get('max'))
+        if input_type == 'float':
+            return _number(float, tool_input.get('min'), tool_input.get('max'))
+        if input_type == 'boolean':
+            return _boolean(tool_input.get('truevalue'), tool_input.get('falsevalue'))
+        if input_type in ('select', 'genomebuild') and tool_input.get('options'):
+            return _select(tool_input['options'], tool_input.get('multiple'))
+        return None
+
+    @staticmethod
+    def _active(conditions, params):
+        """ Whether all conditionals cases are selected by run params (or test params defaults) """
+        for test_name, case_value, default, boolean in conditions:
+            value = params.get(test_name, default)
+            if value is None:
+                return False
+            value = '%s' % value
+            if boolean:
+                value = 'true' if value.lower() in ('true', 'yes', 'on') else 'false'
+            if value != case_value:
+                return False
+        return True
+
+    def errors(self, params, input_files):
+        """ Validate a tool run
+
+        :param params: dictionary of params names with their values (see ``GalaxyJobAdaptor._tool_params``)
+        :param input_files: list of input files params names, one per file
+        :return: list of error messages, empty if run is valid
+        """
+        active = {}
+        for name, conditions, check in self.checks.values():
+            if name in params and self._active(conditions, params):
+                active.setdefault(name, []).append(check)
+        errors = []
+        for name, checks in active.items():
+            if len(checks) > 1:
+                logger.debug('Param %s is ambiguous, not checked', name)
+                continue
+            error = checks[0]('%s' % params[name])
+            if error:
+                errors.append('%s: %s' % (name, error))
+        errors.extend('%s: missing input file' % name for name in self.required_data if name not in input_files)
+        errors.extend('%s: paired collection expects 2 files, got %i' % (name, input_files.count(name))
+                      for name in self.paired if name in input_files and input_files.count(name) != 2)
+        return errors
+
+
+_validators = {}
+
+
+def get_validator(url, tool_id, tool_version, tool_inputs, generation=0):
+    """ Return compiled validator for tool version on Galaxy host ``url``, compiling ``tool_inputs`` on first call
+
+    :param tool_inputs: callable returning Galaxy tool 'inputs' description
+    :param generation: tool details generation in metadata cache (see
+        :meth:`waves.adaptors.galaxy.cache.GalaxyMetadataCache.tool_generation`), validators of previous generations
+        of tool are dropped
+    """
+    key = (url, tool_id, tool_version, generation)
+    if key not in _validators:
+        for stale in [stale for stale in _validators if stale[:2] == (url, tool_id)]:
+            del _validators[stale]
+        _validators[key] = ToolValidator(tool_inputs())
+        logger.debug('Compiled validator for %s %s on %s', tool_id, tool_version, url)
+    return _validators[key]
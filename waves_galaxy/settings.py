@@ -144,6 +144,7 @@ WAVES_DEBUG_GALAXY = True
 WAVES_CORE = {
     'ADAPTORS_CLASSES': (
         'waves.adaptors.galaxy.tool.GalaxyJobAdaptor',
+        'waves.adaptors.galaxy.router.GalaxyRouterAdaptor',
         'waves.adaptors.galaxy.workflow.GalaxyWorkFlowAdaptor',
     ),
 }
\ No newline at end of file